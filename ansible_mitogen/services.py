@@ -359,112 +359,128 @@ class FileService(mitogen.service.Service):
     max_message_size = 1000
     unregistered_msg = 'Path is not registered with FileService.'
 
-    #: Maximum size of any stream's output queue before we temporarily stop
-    #: pumping more file chunks. The queue may overspill by up to
-    #: mitogen.core.CHUNK_SIZE-1 bytes (128KiB-1).
-    max_queue_size = 1048576
-
-    #: Time spent by the scheduler thread asleep when it has no more queues to
-    #: pump. With max_queue_size=1MiB and a sleep of 10ms, maximum throughput
-    #: on any single stream is 100MiB/sec, which is 5x what SSH can handle on
-    #: my laptop.
-    sleep_delay_ms = 0.01
-
     def __init__(self, router):
         super(FileService, self).__init__(router)
         #: Mapping of registered path -> file size.
         self._size_by_path = {}
-        #: Queue used to communicate from service to scheduler thread.
+        #: Queue used to communicate from service to scheduler thread. Items
+        #: are `(NEW, sender, fp)` for a new transfer, `(READY, stream)` once
+        #: the last chunk for a stream was queued below its high watermark or
+        #: the stream has since drained, or `(LOST, stream)` once it could not
+        #: be routed.
         self._queue = mitogen.core.Latch()
         #: Mapping of Stream->[(sender, fp)].
         self._pending_by_stream = {}
         self._thread = threading.Thread(target=self._scheduler_main)
         self._thread.start()
 
-    def _pending_bytes(self, stream):
+    def on_shutdown(self):
+        """
+        Close the scheduler's queue, causing :meth:`_scheduler_main` to exit.
         """
-        Defer a function call to the Broker thread in order to accurately
-        measure the bytes pending in `stream`'s queue.
+        super(FileService, self).on_shutdown()
+        self._queue.close()
 
-        This must be done synchronized with the Broker, as scheduler
-        uncertainty could cause Sender.send()'s deferred enqueues to be
-        processed very late, making the output queue look much emptier than it
-        really is (or is about to become).
+    #: Tags for items on :attr:`_queue`.
+    NEW, READY, LOST = range(3)
+
+    def _on_stream_ready(self, stream, routed):
+        """
+        Called on the broker thread once `stream` can accept another chunk,
+        or once the last chunk could not be routed because the target is gone.
         """
-        latch = mitogen.core.Latch()
-        self.router.broker.defer(lambda: latch.put(stream.pending_bytes()))
-        return latch.get()
+        try:
+            self._queue.put((self.READY if routed else self.LOST, stream))
+        except mitogen.core.LatchError:
+            pass  # Shutting down.
 
-    def _schedule_pending(self, stream, pending):
+    def _schedule_pending(self, stream):
         """
-        Consider the pending file transfers for a single stream, pumping new
-        file chunks into the stream's queue while its size is below the
-        configured limit.
+        Pump the next chunk of the first pending file transfer for a single
+        stream. The broker routes the chunk and wakes the scheduler once the
+        stream is below its high watermark, so each stream has at most one
+        chunk scheduled, and a congested stream is not polled.
 
         :param mitogen.core.Stream stream:
             Stream to pump chunks for.
-        :param pending:
-            Corresponding list from :attr:`_pending_by_stream`.
         """
-        while pending and self._pending_bytes(stream) < self.max_queue_size:
+        pending = self._pending_by_stream[stream]
+        while pending:
             sender, fp = pending[0]
             s = fp.read(mitogen.core.CHUNK_SIZE)
             if s:
-                sender.send(s)
-                continue
+                msg = mitogen.core.Message.pickled(
+                    s,
+                    dst_id=sender.context.context_id,
+                    handle=sender.dst_handle,
+                )
+                self.router.route_throttled(
+                    msg, lambda routed: self._on_stream_ready(stream, routed)
+                )
+                return
 
             # Empty read, indicating this file is fully transferred. Mark the
             # sender closed (causing the corresponding Receiver loop in the
-            # target to exit), close the file handle, remove our entry from the
-            # pending list, and delete the stream's entry in the pending map if
-            # no more sends remain.
+            # target to exit), close the file handle, and remove our entry from
+            # the pending list.
             sender.close()
             fp.close()
             pending.pop(0)
-            if not pending:
-                del self._pending_by_stream[stream]
-
-    def _sleep_on_queue(self):
-        """
-        Sleep indefinitely (no active transfers) or for :attr:`sleep_delay_ms`
-        (active transfers) waiting for a new transfer request to arrive from
-        the :meth:`fetch` method.
 
-        If a new request arrives, add it to the appropriate list in
-        :attr:`_pending_by_stream`.
+        # No more sends remain.
+        del self._pending_by_stream[stream]
 
-        :returns:
-            :data:`True` the scheduler's queue is still open,
-            :meth:`on_shutdown` hasn't been called yet, otherwise
-            :data:`False`.
+    def _drop_pending(self, stream):
         """
-        try:
-            if self._schedule_pending:
-                timeout = self.sleep_delay_ms
-            else:
-                timeout = None
-            sender, fp = self._queue.get(timeout=timeout)
-        except mitogen.core.LatchError:
-            return False
-        except mitogen.core.TimeoutError:
-            return True
+        Abandon every pending transfer for a stream whose target can no longer
+        be reached, rather than reading the remaining files only to discard
+        each chunk.
+        """
+        for sender, fp in self._pending_by_stream.pop(stream, []):
+            LOG.debug('%r: dropping transfer of %r for %r',
+                      self, fp.name, sender)
+            sender.close()
+            fp.close()
 
-        LOG.debug('%r._sleep_on_queue(): setting up %r for %r',
+    def _on_new_transfer(self, sender, fp):
+        """
+        Add a transfer that arrived from :meth:`fetch` to the appropriate list
+        in :attr:`_pending_by_stream`, starting to pump its stream if it was
+        idle.
+        """
+        LOG.debug('%r._on_new_transfer(): setting up %r for %r',
                   self, fp.name, sender)
         stream = self.router.stream_by_id(sender.context.context_id)
+        if stream is None:
+            LOG.debug('%r: no route to %r, dropping %r',
+                      self, sender.context, fp.name)
+            sender.close()
+            fp.close()
+            return
+
         pending = self._pending_by_stream.setdefault(stream, [])
         pending.append((sender, fp))
-        return True
+        if len(pending) == 1:
+            self._schedule_pending(stream)
 
     def _scheduler_main(self):
         """
-        Scheduler thread's main function. Sleep until
-        :meth:`_sleep_on_queue` indicates the queue has been shut down,
-        pending pending file chunks each time we wake.
+        Scheduler thread's main function. Sleep until :meth:`on_shutdown`
+        closes the queue, setting up new transfers and pumping file chunks for
+        ready streams each time we wake.
         """
-        while self._sleep_on_queue():
-            for stream, pending in list(self._pending_by_stream.items()):
-                self._schedule_pending(stream, pending)
+        while True:
+            try:
+                item = self._queue.get()
+            except mitogen.core.LatchError:
+                break
+            tag, args = item[0], item[1:]
+            if tag == self.NEW:
+                self._on_new_transfer(*args)
+            elif tag == self.READY:
+                self._schedule_pending(*args)
+            else:
+                self._drop_pending(*args)
 
         # on_shutdown() has been called. Send close() on every sender to give
         # targets a chance to shut down gracefully.
@@ -514,6 +530,7 @@ class FileService(mitogen.service.Service):
 
         LOG.debug('Serving %r', path)
         self._queue.put((
+            self.NEW,
             sender,
             open(path, 'rb', mitogen.core.CHUNK_SIZE),
         ))
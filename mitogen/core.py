@@ -29,7 +29,9 @@
 import collections
 import errno
 import fcntl
+import heapq
 import imp
+import io
 import itertools
 import logging
 import os
@@ -75,6 +77,10 @@ DEL_ROUTE = 104
 ALLOCATE_ID = 105
 SHUTDOWN = 106
 LOAD_MODULE = 107
+CACHED_MODULES = 108
+CODE_MAGIC = 109
+LOAD_MODULES = 110
+IS_FRAGMENT = 998
 IS_DEAD = 999
 
 PY3 = sys.version_info > (3,)
@@ -83,9 +89,23 @@ if PY3:
 else:
     b = str
 
+#: Return the current time in seconds, from a clock unaffected by changes to
+#: the system time where one is available, for timers and deadlines.
+now = getattr(time, 'monotonic', time.time)
+
 CHUNK_SIZE = 131072
+
+#: Maximum number of buffers passed to a single writev() call. 1024 on Linux,
+#: BSD and OS X.
+IOV_MAX = 1024
 _tls = threading.local()
 
+try:
+    memoryview = memoryview
+except NameError:
+    # Python 2.6.
+    memoryview = None
+
 
 if __name__ == 'mitogen.core':
     # When loaded using import mechanism, ExternalContext.main() will not have
@@ -201,11 +221,29 @@ def set_block(fd):
     fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
 
 
+def _slice_bytes(buf, start, end):
+    """Return bytes `start`..`end` of the :py:class:`bytearray` `buf` as a
+    string, copying them only once."""
+    if memoryview is None:
+        return str(buffer(buf, start, end - start))
+    return memoryview(buf)[start:end].tobytes()
+
+
+def _view(s, start, end=None):
+    """Return bytes `start`..`end` of the string `s` as an object that can be
+    written or compressed, without copying them."""
+    if PY3:
+        return memoryview(s)[start:end]
+    if end is None:
+        return buffer(s, start)
+    return buffer(s, start, end - start)
+
+
 def io_op(func, *args):
     while True:
         try:
             return func(*args), False
-        except (select.error, OSError):
+        except (select.error, OSError, IOError):
             e = sys.exc_info()[1]
             _vv and IOLOG.debug('io_op(%r) -> OSError: %s', func, e)
             if e[0] == errno.EINTR:
@@ -275,23 +313,89 @@ def enable_profiling():
                 fp.close()
 
 
-class Message(object):
-    dst_id = None
-    src_id = None
-    auth_id = None
-    handle = None
-    reply_to = None
-    data = ''
-    _unpickled = object()
+class HeaderCodec(struct.Struct):
+    """
+    Encode and decode the fixed-size header preceding each message in the
+    :ref:`stream protocol <stream-protocol>`. The format is compiled once, and
+    headers are decoded in place from the caller's buffer, so no intermediate
+    strings are created.
+    """
+    #: :py:mod:`struct` format of the header: `dst_id`, `src_id`, `auth_id`,
+    #: `handle`, `reply_to`, and the length of the data that follows.
+    fmt = '>LLLLLL'
 
-    router = None
-    receiver = None
+    too_large_msg = 'Maximum message size exceeded (got %d, max %d)'
+
+    def __init__(self):
+        struct.Struct.__init__(self, self.fmt)
+
+    def encode(self, msg, reply_to=None, length=None):
+        """
+        Return the header for :py:class:`Message` `msg`, or for a fragment of
+        it if `reply_to` and the fragment's `length` are given.
+        """
+        if reply_to is None:
+            reply_to = msg.reply_to or 0
+        if length is None:
+            length = len(msg.data)
+        return self.pack(msg.dst_id, msg.src_id, msg.auth_id, msg.handle,
+                         reply_to, length)
+
+    #: Encoding of the `auth_id` field, found at :py:attr:`auth_id_offset`.
+    auth_id_field = struct.Struct('>L')
+    auth_id_offset = 8
+
+    def restamp(self, frame, auth_id):
+        """Return the encoded header or frame `frame` with its `auth_id`
+        replaced."""
+        i = self.auth_id_offset
+        return frame[:i] + self.auth_id_field.pack(auth_id) + frame[i + 4:]
+
+    def decode_from(self, buf, offset=0, end=None, max_message_size=None):
+        """
+        Decode the header found at `offset` in `buf`, returning a tuple of
+        `(dst_id, src_id, auth_id, handle, reply_to, length)`, or
+        :py:data:`None` if fewer than :py:attr:`size` bytes precede `end`, or
+        the end of `buf` if `end` is :py:data:`None`.
+
+        :raises StreamError:
+            The length exceeds `max_message_size`.
+        """
+        if end is None:
+            end = len(buf)
+        if end - offset < self.size:
+            return None
+        hdr = self.unpack_from(buf, offset)
+        if max_message_size is not None and hdr[5] > max_message_size:
+            raise StreamError(self.too_large_msg, hdr[5], max_message_size)
+        return hdr
 
-    def __init__(self, **kwargs):
-        self.src_id = mitogen.context_id
-        self.auth_id = mitogen.context_id
-        vars(self).update(kwargs)
-        assert isinstance(self.data, str)
+
+#: Placeholder for :py:attr:`Message._unpickled` before :py:meth:`unpickle`
+#: has been called.
+_NOT_UNPICKLED = object()
+
+
+class Message(object):
+    __slots__ = ('dst_id', 'src_id', 'auth_id', 'handle', 'reply_to', 'data',
+                 'router', 'receiver', '_unpickled')
+
+    def __init__(self, dst_id=None, src_id=None, auth_id=None, handle=None,
+                 reply_to=None, data='', router=None, receiver=None):
+        if src_id is None:
+            src_id = mitogen.context_id
+        if auth_id is None:
+            auth_id = mitogen.context_id
+        self.dst_id = dst_id
+        self.src_id = src_id
+        self.auth_id = auth_id
+        self.handle = handle
+        self.reply_to = reply_to
+        self.data = data
+        self.router = router
+        self.receiver = receiver
+        self._unpickled = _NOT_UNPICKLED
+        assert isinstance(data, str)
 
     def _unpickle_context(self, context_id, name):
         return _unpickle_context(self.router, context_id, name)
@@ -316,6 +420,10 @@ class Message(object):
     def is_dead(self):
         return self.reply_to == IS_DEAD
 
+    @property
+    def is_fragment(self):
+        return self.reply_to == IS_FRAGMENT
+
     @classmethod
     def dead(cls, **kwargs):
         return cls(reply_to=IS_DEAD, **kwargs)
@@ -335,19 +443,19 @@ class Message(object):
             msg = Message.pickled(msg)
         msg.dst_id = self.src_id
         msg.handle = self.reply_to
-        vars(msg).update(kwargs)
+        for name, value in kwargs.iteritems():
+            setattr(msg, name, value)
         (self.router or router).route(msg)
 
     def unpickle(self, throw=True, throw_dead=True):
         """Deserialize `data` into an object."""
         _vv and IOLOG.debug('%r.unpickle()', self)
-        if throw_dead and self.is_dead:
+        if throw_dead and self.reply_to == IS_DEAD:
             raise ChannelError(ChannelError.remote_msg)
 
         obj = self._unpickled
-        if obj is Message._unpickled:
-            fp = BytesIO(self.data)
-            unpickler = cPickle.Unpickler(fp)
+        if obj is _NOT_UNPICKLED:
+            unpickler = cPickle.Unpickler(BytesIO(self.data))
             try:
                 unpickler.find_global = self._find_global
             except AttributeError:
@@ -356,14 +464,13 @@ class Message(object):
             try:
                 # Must occur off the broker thread.
                 obj = unpickler.load()
-                self._unpickled = obj
             except (TypeError, ValueError):
                 e = sys.exc_info()[1]
                 raise StreamError('invalid message: %s', e)
+            self._unpickled = obj
 
-        if throw:
-            if isinstance(obj, CallError):
-                raise obj
+        if throw and isinstance(obj, CallError):
+            raise obj
 
         return obj
 
@@ -390,10 +497,38 @@ class Sender(object):
         _vv and IOLOG.debug('%r.close()', self)
         self.context.send(Message.dead(handle=self.dst_handle))
 
-    def send(self, data):
-        """Send `data` to the remote."""
+    #: :py:class:`Latch` receiving :py:data:`None` once the message from the
+    #: last call to :py:meth:`send` with `block=True` was queued on a stream
+    #: that is not congested.
+    _ready = None
+
+    def send(self, data, block=False):
+        """
+        Send `data` to the remote.
+
+        :param bool block:
+            If :py:data:`True`, apply backpressure: first wait until the
+            message previously sent with `block=True` was queued on a stream
+            below its :py:attr:`high watermark <Stream.high_watermark>`, or
+            until that stream drains. The sending thread therefore runs at
+            most one message ahead of a congested stream. Must not be used on
+            the broker thread, nor concurrently from several threads.
+        """
         _vv and IOLOG.debug('%r.send(%r..)', self, repr(data)[:100])
-        self.context.send(Message.pickled(data, handle=self.dst_handle))
+        msg = Message.pickled(data, handle=self.dst_handle)
+        if not block:
+            self.context.send(msg)
+            return
+
+        router = self.context.router
+        if router.broker._thread == threading.currentThread():
+            raise SystemError('Cannot make blocking call on broker thread')
+
+        if self._ready is not None:
+            self._ready.get()
+        latch = self._ready = Latch()
+        msg.dst_id = self.context.context_id
+        router.route_throttled(msg, lambda routed: latch.put(None))
 
 
 def _unpickle_sender(router, context_id, dst_handle):
@@ -409,7 +544,7 @@ class Receiver(object):
     raise_channelerror = True
 
     def __init__(self, router, handle=None, persist=True,
-                 respondent=None, policy=None):
+                 respondent=None, policy=None, fragments=False):
         self.router = router
         self.handle = handle  # Avoid __repr__ crash in add_handler()
         self.handle = router.add_handler(
@@ -418,6 +553,7 @@ class Receiver(object):
             policy=policy,
             persist=persist,
             respondent=respondent,
+            fragments=fragments,
         )
         self._latch = Latch()
 
@@ -460,6 +596,23 @@ class Receiver(object):
             except ChannelError:
                 return
 
+    def iter_data(self):
+        """
+        Yield the data of each fragment of the next message as it arrives,
+        without unpickling it, ending after the final fragment. For use with
+        `fragments=True`, where a fragment's data is a slice of the sender's
+        :py:attr:`Message.data`, so it is only meaningful alone if the sender
+        sent raw bytes rather than using :py:meth:`Sender.send`.
+
+        :raises ChannelError:
+            The channel was closed before the final fragment arrived.
+        """
+        while True:
+            msg = self.get()
+            yield msg.data
+            if not msg.is_fragment:
+                return
+
 
 class Channel(Sender, Receiver):
     def __init__(self, router, context, dst_handle, handle=None):
@@ -473,12 +626,28 @@ class Channel(Sender, Receiver):
         )
 
 
+def compile_module(fullname, source, filename):
+    """
+    Compile `source` for the module `fullname` as :py:class:`Importer` would.
+    """
+    # TODO: monster hack: work around modules now being imported as their
+    # actual name, so when Ansible "apt.py" tries to "import apt", it gets
+    # itself. Instead force absolute imports during compilation.
+    flags = 0
+    if fullname.startswith('ansible'):
+        flags = 0x4000
+    return compile(source, filename, 'exec', flags, True)
+
+
 class Importer(object):
     """
     Import protocol implementation that fetches modules from the parent
     process.
 
     :param context: Context to communicate via.
+    :param bytes core_src:
+        Compressed preamble that started this context, from which the source
+        of :py:mod:`mitogen.core` is served, or empty.
     """
     def __init__(self, router, context, core_src, whitelist=(), blacklist=()):
         self._context = context
@@ -488,6 +657,7 @@ class Importer(object):
             'fakessh',
             'fork',
             'master',
+            'module_cache',
             'parent',
             'service',
             'ssh',
@@ -515,10 +685,14 @@ class Importer(object):
                 'mitogen.core',
                 None,
                 'mitogen/core.py',
-                zlib.compress(core_src, 9),
+                core_src,
                 [],
             )
+        self._router = router
         self._install_handler(router)
+        #: :py:class:`mitogen.module_cache.Resolver` completing tuples whose
+        #: source the parent omitted, if enabled.
+        self._resolver = None
 
     def _install_handler(self, router):
         router.add_handler(
@@ -526,6 +700,11 @@ class Importer(object):
             handle=LOAD_MODULE,
             policy=has_parent_authority,
         )
+        router.add_handler(
+            fn=self._on_load_modules,
+            handle=LOAD_MODULES,
+            policy=has_parent_authority,
+        )
 
     def __repr__(self):
         return 'Importer()'
@@ -606,18 +785,50 @@ class Importer(object):
             # later.
             os.environ['PBR_VERSION'] = '0.0.0'
 
+    def _on_dead(self):
+        if self._resolver:
+            self._resolver.on_dead()
+
     def _on_load_module(self, msg):
         if msg.is_dead:
+            self._on_dead()
             return
+        self._load_tuples([msg.unpickle()])
 
-        tup = msg.unpickle()
-        fullname = tup[0]
-        _v and LOG.debug('Importer._on_load_module(%r)', fullname)
-
+    def _on_load_modules(self, msg):
+        if msg.is_dead:
+            self._on_dead()
+            return
+        # Bundled source and code are compressed together rather than singly.
+        tups = []
+        for tup in Message(data=zlib.decompress(msg.data)).unpickle():
+            if tup[3] is not None:
+                tup = tup[:3] + (zlib.compress(tup[3]),) + tup[4:]
+            if len(tup) > 6 and tup[6] is not None:
+                tup = tup[:6] + (zlib.compress(tup[6]),)
+            tups.append(tup)
+        self._load_tuples(tups)
+
+    def _load_tuples(self, tups):
+        """
+        Store each of the :py:data:`LOAD_MODULE` tuples `tups`, whose source
+        and code are compressed, then run callbacks waiting on any of them, so
+        that no waiting import observes only some of them.
+        """
+        resolved = []
+        for tup in tups:
+            _v and LOG.debug('Importer._load_tuples(%r)', tup[0])
+            if self._resolver and len(tup) > 5 and tup[2] is not None:
+                tup = self._resolver.resolve(tup)
+            if tup is not None:
+                resolved.append(tup)
+
+        callbacks = []
         self._lock.acquire()
         try:
-            self._cache[fullname] = tup
-            callbacks = self._callbacks.pop(fullname, [])
+            for tup in resolved:
+                self._cache[tup[0]] = tup
+                callbacks.extend(self._callbacks.pop(tup[0], ()))
         finally:
             self._lock.release()
 
@@ -666,14 +877,10 @@ class Importer(object):
         else:
             mod.__package__ = fullname.rpartition('.')[0] or None
 
-        # TODO: monster hack: work around modules now being imported as their
-        # actual name, so when Ansible "apt.py" tries to "import apt", it gets
-        # itself. Instead force absolute imports during compilation.
-        flags = 0
-        if fullname.startswith('ansible'):
-            flags = 0x4000
-        source = self.get_source(fullname)
-        code = compile(source, mod.__file__, 'exec', flags, True)
+        code = self._resolver and self._resolver.get_code(ret)
+        if code is None:
+            code = compile_module(fullname, self.get_source(fullname),
+                                  mod.__file__)
         if PY3:
             exec(code, vars(mod))
         else:
@@ -685,8 +892,15 @@ class Importer(object):
             return 'master:' + self._cache[fullname][2]
 
     def get_source(self, fullname):
-        if fullname in self._cache:
-            return zlib.decompress(self._cache[fullname][3])
+        tup = self._cache.get(fullname)
+        if tup and tup[2] is not None and tup[3] is None and self._resolver:
+            tup = self._resolver.fetch_source(fullname)
+        if tup is not None and tup[3] is not None:
+            source = zlib.decompress(tup[3])
+            if fullname == 'mitogen.core':
+                # Our copy is the preamble, ending with the call that ran it.
+                source = '\n'.join(source.splitlines()[:-1])
+            return source
 
 
 class LogHandler(logging.Handler):
@@ -742,6 +956,7 @@ class Side(object):
             _vv and IOLOG.debug('%r.close()', self)
             os.close(self.fd)
             self.fd = None
+            self._file = None
 
     def read(self, n=CHUNK_SIZE):
         s, disconnected = io_op(os.read, self.fd, n)
@@ -749,6 +964,27 @@ class Side(object):
             return ''
         return s
 
+    _file = None
+
+    def readinto(self, buf, offset):
+        """
+        Read directly into the :py:class:`bytearray` `buf` starting at
+        `offset`, without allocating an intermediate string. Return the
+        number of bytes read, 0 on disconnection, or ``None`` if no data was
+        available.
+        """
+        if memoryview is None:
+            s = self.read(len(buf) - offset)
+            buf[offset:offset + len(s)] = s
+            return len(s)
+
+        if self._file is None:
+            self._file = io.FileIO(self.fd, 'r', closefd=False)
+        n, disconnected = io_op(self._file.readinto, memoryview(buf)[offset:])
+        if disconnected:
+            return 0
+        return n
+
     def write(self, s):
         if self.fd is None:
             return None
@@ -758,6 +994,17 @@ class Side(object):
             return None
         return written
 
+    def writev(self, bufs):
+        """Like :py:meth:`write`, but gather output from a sequence of
+        buffers using a single system call. Requires :py:func:`os.writev`."""
+        if self.fd is None:
+            return None
+
+        written, disconnected = io_op(os.writev, self.fd, bufs)
+        if disconnected:
+            return None
+        return written
+
 
 class BasicStream(object):
     receive_side = None
@@ -788,127 +1035,660 @@ class Stream(BasicStream):
     #: :py:attr:`Message.auth_id` of every message received on this stream.
     auth_id = None
 
+    #: If :py:data:`True`, several modules sent together to the remote side
+    #: in reply to one request are sent as one :py:data:`LOAD_MODULES`
+    #: message, otherwise as :py:data:`LOAD_MODULE` messages.
+    bundle_modules = True
+
+    #: If :py:data:`True`, messages to :py:attr:`priority_handles` are queued
+    #: in the priority lane, so they may overtake messages to other handles
+    #: queued earlier. Otherwise every message is sent in the order it was
+    #: queued.
+    priority_lanes = False
+
     def __init__(self, router, remote_id, **kwargs):
         self._router = router
         self.remote_id = remote_id
         self.name = 'default'
         self.sent_modules = set()
+        #: Prefixes of digests of module source cached by the remote
+        #: :py:class:`mitogen.module_cache.ModuleCache`, as announced by
+        #: :py:data:`CACHED_MODULES`.
+        self.cached_modules = set()
+        #: Bytecode magic of the remote interpreter, as announced by
+        #: :py:data:`CODE_MAGIC`, or :py:data:`None`.
+        self.code_magic = None
         self.construct(**kwargs)
-        self._input_buf = collections.deque()
         self._output_buf = collections.deque()
-        self._input_buf_len = 0
         self._output_buf_len = 0
+        self._lanes = tuple(collections.deque() for q in self.lane_quantum)
+        self._deficit = [0] * len(self._lanes)
+        self._queued_len = 0
+        self._priority_queued = 0
+        self._priority_sent = 0
+        self._drain_waiters = []
 
     def construct(self):
         pass
 
+    #: Initial size of the receive buffer. It grows to fit the largest
+    #: message received, and is compacted rather than reallocated as frames
+    #: are consumed from its head.
+    input_buf_size = CHUNK_SIZE
+
+    #: Number of reads that needed no more than :py:attr:`input_buf_size`
+    #: bytes, after which a buffer grown to fit a large message is released.
+    #: A burst of large messages reuses one buffer, yet memory is not pinned
+    #: once the burst ends.
+    input_buf_release_after = 8
+
+    _input_buf = None
+    _input_start = 0
+    _input_end = 0
+    _input_small_reads = 0
+
+    def _reserve(self, want):
+        """Ensure at least `want` bytes of space follow any buffered input,
+        first by discarding consumed bytes, then by growing the buffer."""
+        buf = self._input_buf
+        if buf is None:
+            self._input_buf = buf = bytearray(max(want, self.input_buf_size))
+            return
+
+        if len(buf) - self._input_end >= want:
+            return
+
+        pending = self._input_end - self._input_start
+        if len(buf) - pending < want:
+            # Allocate the full size once, copying only the pending bytes.
+            self._input_buf = bytearray(pending + want)
+            self._input_buf[:pending] = buf[self._input_start:
+                                            self._input_end]
+        elif self._input_start:
+            buf[:pending] = buf[self._input_start:self._input_end]
+        self._input_start = 0
+        self._input_end = pending
+
+    def _prepare_input(self, want):
+        """Reset the input buffer if it is fully consumed, then ensure it has
+        space for `want` more bytes."""
+        if self._input_start == self._input_end:
+            self._input_start = self._input_end = 0
+        if want > self.input_buf_size:
+            self._input_small_reads = 0
+        elif len(self._input_buf or '') > self.input_buf_size:
+            self._input_small_reads += 1
+            if (self._input_small_reads > self.input_buf_release_after
+                    and self._input_start == self._input_end):
+                # Don't pin memory once large messages stop arriving.
+                self._input_buf = None
+        self._reserve(want)
+
     def on_receive(self, broker):
         """Handle the next complete message on the stream. Raise
         :py:class:`StreamError` on failure."""
         _vv and IOLOG.debug('%r.on_receive()', self)
-
-        buf = self.receive_side.read()
-        if not buf:
+        if self._relay_remaining:
+            return self._relay_receive(broker)
+        if self._decompressor is not None:
+            return self._receive_compressed(broker)
+
+        self._prepare_input(max(CHUNK_SIZE, self._input_wanted))
+        n = self.receive_side.readinto(self._input_buf, self._input_end)
+        if n is None:
+            return
+        if not n:
             return self.on_disconnect(broker)
 
-        if self._input_buf and self._input_buf_len < 128:
-            self._input_buf[0] += buf
-        else:
-            self._input_buf.append(buf)
-
-        self._input_buf_len += len(buf)
+        self.rx_bytes += n
+        self._input_end += n
         while self._receive_one(broker):
             pass
 
-    HEADER_FMT = '>LLLLLL'
-    HEADER_LEN = struct.calcsize(HEADER_FMT)
+    #: :py:class:`HeaderCodec` used to encode and decode frame headers.
+    header_codec = HeaderCodec()
+    HEADER_FMT = HeaderCodec.fmt
+    HEADER_LEN = header_codec.size
 
-    def _receive_one(self, broker):
-        if self._input_buf_len < self.HEADER_LEN:
-            return False
+    #: Bytes still missing from the partially received frame at the head of
+    #: the buffer, used to grow the buffer once to fit a large message.
+    _input_wanted = 0
+
+    #: Bytes of the body of a frame being relayed that are yet to be read.
+    _relay_remaining = 0
+
+    #: Maximum size of each read while relaying a frame. Since the string
+    #: returned by each read is queued without copying, a larger size means
+    #: fewer system calls and fewer, larger writes by the outgoing stream.
+    relay_read_size = 1048576
 
-        msg = Message()
-        msg.router = self._router
-        (msg.dst_id, msg.src_id, msg.auth_id,
-         msg.handle, msg.reply_to, msg_len) = struct.unpack(
-            self.HEADER_FMT,
-            self._input_buf[0][:self.HEADER_LEN],
+    def _relay_start(self, header, start, end, msg_len):
+        """
+        Begin relaying a frame that is addressed to another context and too
+        large for the input buffer. Rather than growing the buffer to fit it,
+        the frame is cut through: the part of its body already read, then
+        each subsequent read, is queued on the outgoing stream as soon as it
+        arrives, as a fragment of the message, as if it were sent by
+        :py:meth:`_send_fragments`. The last carries the frame's `reply_to`,
+        and the destination joins them. Reads are queued without copying.
+
+        A frame whose source fails verification is discarded. One that
+        cannot be forwarded, for example for lack of a route, is instead
+        stored as a list of strings, then passed to
+        :py:meth:`Router._async_route` once complete.
+        """
+        _vv and IOLOG.debug('%r._relay_start(%r, len %d)',
+                            self, header, msg_len)
+        self._relay_header = header
+        self._relay_remaining = msg_len + self.HEADER_LEN - (end - start)
+        self._relay_pieces = None
+        dst_id, src_id, auth_id, handle, reply_to = header
+        self._relay_dropped = not self._router._verify_source(
+            Message(dst_id, src_id, auth_id, handle, reply_to), self
         )
+        body = _slice_bytes(self._input_buf, start + self.HEADER_LEN, end)
+        if not (self._relay_dropped
+                or self._relay_forward(body, IS_FRAGMENT)):
+            self._relay_pieces = [_slice_bytes(self._input_buf, start, end)]
+        self._input_start = self._input_end = 0
+        self._input_wanted = 0
+
+    def _relay_forward(self, s, reply_to):
+        """Forward `s` as the next fragment of the frame being relayed."""
+        dst_id, src_id, auth_id, handle, _ = self._relay_header
+        hdr = self.header_codec.pack(dst_id, src_id, auth_id, handle,
+                                     reply_to, len(s))
+        return self._router._async_forward(self, dst_id, src_id, auth_id,
+                                           handle, [hdr, s])
+
+    def _relay_receive(self, broker):
+        s = self.receive_side.read(min(self._relay_remaining,
+                                       self.relay_read_size))
+        if not s:
+            return self.on_disconnect(broker)
+        self.rx_bytes += len(s)
+        self._relay_remaining -= len(s)
+        if self._relay_pieces is not None:
+            self._relay_pieces.append(s)
+            if not self._relay_remaining:
+                self._relay_finish()
+            return
+
+        reply_to = IS_FRAGMENT
+        if not self._relay_remaining:
+            self.rx_frames += 1
+            reply_to = self._relay_header[4]
+        if not (self._relay_dropped or self._relay_forward(s, reply_to)):
+            self._relay_lost()
 
-        if msg_len > self._router.max_message_size:
-            LOG.error('Maximum message size exceeded (got %d, max %d)',
-                      msg_len, self._router.max_message_size)
+    def _relay_lost(self):
+        """
+        Discard the remainder of a frame being cut through once it can no
+        longer be forwarded. Have the destination drop the fragments it
+        already received, should it still be reachable, and reply to the
+        frame's `reply_to` with a dead message, so neither side waits forever.
+        """
+        LOG.error('%r: route lost while relaying frame %r',
+                  self, self._relay_header)
+        self._relay_dropped = True
+        dst_id, src_id, auth_id, handle, reply_to = self._relay_header
+        if self.auth_id is not None:
+            auth_id = self.auth_id
+        self._router._async_route(Message(dst_id, src_id, auth_id, handle,
+                                          IS_DEAD, b(''), self._router))
+        if reply_to not in (0, IS_FRAGMENT, IS_DEAD):
+            self._router._async_route(Message.dead(dst_id=src_id,
+                                                   handle=reply_to))
+
+    def _relay_finish(self):
+        pieces = self._relay_pieces
+        self._relay_pieces = None
+        self.rx_frames += 1
+        dst_id, src_id, auth_id, handle, reply_to = self._relay_header
+        if not self._router._async_forward(self, dst_id, src_id, auth_id,
+                                           handle, pieces):
+            data = ''.join(pieces)[self.HEADER_LEN:]
+            self._router._async_route(Message(dst_id, src_id, auth_id, handle,
+                                              reply_to, data, self._router),
+                                      self)
+
+    def _receive_one(self, broker):
+        start = self._input_start
+        buf = self._input_buf
+        try:
+            hdr = self.header_codec.decode_from(buf, start, self._input_end,
+                                                self._router.max_message_size)
+        except StreamError:
+            LOG.error('%r: %s', self, sys.exc_info()[1])
             self.on_disconnect(broker)
             return False
 
+        if hdr is None:
+            return False
+
+        dst_id, src_id, auth_id, handle, reply_to, msg_len = hdr
+        avail = self._input_end - start
+
         total_len = msg_len + self.HEADER_LEN
-        if self._input_buf_len < total_len:
+        if avail < total_len:
+            if (dst_id != mitogen.context_id
+                    and total_len > self.input_buf_size
+                    and self._decompressor is None):
+                self._relay_start((dst_id, src_id, auth_id, handle, reply_to),
+                                  start, self._input_end, msg_len)
+                return False
             _vv and IOLOG.debug(
                 '%r: Input too short (want %d, got %d)',
-                self, msg_len, self._input_buf_len - self.HEADER_LEN
+                self, msg_len, avail - self.HEADER_LEN
             )
+            self._input_wanted = total_len - avail
             return False
 
-        start = self.HEADER_LEN
-        prev_start = start
-        remain = total_len
-        bits = []
-        while remain:
-            buf = self._input_buf.popleft()
-            bit = buf[start:remain]
-            bits.append(bit)
-            remain -= len(bit) + start
-            prev_start = start
-            start = 0
-
-        msg.data = ''.join(bits)
-        self._input_buf.appendleft(buf[prev_start+len(bit):])
-        self._input_buf_len -= total_len
+        end = start + total_len
+        self._input_start = end
+        self._input_wanted = 0
+        self.rx_frames += 1
+
+        if dst_id != mitogen.context_id:
+            # Relay the encoded frame, avoiding a copy to split off its body.
+            frame = _slice_bytes(buf, start, end)
+            if self._router._async_forward(self, dst_id, src_id, auth_id,
+                                           handle, [frame]):
+                return True
+            data = frame[self.HEADER_LEN:]
+        else:
+            data = _slice_bytes(buf, start + self.HEADER_LEN, end)
+
+        msg = Message(dst_id, src_id, auth_id, handle, reply_to, data,
+                      self._router)
         self._router._async_route(msg, self)
         return True
 
     def pending_bytes(self):
-        return self._output_buf_len
+        return self._queued_len + self._output_buf_len
+
+    #: Bytes read from and written to the stream, as they appear on the wire.
+    rx_bytes = 0
+    tx_bytes = 0
+
+    #: Frames received, and frames queued for transmission, including those
+    #: relayed on behalf of other contexts, and each fragment of a message.
+    rx_frames = 0
+    tx_frames = 0
+
+    #: Largest value :py:meth:`pending_bytes` has reached.
+    max_pending = 0
+
+    def get_stats(self):
+        """
+        Return a dict describing the stream and its counters.
+        """
+        return {
+            'name': self.name,
+            'remote_id': self.remote_id,
+            'rx_bytes': self.rx_bytes,
+            'tx_bytes': self.tx_bytes,
+            'rx_frames': self.rx_frames,
+            'tx_frames': self.tx_frames,
+            'pending': self.pending_bytes(),
+            'max_pending': self.max_pending,
+        }
+
+    #: zlib compression level used once :py:meth:`enable_compression` is
+    #: called.
+    compress_level = 6
+
+    _compressor = None
+    _decompressor = None
+
+    #: Bytes of the decompressed primer yet to be discarded.
+    _discard = 0
+
+    def enable_compression(self, prime=None):
+        """
+        Compress all bytes subsequently sent on the stream, and decompress all
+        bytes subsequently received. The remote end must enable compression at
+        the same point in the stream, which :py:class:`mitogen.parent.Stream`
+        arranges by passing `compress=True` to
+        :py:meth:`ExternalContext.main`, before any message is exchanged.
+
+        Frames are flushed with :py:data:`zlib.Z_SYNC_FLUSH` once per
+        :py:meth:`on_transmit`, so a batch of messages costs a single flush.
+
+        :param bytes prime:
+            If not :py:data:`None`, each side begins by compressing this
+            string into its output, which the receiving side discards after
+            decompression. This primes both ends with a shared history of
+            strings expected in early messages, working with zlib versions
+            lacking preset dictionaries, at the cost of the compressed primer
+            on the wire. Both ends must pass the same string.
+        """
+        self._compressor = zlib.compressobj(self.compress_level)
+        self._compressed = []
+        self._decompressor = zlib.decompressobj()
+        if prime:
+            self._compressed.append(self._compressor.compress(prime))
+            self._discard = len(prime)
+
+    def _flush_compressed(self):
+        self._compressed.append(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        s = b('').join(self._compressed)
+        self._compressed = []
+        self._output_buf.append(s)
+        self._output_buf_len += len(s)
+
+    def _receive_compressed(self, broker):
+        s = self.receive_side.read()
+        if not s:
+            return self.on_disconnect(broker)
+
+        self.rx_bytes += len(s)
+        # Decompress a bounded amount at a time, consuming frames as they
+        # complete, so input cannot inflate without limit. Output filling the
+        # limit may leave more pending in the decompressor even once all
+        # input is consumed, so continue until it returns less.
+        max_length = self.input_buf_size
+        while self.receive_side.fd is not None:
+            data = self._decompressor.decompress(s, max_length)
+            s = self._decompressor.unconsumed_tail
+            more = s or len(data) == max_length
+            if self._discard:
+                n = min(self._discard, len(data))
+                data = data[n:]
+                self._discard -= n
+
+            self._prepare_input(len(data))
+            end = self._input_end + len(data)
+            self._input_buf[self._input_end:end] = data
+            self._input_end = end
+            while self._receive_one(broker):
+                pass
+            if not more:
+                break
+
+    #: Once more than this many bytes are queued for transmission, the stream
+    #: is :py:attr:`congested`, and senders using backpressure wait.
+    high_watermark = 1048576
+
+    #: Once congested, the stream fires ``drain`` and releases waiting senders
+    #: after the queue shrinks to this many bytes.
+    low_watermark = 262144
+
+    #: :py:data:`True` while the output queue has exceeded
+    #: :py:attr:`high_watermark` and has yet to fall to
+    #: :py:attr:`low_watermark`.
+    congested = False
+
+    def call_when_drained(self, func):
+        """
+        Arrange for `func()` to be called once the stream is not
+        :py:attr:`congested`, or immediately if it already is not. Must be
+        called on the broker thread. Functions are also called if the stream
+        disconnects.
+        """
+        if self.congested:
+            self._drain_waiters.append(func)
+        else:
+            func()
+
+    def _on_drain(self):
+        self.congested = False
+        waiters = self._drain_waiters
+        self._drain_waiters = []
+        for func in waiters:
+            func()
+
+    #: Upper bound on the number of bytes :py:meth:`on_transmit` attempts to
+    #: write in a single system call. Queued messages are coalesced up to this
+    #: size, so bursts of small messages need few wakeups to flush.
+    max_write_size = CHUNK_SIZE
+
+    #: Offset of the first unwritten byte in the head of the output queue.
+    _output_offset = 0
+
+    def _gather(self):
+        """Return a list of buffers from the head of the output queue, whose
+        total size does not exceed :py:attr:`max_write_size` unless it
+        consists of a single large buffer."""
+        size = -self._output_offset
+        pieces = []
+        for buf in self._output_buf:
+            size += len(buf)
+            if pieces and (size > self.max_write_size
+                           or len(pieces) == IOV_MAX):
+                break
+            pieces.append(buf)
+        return pieces
+
+    def _write(self, pieces):
+        offset = self._output_offset
+        if len(pieces) > 1 and not hasattr(os, 'writev'):
+            # Only small buffers are gathered together, so copying them is
+            # cheap compared to a system call per buffer.
+            pieces[0] = pieces[0][offset:]
+            return self.transmit_side.write(b('').join(map(bytes, pieces)))
+
+        if offset:
+            pieces[0] = _view(pieces[0], offset)
+        if len(pieces) == 1:
+            return self.transmit_side.write(pieces[0])
+        return self.transmit_side.writev(pieces)
 
     def on_transmit(self, broker):
         """Transmit buffered messages."""
         _vv and IOLOG.debug('%r.on_transmit()', self)
+        if self._queued_len and self._output_buf_len < self.max_write_size:
+            self._schedule()
 
         if self._output_buf:
-            buf = self._output_buf.popleft()
-            written = self.transmit_side.write(buf)
+            written = self._write(self._gather())
             if not written:
                 _v and LOG.debug('%r.on_transmit(): disconnection detected', self)
                 self.on_disconnect(broker)
                 return
-            elif written != len(buf):
-                self._output_buf.appendleft(buffer(buf, written))
 
             _vv and IOLOG.debug('%r.on_transmit() -> len %d', self, written)
+            self.tx_bytes += written
             self._output_buf_len -= written
-
-        if not self._output_buf:
+            written += self._output_offset
+            while self._output_buf and written >= len(self._output_buf[0]):
+                written -= len(self._output_buf.popleft())
+            self._output_offset = written
+            if self.congested and self.pending_bytes() <= self.low_watermark:
+                _v and LOG.debug('%r.on_transmit(): drained', self)
+                self._on_drain()
+                fire(self, 'drain')
+
+        if not (self._output_buf or self._queued_len):
             broker._stop_transmit(self)
 
+    def on_flush(self, broker):
+        """
+        Transmit output queued while none was pending, before the broker next
+        waits for IO. Since the stream was idle, the write very likely
+        succeeds without waiting for writeability, saving a loop iteration
+        and two interest changes per message. Only output that remains is
+        left to :py:meth:`on_transmit`.
+        """
+        try:
+            self.on_transmit(broker)
+        except OSError:
+            if sys.exc_info()[1].args[0] != errno.EAGAIN:
+                raise
+        if self.pending_bytes() and self.transmit_side.fd is not None:
+            broker._start_transmit(self)
+
+    #: Handles whose messages are queued in the priority lane when
+    #: :py:attr:`priority_lanes` is enabled, so they are not delayed behind
+    #: bulk transfers queued earlier. These are small requests needed to make
+    #: progress: calls, module loading, logging and route setup.
+    #: :py:data:`SHUTDOWN` and :py:data:`DEL_ROUTE` are absent, as they must
+    #: not overtake messages already queued before them.
+    priority_handles = frozenset([
+        CALL_FUNCTION, GET_MODULE, LOAD_MODULE, LOAD_MODULES, CACHED_MODULES,
+        CODE_MAGIC, FORWARD_LOG, ADD_ROUTE, ALLOCATE_ID,
+    ])
+
+    #: Bytes each output lane may send per turn of deficit round robin
+    #: scheduling while others have frames queued: the first is the priority
+    #: lane, the second the lane for every other message. Their ratio sets
+    #: the share of bandwidth each receives while both are busy. Frames are
+    #: never split, and frames in one lane are sent in the order they were
+    #: queued. Since the lane depends only on the handle, messages to a
+    #: handle are always delivered in order. A frame in the second lane is
+    #: never sent before a priority frame queued earlier, so for example
+    #: :py:data:`ADD_ROUTE` always arrives before messages it announces.
+    lane_quantum = (4 * CHUNK_SIZE, CHUNK_SIZE)
+
+    #: Lane whose turn it is. Initially the last, so the priority lane is
+    #: granted its quantum when it is first used.
+    _lane = -1
+
+    def _schedule(self):
+        """
+        Move frames from the output lanes to the output buffer until it holds
+        around :py:attr:`max_write_size` bytes, compressing them if enabled.
+        Frames are only scheduled once the output buffer is nearly empty, so
+        frames queued later in the priority lane overtake those waiting in
+        others. The priority lane preempts the turn of another, which keeps
+        its unspent deficit, so its share of bandwidth is unchanged.
+        """
+        lanes = self._lanes
+        deficit = self._deficit
+        sent = self._priority_sent
+        i = self._lane
+        if i and lanes[0]:
+            i = 0
+            deficit[0] += self.lane_quantum[0]
+        budget = self.max_write_size - self._output_buf_len
+        queued = self._queued_len
+        if self._compressor is None:
+            out = self._output_buf
+        else:
+            out = []
+
+        while queued and budget > 0:
+            lane = lanes[i]
+            d = deficit[i]
+            while lane and budget > 0 and lane[0][0] <= d and \
+                    lane[0][2] <= sent:
+                size, pieces, barrier = lane.popleft()
+                if not i:
+                    sent += 1
+                d -= size
+                budget -= size
+                queued -= size
+                out.extend(pieces)
+            deficit[i] = d
+            if budget <= 0:
+                break
+
+            if not lane:
+                deficit[i] = 0
+            i = (i + 1) % len(lanes)
+            if lanes[i]:
+                deficit[i] += self.lane_quantum[i]
+
+        self._lane = i
+        self._priority_sent = sent
+        if self._compressor is None:
+            self._output_buf_len += self._queued_len - queued
+        else:
+            compress = self._compressor.compress
+            self._compressed.extend([compress(s) for s in out])
+            self._flush_compressed()
+        self._queued_len = queued
+
+    #: Messages larger than this are sent as a run of frames of at most this
+    #: size, so no context on their path, nor the receiver when it consumes
+    #: them as a stream, must buffer more than this at once.
+    fragment_size = 1048576
+
     def _send(self, msg):
         _vv and IOLOG.debug('%r._send(%r)', self, msg)
-        pkt = struct.pack(self.HEADER_FMT, msg.dst_id, msg.src_id,
-                          msg.auth_id, msg.handle, msg.reply_to or 0,
-                          len(msg.data)) + msg.data
-        if not self._output_buf_len:
-            self._router.broker._start_transmit(self)
-        self._output_buf.append(pkt)
-        self._output_buf_len += len(pkt)
+        if len(msg.data) > self.fragment_size:
+            return self._send_fragments(msg)
+        self._enqueue((self.header_codec.encode(msg), msg.data), msg.handle)
+
+    def _send_fragments(self, msg):
+        """
+        Queue a large message as frames of :py:attr:`fragment_size`, each but
+        the last having :py:data:`IS_FRAGMENT` in place of `reply_to`. They
+        are queued together in one lane, so they are never interleaved with
+        other messages from this context to the same handle, while messages
+        in the priority lane may be sent between them. Fragments are views of
+        the message's data rather than copies of it.
+        """
+        encode = self.header_codec.encode
+        data = msg.data
+        size = self.fragment_size
+        for start in xrange(0, len(data), size):
+            s = _view(data, start, start + size)
+            if start + size < len(data):
+                reply_to = IS_FRAGMENT
+            else:
+                reply_to = msg.reply_to or 0
+            self._enqueue((encode(msg, reply_to, len(s)), s), msg.handle)
+
+    def _enqueue(self, pieces, handle):
+        """
+        Queue the frame formed by concatenating the strings `pieces` for
+        transmission, in the lane for messages to `handle`. Must be called on
+        the broker thread.
+        """
+        pending = self._queued_len + self._output_buf_len
+        if not pending:
+            self._router.broker._flush_soon(self)
+        size = 0
+        for s in pieces:
+            size += len(s)
+        if not (self.priority_lanes or self._queued_len
+                or self._compressor):
+            # One lane holding nothing has no need of scheduling.
+            self._output_buf.extend(pieces)
+            self._output_buf_len += size
+        elif self.priority_lanes and handle in self.priority_handles:
+            self._priority_queued += 1
+            self._lanes[0].append((size, pieces, 0))
+            self._queued_len += size
+        else:
+            self._lanes[-1].append((size, pieces, self._priority_queued))
+            self._queued_len += size
+        self.tx_frames += 1
+        if pending + size > self.max_pending:
+            self.max_pending = pending + size
+        if pending + size > self.high_watermark and not self.congested:
+            _v and LOG.debug('%r._enqueue(): congested', self)
+            self.congested = True
 
     def send(self, msg):
         """Send `data` to `handle`, and tell the broker we have output. May
         be called from any thread."""
         self._router.broker.defer(self._send, msg)
 
+    def send_many(self, msgs):
+        """Like :py:meth:`send`, but queue a sequence of messages using a
+        single wake up of the broker. May be called from any thread."""
+        self._router.broker.defer_many([(self._send, (msg,), {})
+                                        for msg in msgs])
+
     def on_shutdown(self, broker):
         """Override BasicStream behaviour of immediately disconnecting."""
         _v and LOG.debug('%r.on_shutdown(%r)', self, broker)
 
+    def on_disconnect(self, broker):
+        super(Stream, self).on_disconnect(broker)
+        if self._relay_remaining:
+            LOG.error('%r: disconnected while relaying %d byte frame %r',
+                      self, self._relay_remaining, self._relay_header)
+            if self._relay_pieces is None and not self._relay_dropped:
+                # Have the destination discard the fragments it received.
+                self._relay_forward(b(''), IS_DEAD)
+            self._relay_remaining = 0
+            self._relay_pieces = None
+        # Senders waiting for the queue to drain would otherwise hang.
+        self._on_drain()
+
     def accept(self, rfd, wfd):
         # TODO: what is this os.dup for?
         self.receive_side = Side(self, os.dup(rfd))
@@ -940,9 +1720,16 @@ class Context(object):
         msg.dst_id = self.context_id
         self.router.route(msg)
 
+    def send_many(self, msgs):
+        """Like :py:meth:`send`, but route a sequence of messages using a
+        single wake up of the broker. May be called from any thread."""
+        for msg in msgs:
+            msg.dst_id = self.context_id
+        self.router.route_many(msgs)
+
     def send_async(self, msg, persist=False):
         if self.router.broker._thread == threading.currentThread():  # TODO
-            raise SystemError('Cannot making blocking call on broker thread')
+            raise SystemError('Cannot make blocking call on broker thread')
 
         receiver = Receiver(self.router, persist=persist, respondent=self)
         msg.reply_to = receiver.handle
@@ -973,117 +1760,284 @@ def _unpickle_context(router, context_id, name):
     return router.context_class(router, context_id, name)
 
 
+class Waiter(object):
+    """
+    Base for strategies used by :py:class:`Latch` to put a thread to sleep
+    until another thread wakes it. Instances are pooled between sleeps by
+    subclass, and the pools are discarded in forked children.
+    """
+    _pool = None
+
+    @classmethod
+    def allocate(cls):
+        """Return a waiter from the pool, or a new one if it is empty."""
+        try:
+            return cls._pool.pop()
+        except IndexError:
+            return cls()
+
+    @classmethod
+    def for_wait(cls, timeout):
+        """Return a waiter able to sleep for `timeout` on the calling
+        thread."""
+        return cls.allocate()
+
+    def free(self):
+        """Return a waiter with no pending wakeup to the pool."""
+        self._pool.append(self)
+
+    @classmethod
+    def _on_fork(cls):
+        while cls._pool:
+            cls._pool.pop().close()
+
+    def close(self):
+        pass
+
+    def wait(self, timeout):
+        """Sleep until :py:meth:`wake` is called or `timeout` expires."""
+        raise NotImplementedError()
+
+    def wake(self):
+        raise NotImplementedError()
+
+    def consume(self):
+        """Consume a wakeup known to have been sent, returning ``False`` if
+        it is missing or was sent more than once."""
+        raise NotImplementedError()
+
+
+class SocketWaiter(Waiter):
+    """
+    Default :py:class:`Waiter`. Each sleeping thread waits in
+    :py:func:`select.select` on one end of a socketpair, and is woken by a byte
+    written to the other.
+
+    Unlike a blocking lock acquisition on Python 2, the sleep remains
+    interruptible by signals. Since the pool is discarded in forked children,
+    a child never shares a wakeup channel with its parent.
+    """
+    _pool = []
+
+    def __init__(self):
+        self.rsock, self.wsock = socket.socketpair()
+        set_cloexec(self.rsock.fileno())
+        set_cloexec(self.wsock.fileno())
+
+    def __repr__(self):
+        return 'SocketWaiter(wfd=%r)' % (self.wsock.fileno(),)
+
+    def close(self):
+        self.rsock.close()
+        self.wsock.close()
+
+    def wait(self, timeout):
+        io_op(select.select, [self.rsock], [], [], timeout)
+
+    def wake(self):
+        try:
+            os.write(self.wsock.fileno(), b('\x7f'))
+        except OSError:
+            e = sys.exc_info()[1]
+            if e[0] != errno.EBADF:
+                raise
+
+    def consume(self):
+        return self.rsock.recv(2) == b('\x7f')
+
+
+class LockWaiter(Waiter):
+    """
+    Alternative :py:class:`Waiter` that hands a wakeup over using a
+    :py:class:`threading.Lock` held while the thread sleeps, and released by
+    the thread waking it. No file descriptors are consumed, and sleeping or
+    waking costs at most one futex call on Linux.
+
+    Python 2 cannot interrupt a blocking lock acquisition, nor acquire with a
+    timeout. Since signals are only delivered to the main thread, the main
+    thread and waits with a timeout use a :py:class:`SocketWaiter` instead.
+    """
+    _pool = []
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lock.acquire()
+
+    def __repr__(self):
+        return 'LockWaiter(%#x)' % (id(self),)
+
+    @classmethod
+    def for_wait(cls, timeout):
+        if not PY3 and (timeout is not None
+                        or isinstance(threading.currentThread(),
+                                      threading._MainThread)):
+            return SocketWaiter.allocate()
+        return cls.allocate()
+
+    def wait(self, timeout):
+        if PY3:
+            got = self._lock.acquire(True, -1 if timeout is None else timeout)
+        else:
+            got = self._lock.acquire()
+        if got:
+            # Leave the wakeup for consume().
+            self._lock.release()
+
+    def wake(self):
+        self._lock.release()
+
+    def consume(self):
+        return self._lock.acquire(False)
+
+
 class Latch(object):
+    """
+    A queue that may be waited on from any thread. Items put while threads
+    sleep in :py:meth:`get` are handed directly to the longest sleeping
+    thread, so items remaining in the queue are never reserved, and while no
+    thread sleeps, :py:meth:`get` and :py:meth:`put` need not take the lock.
+    """
     closed = False
     _waking = 0
-    _sockets = []
+
+    #: :py:class:`Waiter` subclass implementing the sleep and wakeup of threads
+    #: blocked in :py:meth:`get`, either :py:class:`SocketWaiter` or
+    #: :py:class:`LockWaiter`. May be changed at runtime, on the class or on
+    #: individual instances.
+    waiter_class = SocketWaiter
+
+    #: Counters for profiling: items put, items returned by :py:meth:`get`,
+    #: calls to :py:meth:`get` that slept, and sleeping threads woken by
+    #: :py:meth:`put` or :py:meth:`close`. Updates are not synchronized, so
+    #: counts may be approximate when many threads use the latch at once.
+    puts = 0
+    gets = 0
+    sleeps = 0
+    wakeups = 0
 
     def __init__(self):
         self._lock = threading.Lock()
-        self._queue = []
+        self._queue = collections.deque()
+        # [waiter, item] for each sleeping thread, in the order they slept.
+        # The first _waking entries have been woken.
         self._sleeping = []
 
     @classmethod
     def _on_fork(cls):
-        while cls._sockets:
-            rsock, wsock = cls._sockets.pop()
-            rsock.close()
-            wsock.close()
+        for waiter_class in SocketWaiter, LockWaiter:
+            waiter_class._on_fork()
 
     def close(self):
         self._lock.acquire()
         try:
             self.closed = True
             while self._waking < len(self._sleeping):
-                self._wake(self._sleeping[self._waking])
+                self._sleeping[self._waking][0].wake()
                 self._waking += 1
+                self.wakeups += 1
         finally:
             self._lock.release()
 
     def empty(self):
         return len(self._queue) == 0
 
-    def _tls_init(self):
-        if self._sockets:
-            return self._sockets.pop()
-        rsock, wsock = socket.socketpair()
-        set_cloexec(rsock.fileno())
-        set_cloexec(wsock.fileno())
-        return rsock, wsock
+    def _wake_sleepers(self):
+        """Hand queued items to sleeping threads, oldest first. Must be
+        called with _lock held."""
+        while self._queue and self._waking < len(self._sleeping):
+            entry = self._sleeping[self._waking]
+            entry[1] = self._queue.popleft()
+            self._waking += 1
+            self.wakeups += 1
+            _vv and IOLOG.debug('%r.put() -> waking %r', self, entry[0])
+            entry[0].wake()
 
     def get(self, timeout=None, block=True):
         _vv and IOLOG.debug('%r.get(timeout=%r, block=%r)',
                             self, timeout, block)
+        if self.closed:
+            raise LatchError()
+        if not self._sleeping:
+            try:
+                obj = self._queue.popleft()
+                self.gets += 1
+                _vv and IOLOG.debug('%r.get() -> %r', self, obj)
+                return obj
+            except IndexError:
+                pass
 
         self._lock.acquire()
         try:
             if self.closed:
                 raise LatchError()
-            i = len(self._sleeping)
-            if len(self._queue) > i:
-                _vv and IOLOG.debug('%r.get() -> %r', self, self._queue[i])
-                return self._queue.pop(i)
+            self._wake_sleepers()
+            if self._queue:
+                obj = self._queue.popleft()
+                self.gets += 1
+                _vv and IOLOG.debug('%r.get() -> %r', self, obj)
+                return obj
             if not block:
                 raise TimeoutError()
-            rsock, wsock = self._tls_init()
-            self._sleeping.append(wsock)
+            entry = [self.waiter_class.for_wait(timeout), None]
+            self._sleeping.append(entry)
+            self.sleeps += 1
+            # A put() that saw no sleepers may have queued an item since the
+            # check above.
+            self._wake_sleepers()
         finally:
             self._lock.release()
 
-        return self._get_sleep(timeout, block, rsock, wsock)
+        return self._get_sleep(timeout, block, entry)
 
-    def _get_sleep(self, timeout, block, rsock, wsock):
+    def _get_sleep(self, timeout, block, entry):
         _vv and IOLOG.debug('%r._get_sleep(timeout=%r, block=%r)',
                             self, timeout, block)
+        waiter = entry[0]
         e = None
         try:
-            io_op(select.select, [rsock], [], [], timeout)
+            waiter.wait(timeout)
         except Exception:
             e = sys.exc_info()[1]
 
         self._lock.acquire()
         try:
-            i = self._sleeping.index(wsock)
+            i = self._sleeping.index(entry)
             del self._sleeping[i]
-            self._sockets.append((rsock, wsock))
             if i >= self._waking:
+                waiter.free()
                 raise TimeoutError()
             self._waking -= 1
-            if rsock.recv(2) != '\x7f':
+            if not waiter.consume():
                 raise LatchError('internal error: received >1 wakeups')
-            if e:
-                raise e
+            waiter.free()
             if self.closed:
                 raise LatchError()
-            _vv and IOLOG.debug('%r.get() wake -> %r', self, self._queue[i])
-            return self._queue.pop(i)
+            if e:
+                # Give the item to the next sleeper, if any.
+                self._queue.appendleft(entry[1])
+                self._wake_sleepers()
+                raise e
+            self.gets += 1
+            _vv and IOLOG.debug('%r.get() wake -> %r', self, entry[1])
+            return entry[1]
         finally:
             self._lock.release()
 
     def put(self, obj):
         _vv and IOLOG.debug('%r.put(%r)', self, obj)
-        self._lock.acquire()
-        try:
-            if self.closed:
-                raise LatchError()
-            self._queue.append(obj)
-
-            if self._waking < len(self._sleeping):
-                sock = self._sleeping[self._waking]
-                self._waking += 1
-                _vv and IOLOG.debug('%r.put() -> waking wfd=%r',
-                                    self, sock.fileno())
-                self._wake(sock)
-        finally:
-            self._lock.release()
-
-    def _wake(self, sock):
-        try:
-            os.write(sock.fileno(), '\x7f')
-        except OSError:
-            e = sys.exc_info()[1]
-            if e[0] != errno.EBADF:
-                raise
+        if self.closed:
+            raise LatchError()
+        self._queue.append(obj)
+        self.puts += 1
+        # get() registers as a sleeper before checking the queue, while we
+        # check for sleepers after queueing, so at least one of us notices
+        # the other.
+        if self._sleeping:
+            self._lock.acquire()
+            try:
+                self._wake_sleepers()
+            finally:
+                self._lock.release()
 
     def __repr__(self):
         return 'Latch(%#x, size=%d, t=%r)' % (
@@ -1099,18 +2053,41 @@ class Waker(BasicStream):
     Used to wake the multiplexer when another thread needs to modify its state
     (via a cross-thread function call).
 
+    A wakeup is only written when the queue of deferred calls transitions from
+    empty to non-empty, so a burst of calls from other threads costs one
+    system call, and one wakeup of the broker. Where :py:func:`os.eventfd`
+    exists (Linux, Python 3.10+), it replaces the pipe, saving a descriptor.
+
     .. _UNIX self-pipe trick: https://cr.yp.to/docs/selfpipe.html
     """
     broker_ident = None
 
+    #: Count of functions run by :py:meth:`on_receive`.
+    deferred_calls = 0
+
+    #: Total and maximum seconds between a wakeup being requested and the
+    #: deferred functions it announced starting to run.
+    defer_latency = 0.0
+    defer_latency_max = 0.0
+
+    #: Time the queue of deferred calls last became non-empty, if the
+    #: broker's :py:attr:`Broker.stats_interval` was set at that moment.
+    _deferred_since = None
+
     def __init__(self, broker):
         self._broker = broker
         self._lock = threading.Lock()
         self._deferred = []
 
-        rfd, wfd = os.pipe()
-        self.receive_side = Side(self, rfd)
-        self.transmit_side = Side(self, wfd)
+        if hasattr(os, 'eventfd'):
+            self.receive_side = Side(self, os.eventfd(0))
+            self.transmit_side = self.receive_side
+            self._wake_data = struct.pack('=Q', 1)
+        else:
+            rfd, wfd = os.pipe()
+            self.receive_side = Side(self, rfd)
+            self.transmit_side = Side(self, wfd)
+            self._wake_data = b(' ')
 
     def __repr__(self):
         return 'Waker(%r rfd=%r, wfd=%r)' % (
@@ -1132,12 +2109,10 @@ class Waker(BasicStream):
 
     def on_receive(self, broker):
         """
-        Drain the pipe and fire callbacks. Reading multiple bytes is safe since
-        new bytes corresponding to future .defer() calls are written only after
-        .defer() takes _lock: either a byte we read corresponds to something
-        already on the queue by the time we take _lock, or a byte remains
-        buffered, causing another wake up, because it was written after we
-        released _lock.
+        Drain the pipe and fire callbacks. Since :py:meth:`defer` only writes
+        when it finds the queue empty, and writes after releasing _lock, every
+        call queued before we take _lock is either collected by us, or was
+        preceded by a write that has yet to happen, causing another wake up.
         """
         _vv and IOLOG.debug('%r.on_receive()', self)
         self.receive_side.read(128)
@@ -1145,9 +2120,18 @@ class Waker(BasicStream):
         try:
             deferred = self._deferred
             self._deferred = []
+            since = self._deferred_since
+            self._deferred_since = None
         finally:
             self._lock.release()
 
+        self.deferred_calls += len(deferred)
+        if since is not None:
+            latency = now() - since
+            self.defer_latency += latency
+            if latency > self.defer_latency_max:
+                self.defer_latency_max = latency
+
         for func, args, kwargs in deferred:
             try:
                 func(*args, **kwargs)
@@ -1156,6 +2140,19 @@ class Waker(BasicStream):
                               func, args, kwargs)
                 self._broker.shutdown()
 
+    def _wake(self):
+        """
+        Wake the multiplexer by writing a byte. If the broker is in the midst
+        of tearing itself down, the waker fd may already have been closed, so
+        ignore EBADF here.
+        """
+        try:
+            self.transmit_side.write(self._wake_data)
+        except OSError:
+            e = sys.exc_info()[1]
+            if e[0] != errno.EBADF:
+                raise
+
     def defer(self, func, *args, **kwargs):
         if threading.currentThread().ident == self.broker_ident:
             _vv and IOLOG.debug('%r.defer() [immediate]', self)
@@ -1164,19 +2161,42 @@ class Waker(BasicStream):
         _vv and IOLOG.debug('%r.defer() [fd=%r]', self, self.transmit_side.fd)
         self._lock.acquire()
         try:
+            empty = not self._deferred
             self._deferred.append((func, args, kwargs))
+            if empty and self._broker.stats_interval is not None:
+                self._deferred_since = now()
         finally:
             self._lock.release()
 
-        # Wake the multiplexer by writing a byte. If the broker is in the midst
-        # of tearing itself down, the waker fd may already have been closed, so
-        # ignore EBADF here.
+        if empty:
+            self._wake()
+
+    def defer_many(self, calls):
+        """
+        Like :py:meth:`defer`, but arrange for each `(func, args, kwargs)`
+        tuple in the sequence `calls` to be run in order, using at most one
+        wake up.
+        """
+        if threading.currentThread().ident == self.broker_ident:
+            _vv and IOLOG.debug('%r.defer_many() [immediate]', self)
+            for func, args, kwargs in calls:
+                func(*args, **kwargs)
+            return
+
+        _vv and IOLOG.debug('%r.defer_many() [fd=%r]', self,
+                            self.transmit_side.fd)
+        self._lock.acquire()
         try:
-            self.transmit_side.write(b(' '))
-        except OSError:
-            e = sys.exc_info()[1]
-            if e[0] != errno.EBADF:
-                raise
+            empty = not self._deferred
+            self._deferred.extend(calls)
+            empty = empty and bool(self._deferred)
+            if empty and self._broker.stats_interval is not None:
+                self._deferred_since = now()
+        finally:
+            self._lock.release()
+
+        if empty:
+            self._wake()
 
 
 class IoLogger(BasicStream):
@@ -1238,11 +2258,23 @@ class Router(object):
 
         #: context ID -> Stream
         self._stream_by_id = {}
+        #: Stream for context IDs missing from :py:attr:`_stream_by_id`.
+        self._parent_stream = None
+        #: (auth_id, src_id) -> Stream such messages were verified to arrive
+        #: on. Caches the result of source verification in
+        #: :py:meth:`_async_route`.
+        self._stream_by_ids = {}
         #: List of contexts to notify of shutdown.
         self._context_by_id = {}
         self._last_handle = itertools.count(1000)
         #: handle -> (persistent?, func(msg))
         self._handle_map = {}
+        #: Handles whose functions receive each fragment of a large message.
+        self._fragment_handles = set()
+        #: (src_id, handle) -> (stream, size, [data, ..]) of fragments
+        #: received so far on `stream`, or size and list are :py:data:`None`
+        #: if the message was too large.
+        self._fragments = {}
 
     def __repr__(self):
         return 'Router(%r)' % (self.broker,)
@@ -1252,6 +2284,7 @@ class Router(object):
             stream_ = self._stream_by_id.get(context.context_id)
             if stream_ is stream:
                 del self._stream_by_id[context.context_id]
+                self._on_routes_changed()
                 context.on_disconnect()
 
     def _on_broker_exit(self):
@@ -1259,15 +2292,34 @@ class Router(object):
             _, (_, func, _) = self._handle_map.popitem()
             func(Message.dead())
 
+    #: Upper bound on the size of the source verification cache, since its
+    #: keys are taken from message headers.
+    max_verified_ids = 4096
+
+    def _on_routes_changed(self):
+        """
+        Refresh state derived from :py:attr:`_stream_by_id`. Must be called
+        whenever it is modified.
+        """
+        self._parent_stream = self._stream_by_id.get(mitogen.parent_id)
+        self._stream_by_ids.clear()
+        for key, (stream, _, _) in list(self._fragments.items()):
+            if self._stream_by_id.get(key[0], self._parent_stream) != stream:
+                LOG.error('%r: route to context %d lost while receiving a '
+                          'fragmented message for handle %d', self, key[0],
+                          key[1])
+                del self._fragments[key]
+
     def register(self, context, stream):
         _v and LOG.debug('register(%r, %r)', context, stream)
         self._stream_by_id[context.context_id] = stream
+        self._on_routes_changed()
         self._context_by_id[context.context_id] = context
         self.broker.start_receive(stream)
         listen(stream, 'disconnect', lambda: self.on_stream_disconnect(stream))
 
     def add_handler(self, fn, handle=None, persist=True,
-                    policy=None, respondent=None):
+                    policy=None, respondent=None, fragments=False):
         handle = handle or self._last_handle.next()
         _vv and IOLOG.debug('%r.add_handler(%r, %r, %r)', self, fn, handle, persist)
 
@@ -1282,6 +2334,8 @@ class Router(object):
             listen(respondent, 'disconnect', on_disconnect)
 
         self._handle_map[handle] = persist, fn, policy
+        if fragments:
+            self._fragment_handles.add(handle)
         return handle
 
     def on_shutdown(self, broker):
@@ -1301,13 +2355,13 @@ class Router(object):
             persist, fn, policy = self._handle_map[msg.handle]
         except KeyError:
             LOG.error('%r: invalid handle: %r', self, msg)
-            if msg.reply_to and not msg.is_dead:
+            if msg.reply_to and not (msg.is_dead or msg.is_fragment):
                 msg.reply(Message.dead())
             return
 
         if policy and not policy(msg, stream):
             LOG.error('%r: policy refused message: %r', self, msg)
-            if msg.reply_to:
+            if msg.reply_to and not msg.is_fragment:
                 self.route(Message.pickled(
                     CallError(self.refused_msg),
                     dst_id=msg.src_id,
@@ -1315,71 +2369,361 @@ class Router(object):
                 ))
             return
 
-        if not persist:
+        if not (persist or msg.is_fragment):
             del self._handle_map[msg.handle]
+            self._fragment_handles.discard(msg.handle)
 
         try:
             fn(msg)
         except Exception:
             LOG.exception('%r._invoke(%r): %r crashed', self, msg, fn)
 
-    def _async_route(self, msg, stream=None):
-        _vv and IOLOG.debug('%r._async_route(%r, %r)', self, msg, stream)
-        if len(msg.data) > self.max_message_size:
-            LOG.error('message too large (max %d bytes): %r',
-                      self.max_message_size, msg)
-            return
+    def _verify_source(self, msg, stream):
+        """
+        Return :py:data:`True` if `msg` could legitimately have arrived on
+        `stream`, recording the verdict for :py:meth:`_async_forward`.
+        """
+        key = msg.auth_id, msg.src_id
+        if self._stream_by_ids.get(key) is stream:
+            return True
+
+        parent = self._parent_stream
+        expect = self._stream_by_id.get(msg.auth_id, parent)
+        if stream != expect:
+            LOG.error('%r: bad auth_id: got %r via %r, not %r: %r',
+                      self, msg.auth_id, stream, expect, msg)
+            return False
 
-        # Perform source verification.
-        if stream:
-            parent = self._stream_by_id.get(mitogen.parent_id)
-            expect = self._stream_by_id.get(msg.auth_id, parent)
+        if msg.src_id != msg.auth_id:
+            expect = self._stream_by_id.get(msg.src_id, parent)
             if stream != expect:
-                LOG.error('%r: bad auth_id: got %r via %r, not %r: %r',
-                          self, msg.auth_id, stream, expect, msg)
-                return
+                LOG.error('%r: bad src_id: got %r via %r, not %r: %r',
+                          self, msg.src_id, stream, expect, msg)
+                return False
 
-            if msg.src_id != msg.auth_id:
-                expect = self._stream_by_id.get(msg.src_id, parent)
-                if stream != expect:
-                    LOG.error('%r: bad src_id: got %r via %r, not %r: %r',
-                              self, msg.src_id, stream, expect, msg)
-                    return
+        if len(self._stream_by_ids) >= self.max_verified_ids:
+            self._stream_by_ids.clear()
+        self._stream_by_ids[key] = stream
+        return True
+
+    def _async_forward(self, in_stream, dst_id, src_id, auth_id, handle,
+                       pieces):
+        """
+        Fast path of :py:meth:`_async_route` for a frame received on
+        `in_stream` that is addressed to another context: if its source was
+        previously verified and a route exists, queue the encoded frame on the
+        outgoing stream without constructing a :py:class:`Message`. The
+        header is only rewritten if `in_stream` restamps `auth_id`.
+
+        :param list pieces:
+            Strings that concatenate to form the frame, the first beginning
+            with its header.
+        :returns:
+            :py:data:`True` if the frame was forwarded, otherwise
+            :py:data:`False` and the caller must use :py:meth:`_async_route`.
+        """
+        if self._stream_by_ids.get((auth_id, src_id)) is not in_stream:
+            return False
+
+        stream = self._stream_by_id.get(dst_id, self._parent_stream)
+        if stream is None:
+            return False
+
+        _vv and IOLOG.debug('%r._async_forward(%r, %r -> %r)',
+                            self, in_stream, src_id, dst_id)
+        if in_stream.auth_id not in (None, auth_id):
+            # Rewrite only the header, queueing the body as a view of the
+            # received frame rather than copying it again.
+            codec = in_stream.header_codec
+            frame = pieces[0]
+            header = frame[:codec.size]
+            pieces[0:1] = [codec.restamp(header, in_stream.auth_id)]
+            if len(frame) > codec.size:
+                pieces.insert(1, _view(frame, codec.size))
+        stream._enqueue(pieces, handle)
+        return True
 
+    def _reassemble(self, msg, stream):
+        """
+        Accumulate fragments sent by :py:meth:`Stream._send_fragments`,
+        returning :py:data:`None` until the final one arrives, then the
+        complete message. Fragments for handles registered with
+        `fragments=True` are returned as they are, for the handler to consume
+        as a stream.
+        """
+        if msg.handle in self._fragment_handles:
+            return msg
+
+        key = msg.src_id, msg.handle
+        _, size, pieces = self._fragments.pop(key, (None, 0, []))
+        if msg.is_dead:
+            # A relay lost the remainder, or the sender closed the channel.
+            return msg
+        if size is not None:
+            size += len(msg.data)
+            if size > self.max_message_size:
+                LOG.error('%r: message too large (max %d bytes): %r',
+                          self, self.max_message_size, msg)
+                size = pieces = None
+            else:
+                pieces.append(msg.data)
+
+        if msg.is_fragment:
+            self._fragments[key] = stream, size, pieces
+            return None
+        if pieces is None:
+            if msg.reply_to and not msg.is_dead:
+                msg.reply(Message.dead(), router=self)
+            return None
+        if len(pieces) > 1:
+            msg.data = b('').join(pieces)
+        return msg
+
+    def _async_route(self, msg, stream=None):
+        _vv and IOLOG.debug('%r._async_route(%r, %r)', self, msg, stream)
+        if stream:
+            # Length was already checked by Stream._receive_one().
+            if not self._verify_source(msg, stream):
+                return
             if stream.auth_id is not None:
                 msg.auth_id = stream.auth_id
+        elif len(msg.data) > self.max_message_size:
+            LOG.error('message too large (max %d bytes): %r',
+                      self.max_message_size, msg)
+            return
 
         if msg.dst_id == mitogen.context_id:
-            return self._invoke(msg, stream)
-
-        stream = self._stream_by_id.get(msg.dst_id)
-        if stream is None:
-            stream = self._stream_by_id.get(mitogen.parent_id)
+            if self._fragments or msg.reply_to == IS_FRAGMENT:
+                msg = self._reassemble(msg, stream)
+            if msg is not None:
+                self._invoke(msg, stream)
+            return None
 
+        stream = self._stream_by_id.get(msg.dst_id, self._parent_stream)
         if stream is None:
             LOG.error('%r: no route for %r, my ID is %r',
                       self, msg, mitogen.context_id)
-            if msg.reply_to and not msg.is_dead:
+            if msg.reply_to and not (msg.is_dead or msg.is_fragment):
                 msg.reply(Message.dead(), router=self)
             return
 
         stream._send(msg)
+        return stream
 
     def route(self, msg):
         self.broker.defer(self._async_route, msg)
 
+    def _async_route_throttled(self, msg, func):
+        stream = self._async_route(msg)
+        if stream is None:
+            func(msg.dst_id == mitogen.context_id)
+            return
+
+        def on_drained():
+            # The route is removed before a disconnecting stream releases
+            # its waiters.
+            func(self._stream_by_id.get(msg.dst_id,
+                                        self._parent_stream) is stream)
+        stream.call_when_drained(on_drained)
+
+    def route_throttled(self, msg, func):
+        self.broker.defer(self._async_route_throttled, msg, func)
+
+    def route_many(self, msgs):
+        self.broker.defer_many([(self._async_route, (msg,), {})
+                                for msg in msgs])
+
+
+class Poller(object):
+    """
+    Track file descriptors a :py:class:`Broker` is interested in, and block
+    until one or more become ready. This implementation uses
+    :py:func:`select.select`, so its cost grows with the number of descriptors
+    and it cannot handle descriptors above ``FD_SETSIZE``. More scalable
+    subclasses exist in :py:mod:`mitogen.parent`.
+
+    Interest is registered incrementally; each descriptor is associated with
+    an opaque `data` object that :py:meth:`poll` yields when the descriptor
+    becomes ready, rather than the descriptor itself.
+
+    Interest changes are constant time. Changes that leave a descriptor with
+    some remaining interest are batched and passed to the OS once, at the
+    start of the next :py:meth:`poll`, so a stream that enables and disables
+    transmit interest repeatedly during one loop iteration costs nothing
+    beyond its final state. Changes removing all interest are applied
+    immediately, since the descriptor is likely about to be closed.
+    """
+    #: Number of calls to :py:meth:`poll`.
+    polls = 0
+
+    #: Number of interest changes requested by callers.
+    changes = 0
+
+    #: Number of interest changes passed to the OS after batching.
+    updates = 0
+
+    def __init__(self):
+        #: fd -> (data, generation) for descriptors awaiting readability.
+        self._rfds = {}
+        #: fd -> (data, generation) for descriptors awaiting writeability.
+        self._wfds = {}
+        #: Descriptors whose interest changed since the last :py:meth:`poll`.
+        self._dirty = set()
+        self._generation = 1
+
+    def __repr__(self):
+        return '%s(%#x)' % (type(self).__name__, id(self))
+
+    @property
+    def readers(self):
+        """List of `(fd, data)` tuples registered for readability."""
+        return [(fd, data) for fd, (data, _) in self._rfds.items()]
+
+    @property
+    def writers(self):
+        """List of `(fd, data)` tuples registered for writeability."""
+        return [(fd, data) for fd, (data, _) in self._wfds.items()]
+
+    def close(self):
+        """Release any OS resources held by the poller."""
+        pass
+
+    def _update(self, fd):
+        """Subclasses override this to inform the OS of an interest change for
+        `fd`, after :py:attr:`_rfds` or :py:attr:`_wfds` has been updated."""
+        pass
+
+    def _changed(self, fd):
+        self.changes += 1
+        if fd in self._rfds or fd in self._wfds:
+            self._dirty.add(fd)
+        else:
+            self._dirty.discard(fd)
+            self.updates += 1
+            self._update(fd)
+
+    def _flush(self):
+        dirty = self._dirty
+        self._dirty = set()
+        self.updates += len(dirty)
+        for fd in dirty:
+            self._update(fd)
+
+    def start_receive(self, fd, data=None):
+        self._rfds[fd] = (data or fd, self._generation)
+        self._changed(fd)
+
+    def stop_receive(self, fd):
+        if self._rfds.pop(fd, None) is not None:
+            self._changed(fd)
+
+    def start_transmit(self, fd, data=None):
+        self._wfds[fd] = (data or fd, self._generation)
+        self._changed(fd)
+
+    def stop_transmit(self, fd):
+        if self._wfds.pop(fd, None) is not None:
+            self._changed(fd)
+
+    def poll(self, timeout=None):
+        """
+        Block for up to `timeout` seconds (or forever if :py:data:`None`)
+        waiting for registered descriptors to become ready, returning an
+        iterable of their `data`.
+
+        Descriptors registered after the call to :py:meth:`poll` began are
+        never reported by it, since their readiness may have been reported for
+        a previous user of the same descriptor number that was closed while
+        callbacks were running.
+        """
+        self.polls += 1
+        self._generation += 1
+        if self._dirty:
+            self._flush()
+        return self._poll(timeout)
+
+    def _poll(self, timeout):
+        (rfds, wfds, _), _ = io_op(select.select,
+            self._rfds,
+            self._wfds,
+            (), timeout
+        )
+
+        for fd in rfds:
+            _vv and IOLOG.debug('%r: POLLIN for %r', self, fd)
+            data, gen = self._rfds.get(fd, (None, None))
+            if gen and gen < self._generation:
+                yield data
+
+        for fd in wfds:
+            _vv and IOLOG.debug('%r: POLLOUT for %r', self, fd)
+            data, gen = self._wfds.get(fd, (None, None))
+            if gen and gen < self._generation:
+                yield data
+
+
+class Timer(object):
+    """
+    Handle for a function scheduled by :py:meth:`Broker.call_later`.
+    """
+    #: :py:data:`True` once :py:meth:`cancel` has been called.
+    cancelled = False
+
+    def __init__(self, when, func, args):
+        self.when = when
+        self.func = func
+        self.args = args
+
+    def __repr__(self):
+        return 'Timer(%r, when=%r)' % (self.func, self.when)
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def __le__(self, other):
+        return self.when <= other.when
+
+    def cancel(self):
+        """
+        Prevent the function from running, if it has not already started.
+        Safe to call from any thread.
+        """
+        self.cancelled = True
+
 
 class Broker(object):
     _waker = None
     _thread = None
     shutdown_timeout = 3.0
 
-    def __init__(self):
+    #: :py:class:`Poller` subclass used to wait for IO readiness.
+    poller_class = Poller
+
+    #: Seconds the IO loop has spent waiting for IO readiness, and running
+    #: callbacks for ready streams, while :py:attr:`stats_interval` is set.
+    poll_time = 0.0
+    dispatch_time = 0.0
+
+    #: If not :py:data:`None`, log the result of :py:meth:`get_stats` every
+    #: `stats_interval` seconds. In a child, logs are forwarded to the
+    #: master.
+    stats_interval = None
+    _stats_timer = None
+
+    def __init__(self, poller_class=None):
         self._alive = True
+        #: Heap of pending :py:class:`Timer`, earliest first.
+        self._timers = []
+        #: Streams whose output is written before the next poll.
+        self._flushing = []
         self._waker = Waker(self)
         self.defer = self._waker.defer
-        self._readers = [self._waker.receive_side]
-        self._writers = []
+        self.defer_many = self._waker.defer_many
+        self.poller = (poller_class or self.poller_class)()
+        self.poller.start_receive(
+            self._waker.receive_side.fd,
+            (self._waker.receive_side, self._waker.on_receive)
+        )
         self._thread = threading.Thread(
             target=_profile_hook,
             args=('broker', self._broker_main),
@@ -1388,33 +2732,45 @@ class Broker(object):
         self._thread.start()
         self._waker.broker_ident = self._thread.ident
 
-    def _list_discard(self, lst, value):
-        try:
-            lst.remove(value)
-        except ValueError:
-            pass
-
-    def _list_add(self, lst, value):
-        if value not in lst:
-            lst.append(value)
-
     def start_receive(self, stream):
         _vv and IOLOG.debug('%r.start_receive(%r)', self, stream)
-        assert stream.receive_side and stream.receive_side.fd is not None
-        self.defer(self._list_add, self._readers, stream.receive_side)
+        side = stream.receive_side
+        assert side and side.fd is not None
+        self.defer(self.poller.start_receive,
+                   side.fd, (side, stream.on_receive))
 
     def stop_receive(self, stream):
         IOLOG.debug('%r.stop_receive(%r)', self, stream)
-        self.defer(self._list_discard, self._readers, stream.receive_side)
+        side = stream.receive_side
+        if side and side.fd is not None:
+            self.defer(self.poller.stop_receive, side.fd)
 
     def _start_transmit(self, stream):
-        IOLOG.debug('%r._start_transmit(%r)', self, stream)
-        assert stream.transmit_side and stream.transmit_side.fd is not None
-        self._list_add(self._writers, stream.transmit_side)
+        _vv and IOLOG.debug('%r._start_transmit(%r)', self, stream)
+        side = stream.transmit_side
+        assert side and side.fd is not None
+        self.poller.start_transmit(side.fd, (side, stream.on_transmit))
 
     def _stop_transmit(self, stream):
-        IOLOG.debug('%r._stop_transmit(%r)', self, stream)
-        self._list_discard(self._writers, stream.transmit_side)
+        _vv and IOLOG.debug('%r._stop_transmit(%r)', self, stream)
+        side = stream.transmit_side
+        if side and side.fd is not None:
+            self.poller.stop_transmit(side.fd)
+
+    def _flush_soon(self, stream):
+        """
+        Arrange for :py:meth:`Stream.on_flush` to be called before the IO loop
+        next waits, rather than waiting for `stream` to become writeable.
+        """
+        self._flushing.append(stream)
+
+    def _flush(self):
+        streams = self._flushing
+        self._flushing = []
+        for stream in streams:
+            side = stream.transmit_side
+            if side and side.fd is not None:
+                self._call(stream, stream.on_flush)
 
     def _call(self, stream, func):
         try:
@@ -1424,40 +2780,127 @@ class Broker(object):
             stream.on_disconnect(self)
 
     def _loop_once(self, timeout=None):
-        _vv and IOLOG.debug('%r._loop_once(%r)', self, timeout)
-
-        #IOLOG.debug('readers = %r', self._readers)
-        #IOLOG.debug('writers = %r', self._writers)
-        (rsides, wsides, _), _ = io_op(select.select,
-            self._readers,
-            self._writers,
-            (), timeout
-        )
+        _vv and IOLOG.debug('%r._loop_once(%r, %r)',
+                            self, timeout, self.poller)
+        if self._flushing:
+            self._flush()
+
+        timers = self._timers
+        while timers and timers[0].cancelled:
+            heapq.heappop(timers)
+
+        timed = self.stats_interval is not None
+        if not (timed or timers):
+            # With no timers and statistics off, the clock need not be read.
+            for (side, func) in self.poller.poll(timeout):
+                self._call(side.stream, func)
+            return
 
-        for side in rsides:
-            _vv and IOLOG.debug('%r: POLLIN for %r', self, side)
-            self._call(side.stream, side.stream.on_receive)
+        # poll() only waits once its first event is requested.
+        t0 = now()
+        if timers:
+            delay = max(0, timers[0].when - t0)
+            if timeout is None or delay < timeout:
+                timeout = delay
+
+        t1 = None
+        for (side, func) in self.poller.poll(timeout):
+            if t1 is None:
+                t1 = now()
+            self._call(side.stream, func)
+
+        if t1 is None:
+            t1 = now()
+        if timers:
+            self._fire_timers(t1)
+        if timed:
+            t2 = now()
+            self.poll_time += t1 - t0
+            self.dispatch_time += t2 - t1
+
+    def call_later(self, delay, func, *args):
+        """
+        Arrange for `func(*args)` to run on the broker thread after `delay`
+        seconds, returning a :py:class:`Timer` that may be used to cancel it.
+        Safe to call from any thread. The IO loop waits no longer than
+        necessary to run the earliest timer, and otherwise sleeps until IO
+        occurs.
+        """
+        timer = Timer(now() + delay, func, args)
+        self.defer(heapq.heappush, self._timers, timer)
+        return timer
+
+    def _fire_timers(self, now):
+        timers = self._timers
+        while timers and timers[0].when <= now:
+            timer = heapq.heappop(timers)
+            if timer.cancelled:
+                continue
+            try:
+                timer.func(*timer.args)
+            except Exception:
+                LOG.exception('%r crashed', timer)
 
-        for side in wsides:
-            _vv and IOLOG.debug('%r: POLLOUT for %r', self, side)
-            self._call(side.stream, side.stream.on_transmit)
+    def get_stats(self):
+        """
+        Return a dict describing time spent by the IO loop, functions run by
+        :py:meth:`defer`, and the result of :py:meth:`Stream.get_stats` for
+        each connected stream. Counters are read without locking, so may be
+        called from any thread.
+        """
+        waker = self._waker
+        streams = set(side.stream for side in self._all_sides())
+        return {
+            'loops': self.poller.polls,
+            'poll_time': self.poll_time,
+            'dispatch_time': self.dispatch_time,
+            'deferred_calls': waker.deferred_calls,
+            'defer_latency': waker.defer_latency,
+            'defer_latency_max': waker.defer_latency_max,
+            'streams': [stream.get_stats() for stream in streams
+                        if isinstance(stream, Stream)],
+        }
+
+    def _reset_stats_timer(self):
+        """
+        Cancel any timer for logging statistics, and start a new one if
+        :py:attr:`stats_interval` is set. Must be called on the broker thread.
+        """
+        if self._stats_timer:
+            self._stats_timer.cancel()
+            self._stats_timer = None
+        if self.stats_interval is not None:
+            self._stats_timer = self.call_later(self.stats_interval,
+                                                self._on_stats_timer)
+
+    def _on_stats_timer(self):
+        LOG.info('%r: %r', self, self.get_stats())
+        self._stats_timer = None
+        self._reset_stats_timer()
+
+    def _all_sides(self):
+        return set(side for _, (side, _) in
+                   self.poller.readers + self.poller.writers)
 
     def keep_alive(self):
-        return sum((side.keep_alive for side in self._readers), 0)
+        return sum((side.keep_alive for _, (side, _) in self.poller.readers),
+                   0)
 
     def _broker_main(self):
         try:
+            self._reset_stats_timer()
             while self._alive:
                 self._loop_once()
 
             fire(self, 'shutdown')
 
-            for side in set(self._readers).union(self._writers):
+            for side in self._all_sides():
                 self._call(side.stream, side.stream.on_shutdown)
 
-            deadline = time.time() + self.shutdown_timeout
-            while self.keep_alive() and time.time() < deadline:
-                self._loop_once(max(0, deadline - time.time()))
+            expired = []
+            self.call_later(self.shutdown_timeout, expired.append, True)
+            while self.keep_alive() and not expired:
+                self._loop_once()
 
             if self.keep_alive():
                 LOG.error('%r: some streams did not close gracefully. '
@@ -1465,12 +2908,14 @@ class Broker(object):
                           'more child processes still connected to '
                           'our stdout/stderr pipes.', self)
 
-            for side in set(self._readers).union(self._writers):
+            for side in self._all_sides():
                 LOG.error('_broker_main() force disconnecting %r', side)
                 side.stream.on_disconnect(self)
         except Exception:
             LOG.exception('_broker_main() crashed')
 
+        self.poller.close()
+
         fire(self, 'exit')
 
     def shutdown(self):
@@ -1486,6 +2931,27 @@ class Broker(object):
         return 'Broker(%#x)' % (id(self),)
 
 
+@takes_router
+def get_stats(router):
+    """
+    Return :py:meth:`Broker.get_stats` for the broker of the context running
+    the function, so that it may be collected using :py:meth:`Context.call`.
+    """
+    return router.broker.get_stats()
+
+
+@takes_router
+def log_stats(interval, router):
+    """
+    Set :py:attr:`Broker.stats_interval` for the broker of the context running
+    the function, or disable logging if `interval` is :py:data:`None`.
+    """
+    def _set_interval():
+        router.broker.stats_interval = interval
+        router.broker._reset_stats_timer()
+    router.broker.defer(_set_interval)
+
+
 class ExternalContext(object):
     def _on_broker_shutdown(self):
         self.channel.close()
@@ -1504,7 +2970,8 @@ class ExternalContext(object):
         self.broker.shutdown()
 
     def _setup_master(self, max_message_size, profiling, parent_id,
-                      context_id, in_fd, out_fd):
+                      context_id, in_fd, out_fd, compress, compress_prime,
+                      priority_lanes):
         Router.max_message_size = max_message_size
         self.profiling = profiling
         if profiling:
@@ -1529,6 +2996,9 @@ class ExternalContext(object):
         self.stream.name = 'parent'
         self.stream.accept(in_fd, out_fd)
         self.stream.receive_side.keep_alive = False
+        if compress:
+            self.stream.enable_compression(compress_prime)
+        self.stream.priority_lanes = priority_lanes
 
         listen(self.stream, 'disconnect', self._on_parent_disconnect)
         listen(self.broker, 'shutdown', self._on_broker_shutdown)
@@ -1547,6 +3017,22 @@ class ExternalContext(object):
         if debug:
             enable_debug_logging()
 
+    def _setup_resolver(self, module_cache, bytecode):
+        # Imported from the parent only when enabled, so it must follow
+        # registration of the parent stream.
+        import mitogen.module_cache
+        cache = None
+        if module_cache:
+            try:
+                cache = mitogen.module_cache.ModuleCache(module_cache)
+                listen(self.broker, 'exit', cache.flush)
+            except OSError:
+                LOG.warning('Cannot use module cache %r, continuing without',
+                            module_cache, exc_info=True)
+        resolver = mitogen.module_cache.Resolver(self.importer, cache,
+                                                 bytecode)
+        resolver.announce()
+
     def _setup_importer(self, importer, core_src_fd, whitelist, blacklist):
         if importer:
             importer._install_handler(self.router)
@@ -1556,9 +3042,8 @@ class ExternalContext(object):
                 fp = os.fdopen(101, 'r', 1)
                 try:
                     core_size = int(fp.readline())
+                    # Kept compressed; get_source() strips the main() call.
                     core_src = fp.read(core_size)
-                    # Strip "ExternalContext.main()" call from last line.
-                    core_src = '\n'.join(core_src.splitlines()[:-1])
                 finally:
                     fp.close()
             else:
@@ -1647,13 +3132,17 @@ class ExternalContext(object):
     def main(self, parent_ids, context_id, debug, profiling, log_level,
              max_message_size, in_fd=100, out_fd=1, core_src_fd=101,
              setup_stdio=True, setup_package=True, importer=None,
-             whitelist=(), blacklist=()):
+             whitelist=(), blacklist=(), compress=False,
+             compress_prime=None, module_cache=None, bytecode=False,
+             priority_lanes=False):
         self._setup_master(max_message_size, profiling, parent_ids[0],
-                           context_id, in_fd, out_fd)
+                           context_id, in_fd, out_fd, compress, compress_prime,
+                           priority_lanes)
         try:
             try:
                 self._setup_logging(debug, log_level)
-                self._setup_importer(importer, core_src_fd, whitelist, blacklist)
+                self._setup_importer(importer, core_src_fd, whitelist,
+                                     blacklist)
                 if setup_package:
                     self._setup_package()
                 self._setup_globals(context_id, parent_ids)
@@ -1661,6 +3150,8 @@ class ExternalContext(object):
                     self._setup_stdio()
 
                 self.router.register(self.parent, self.stream)
+                if module_cache or bytecode:
+                    self._setup_resolver(module_cache, bytecode)
 
                 sys.executable = os.environ.pop('ARGV0', sys.executable)
                 _v and LOG.debug('Connected to %s; my ID is %r, PID is %r',
@@ -27,7 +27,8 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 """
-Basic signal handler for dumping thread stacks.
+Basic signal handler for dumping thread stacks, and a sampling profiler that
+may be started and stopped at runtime in any context.
 """
 
 import difflib
@@ -118,3 +119,137 @@ def dump_to_logger():
     th = threading.Thread(target=_logging_main)
     th.setDaemon(True)
     th.start()
+
+
+class Sampler(object):
+    """
+    Sampling profiler that records the stacks of every thread but its own
+    every `interval` seconds, using :py:func:`sys._current_frames`, counting
+    each distinct stack. Unlike :py:func:`mitogen.core.enable_profiling`, the
+    cost to profiled threads is limited to contention for the GIL while a
+    sample is taken.
+
+    Memory is bounded by recording at most `max_stacks` distinct stacks, each
+    truncated to its innermost `max_depth` frames. Samples of further
+    distinct stacks are counted in :py:attr:`dropped`.
+    """
+    def __init__(self, interval=0.005, max_stacks=10000, max_depth=64):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+        #: Mapping of folded stack to the number of samples it appeared in.
+        self.counts = {}
+        #: Samples taken.
+        self.samples = 0
+        #: Thread stacks sampled that were not recorded in :py:attr:`counts`.
+        self.dropped = 0
+        self._labels = {}
+        self._names = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __repr__(self):
+        return 'Sampler(interval=%r, samples=%d, stacks=%d)' % (
+            self.interval, self.samples, len(self.counts),
+        )
+
+    def _label(self, code):
+        try:
+            return self._labels[code]
+        except KeyError:
+            label = '%s (%s:%d)' % (code.co_name, code.co_filename,
+                                    code.co_firstlineno)
+            self._labels[code] = label.replace(';', ':')
+            return self._labels[code]
+
+    def _thread_name(self, ident):
+        name = self._names.get(ident)
+        if name is None:
+            self._names = dict((t.ident, t.name)
+                               for t in threading.enumerate())
+            name = self._names.setdefault(ident, str(ident))
+        return name
+
+    def _fold(self, ident, frame):
+        labels = []
+        while frame is not None and len(labels) < self.max_depth:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        labels.append(self._thread_name(ident))
+        labels.reverse()
+        return ';'.join(labels)
+
+    def sample(self):
+        """
+        Record the stack of every thread but the calling thread.
+        """
+        me = threading.currentThread().ident
+        self.samples += 1
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            key = self._fold(ident, frame)
+            if key in self.counts:
+                self.counts[key] += 1
+            elif len(self.counts) < self.max_stacks:
+                self.counts[key] = 1
+            else:
+                self.dropped += 1
+
+    def _sampler_main(self):
+        while not self._stopped.isSet():
+            self.sample()
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sampler_main,
+                                        name='mitogen-sampler')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def format_folded(self):
+        """
+        Return the recorded stacks in the folded format accepted by
+        `flamegraph.pl`_: one line per stack, with frames from outermost to
+        innermost separated by semicolons, followed by its sample count.
+
+        .. _flamegraph.pl: https://github.com/brendangregg/FlameGraph
+        """
+        return ''.join('%s %d\n' % (key, count)
+                       for key, count in sorted(self.counts.items()))
+
+
+_sampler = None
+
+
+def start_sampling(interval=0.005, max_stacks=10000, max_depth=64):
+    """
+    Start a :py:class:`Sampler` in the current process, replacing any that
+    was running. Intended to be invoked in a child using
+    :py:meth:`Context.call <mitogen.parent.Context.call>`.
+    """
+    global _sampler
+    if _sampler is not None:
+        _sampler.stop()
+    _sampler = Sampler(interval, max_stacks, max_depth)
+    _sampler.start()
+
+
+def stop_sampling():
+    """
+    Stop the sampler started by :py:func:`start_sampling`, returning its
+    stacks in the format of :py:meth:`Sampler.format_folded`, or
+    :py:data:`None` if no sampler was running.
+    """
+    global _sampler
+    sampler, _sampler = _sampler, None
+    if sampler is None:
+        return None
+    sampler.stop()
+    LOG.debug('%r stopped, %d samples dropped', sampler, sampler.dropped)
+    return sampler.format_folded()
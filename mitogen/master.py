@@ -26,11 +26,15 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import binascii
+import collections
 import dis
+import hashlib
 import imp
 import inspect
 import itertools
 import logging
+import marshal
 import os
 import pkgutil
 import re
@@ -46,6 +50,7 @@ if not hasattr(pkgutil, 'find_loader'):
     from mitogen.compat import pkgutil
 
 import mitogen.core
+import mitogen.module_cache
 import mitogen.parent
 from mitogen.core import LOG
 
@@ -315,10 +320,118 @@ class LogForwarder(object):
         return 'LogForwarder(%r)' % (self._router,)
 
 
+class DependencyCache(object):
+    """
+    File of :py:func:`scan_code_imports` results for source files, keyed by
+    path and validated by size and modification time, allowing a master to
+    skip compiling modules it scanned in a previous run. The file is named for
+    the running interpreter's bytecode magic, as the scan depends on the
+    compiler. Changes are only written by :py:meth:`save`.
+
+    :param str path:
+        Directory to use, created if it does not exist.
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.filename = os.path.join(self.path, 'imports-%s.marshal' % (
+            binascii.hexlify(imp.get_magic()),
+        ))
+        #: Mapping of path to `(mtime, size, [(level, modname, namelist)])`.
+        self._entries = self._load()
+        self._dirty = False
+
+    def __repr__(self):
+        return 'DependencyCache(%r)' % (self.path,)
+
+    def _load(self):
+        try:
+            fp = open(self.filename, 'rb')
+        except IOError:
+            return {}
+
+        try:
+            try:
+                entries = marshal.load(fp)
+            finally:
+                fp.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            entries = None
+
+        if not isinstance(entries, dict):
+            LOG.warning('%r: discarding unreadable or corrupt %r',
+                        self, self.filename)
+            return {}
+        return entries
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def get(self, path):
+        """
+        Return the list of `(level, modname, namelist)` tuples scanned from
+        the file at `path`, or :py:data:`None` if it is absent or the file
+        changed since it was scanned.
+        """
+        entry = self._entries.get(path)
+        if entry is not None and self._stat(path) == entry[:2]:
+            return entry[2]
+
+    def put(self, path, imports):
+        """
+        Store `imports`, the list of `(level, modname, namelist)` tuples
+        scanned from the file at `path`.
+        """
+        st = self._stat(path)
+        if st is not None:
+            self._entries[path] = st + (imports,)
+            self._dirty = True
+
+    def save(self):
+        """
+        Write any new entries to disk, merged with those saved meanwhile by
+        other masters sharing the cache. Entries for files that were deleted
+        or changed since they were scanned are dropped, so the cache does not
+        grow without bound.
+        """
+        if not self._dirty:
+            return
+
+        entries = self._load()
+        entries.update(self._entries)
+        for path, entry in list(entries.items()):
+            if self._stat(path) != entry[:2]:
+                del entries[path]
+        tmp_path = '%s.%d.tmp' % (self.filename, os.getpid())
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, int('0700', 8))
+            fp = open(tmp_path, 'wb')
+            try:
+                marshal.dump(entries, fp)
+            finally:
+                fp.close()
+            os.rename(tmp_path, self.filename)
+        except (IOError, OSError):
+            LOG.warning('%r: cannot write %r', self, self.filename,
+                        exc_info=True)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return
+
+        self._entries = entries
+        self._dirty = False
+
+
 class ModuleFinder(object):
     _STDLIB_PATHS = _stdlib_paths()
 
-    def __init__(self):
+    def __init__(self, dependency_cache=None):
         #: Import machinery is expensive, keep :py:meth`:get_module_source`
         #: results around.
         self._found_cache = {}
@@ -326,6 +439,9 @@ class ModuleFinder(object):
         #: Avoid repeated dependency scanning, which is expensive.
         self._related_cache = {}
 
+        #: :py:class:`DependencyCache` or :py:data:`None`.
+        self.dependency_cache = dependency_cache
+
     def __repr__(self):
         return 'ModuleFinder()'
 
@@ -468,6 +584,32 @@ class ModuleFinder(object):
             fullname, _, _ = fullname.rpartition('.')
             yield fullname
 
+    def _scan_imports(self, fullname):
+        """
+        Return a list of `(level, modname, namelist)` tuples describing the
+        imports made by `fullname`, or :py:data:`None` if its source cannot be
+        found. Results for unchanged files are reused from
+        :py:attr:`dependency_cache`, keyed on the path the source was found
+        at, so modules the master never imported benefit too.
+        """
+        modpath, src, _ = self.get_module_source(fullname)
+        if src is None:
+            return None
+
+        cache = self.dependency_cache
+        if cache is not None:
+            # The path is relative when its sys.path entry is.
+            path = os.path.abspath(modpath)
+            imports = cache.get(path)
+            if imports is not None:
+                return imports
+
+        co = compile(src, modpath, 'exec')
+        imports = list(scan_code_imports(co))
+        if cache is not None:
+            cache.put(path, imports)
+        return imports
+
     def find_related_imports(self, fullname):
         """
         Return a list of non-stdlb modules that are directly imported by
@@ -484,14 +626,12 @@ class ModuleFinder(object):
         if related is not None:
             return related
 
-        modpath, src, _ = self.get_module_source(fullname)
-        if src is None:
+        imports = self._scan_imports(fullname)
+        if imports is None:
             return []
 
         maybe_names = list(self.generate_parent_names(fullname))
-
-        co = compile(src, modpath, 'exec')
-        for level, modname, namelist in scan_code_imports(co):
+        for level, modname, namelist in imports:
             if level == -1:
                 modnames = [modname, '%s.%s' % (fullname, modname)]
             else:
@@ -528,30 +668,42 @@ class ModuleFinder(object):
             for which source code can be retrieved
         :type fullname: str
         """
-        stack = [fullname]
+        queue = collections.deque([fullname])
         found = set()
 
-        while stack:
-            name = stack.pop(0)
-            names = self.find_related_imports(name)
-            stack.extend(set(names).difference(found, stack))
-            found.update(names)
+        while queue:
+            for name in self.find_related_imports(queue.popleft()):
+                if name not in found:
+                    found.add(name)
+                    queue.append(name)
 
         found.discard(fullname)
         return sorted(found)
 
 
 class ModuleResponder(object):
-    def __init__(self, router):
+    def __init__(self, router, dependency_cache=None):
         self._router = router
-        self._finder = ModuleFinder()
+        self._finder = ModuleFinder(dependency_cache)
         self._cache = {}  # fullname -> pickled
+        self._code_cache = {}  # fullname -> compressed marshalled code
+        self._bundle_cache = {}
         self.blacklist = []
         self.whitelist = ['']
         router.add_handler(
             fn=self._on_get_module,
             handle=mitogen.core.GET_MODULE,
         )
+        router.add_handler(
+            fn=lambda msg: mitogen.module_cache.on_cached_modules(router, msg),
+            handle=mitogen.core.CACHED_MODULES,
+            policy=mitogen.parent.is_immediate_child,
+        )
+        router.add_handler(
+            fn=lambda msg: mitogen.module_cache.on_code_magic(router, msg),
+            handle=mitogen.core.CODE_MAGIC,
+            policy=mitogen.parent.is_immediate_child,
+        )
 
     def __repr__(self):
         return 'ModuleResponder(%r)' % (self._router,)
@@ -607,16 +759,47 @@ class ModuleResponder(object):
             for name in self._finder.find_related(fullname)
             if not mitogen.core.is_blacklisted_import(self, name)
         ]
-        # 0:fullname 1:pkg_present 2:path 3:compressed 4:related
-        tup = fullname, pkg_present, path, compressed, related
+        # 0:fullname 1:pkg_present 2:path 3:compressed 4:related 5:digest
+        tup = (fullname, pkg_present, path, compressed, related,
+               hashlib.sha1(source).digest())
         self._cache[fullname] = tup
         return tup
 
-    def _send_load_module(self, stream, msg, fullname):
-        LOG.debug('_send_load_module(%r, %r)', stream, fullname)
-        msg.reply(self._build_tuple(fullname),
-                  handle=mitogen.core.LOAD_MODULE)
+    def _get_code(self, tup):
+        """
+        Return the compressed, marshalled code object for the module described
+        by the :py:data:`mitogen.core.LOAD_MODULE` tuple `tup`, or
+        :py:data:`None` if it cannot be compiled here.
+        """
+        fullname = tup[0]
+        if fullname in self._code_cache:
+            return self._code_cache[fullname]
+
+        try:
+            code = mitogen.core.compile_module(fullname,
+                                               zlib.decompress(tup[3]),
+                                               'master:' + tup[2])
+            compressed = zlib.compress(marshal.dumps(code), 9)
+        except (SyntaxError, ValueError):
+            # Let the child raise the error when compiling the source.
+            LOG.debug('%r: cannot compile %r', self, fullname, exc_info=True)
+            compressed = None
+        self._code_cache[fullname] = compressed
+        return compressed
+
+    def _prepare_tuple(self, stream, fullname):
+        """
+        Return the :py:data:`mitogen.core.LOAD_MODULE` tuple for `fullname`
+        as it should be sent via `stream`, and record it as sent.
+        """
+        LOG.debug('_prepare_tuple(%r, %r)', stream, fullname)
+        tup = self._build_tuple(fullname)
+        code = None
+        if tup[3] is not None and stream.code_magic == imp.get_magic():
+            code = self._get_code(tup)
+        tup = mitogen.module_cache.prepare_tuple(stream, tup, code)
         stream.sent_modules.add(fullname)
+        return tup
 
     def _on_get_module(self, msg):
         if msg.is_dead:
@@ -625,12 +808,14 @@ class ModuleResponder(object):
         LOG.debug('%r._on_get_module(%r)', self, msg.data)
         stream = self._router.stream_by_id(msg.src_id)
         fullname = msg.data
-        if fullname in stream.sent_modules:
+        if (fullname in stream.sent_modules and not stream.cached_modules
+                and stream.code_magic is None):
             LOG.warning('_on_get_module(): dup request for %r from %r',
                         fullname, stream)
 
         try:
             tup = self._build_tuple(fullname)
+            tups = []
             for name in tup[4]:  # related
                 parent, _, _ = name.partition('.')
                 if parent != fullname and parent not in stream.sent_modules:
@@ -641,18 +826,68 @@ class ModuleResponder(object):
                     # Submodule has been sent already, skip.
                     continue
 
-                self._send_load_module(stream, msg, name)
-            self._send_load_module(stream, msg, fullname)
+                tups.append(self._prepare_tuple(stream, name))
+            tups.append(self._prepare_tuple(stream, fullname))
+            for load_msg in mitogen.parent.make_load_module_msgs(
+                    stream, tups, msg.src_id, self._bundle_cache):
+                self._router.route(load_msg)
 
         except Exception:
             LOG.debug('While importing %r', fullname, exc_info=True)
             msg.reply((fullname, None, None, None, ()),
                       handle=mitogen.core.LOAD_MODULE)
 
+    def preload(self, context, fullname):
+        """
+        If `context` is an immediate child whose stream was constructed with
+        `preload_modules=True`, send it `fullname` and every module it depends
+        on, except those already sent, so that a following call into
+        `fullname` need not wait for any :py:data:`mitogen.core.GET_MODULE`
+        round trips. Safe to call from any thread. The modules are queued
+        ahead of any message subsequently sent to `context`.
+        """
+        # Checked here to avoid waking the broker on every call when disabled.
+        stream = self._router.stream_by_id(context.context_id)
+        if (stream and stream.remote_id == context.context_id
+                and stream.preload_modules):
+            self._router.broker.defer(self._preload, stream, context,
+                                      fullname)
+
+    def _preload(self, stream, context, fullname):
+        if (fullname in stream.sent_modules
+                or self._finder.is_stdlib_name(fullname)):
+            return
+
+        try:
+            tup = self._build_tuple(fullname)
+        except ImportError:
+            return
+
+        if tup[2] is None:
+            # Leave the child to discover what it can import locally.
+            return
+
+        tups = []
+        for name in tup[4] + [fullname]:  # related
+            if name in stream.sent_modules:
+                continue
+            try:
+                if self._build_tuple(name)[2] is not None:
+                    tups.append(self._prepare_tuple(stream, name))
+            except ImportError:
+                LOG.debug('%r: not preloading %r', self, name, exc_info=True)
+
+        for msg in mitogen.parent.make_load_module_msgs(
+                stream, tups, context.context_id, self._bundle_cache):
+            # Already on the broker thread, so route immediately, to precede
+            # the call queued behind this function.
+            self._router._async_route(msg)
+
 
 class Broker(mitogen.core.Broker):
     shutdown_timeout = 5.0
     _watcher = None
+    poller_class = mitogen.parent.PREFERRED_POLLER
 
     def __init__(self, install_watcher=True):
         if install_watcher:
@@ -668,22 +903,35 @@ class Broker(mitogen.core.Broker):
             self._watcher.remove()
 
 
+class Context(mitogen.parent.Context):
+    def call_async(self, fn, *args, **kwargs):
+        self.router.responder.preload(self, fn.__module__)
+        return super(Context, self).call_async(fn, *args, **kwargs)
+
+
 class Router(mitogen.parent.Router):
     broker_class = Broker
+    context_class = Context
     debug = False
     profiling = False
 
-    def __init__(self, broker=None, max_message_size=None):
+    def __init__(self, broker=None, max_message_size=None,
+                 dependency_cache=None):
         if broker is None:
             broker = self.broker_class()
         if max_message_size:
             self.max_message_size = max_message_size
+        self.dependency_cache = None
+        if dependency_cache:
+            self.dependency_cache = DependencyCache(dependency_cache)
+            mitogen.core.listen(broker, 'shutdown',
+                                self.dependency_cache.save)
         super(Router, self).__init__(broker)
         self.upgrade()
 
     def upgrade(self):
         self.id_allocator = IdAllocator(self)
-        self.responder = ModuleResponder(self)
+        self.responder = ModuleResponder(self, self.dependency_cache)
         self.log_forwarder = LogForwarder(self)
         self.route_monitor = mitogen.parent.RouteMonitor(router=self)
 
@@ -0,0 +1,515 @@
+# Copyright 2017, David Wilson
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Support for contexts started with `module_cache` or `bytecode`, whose parent
+may omit module source from :py:data:`mitogen.core.LOAD_MODULE` replies, since
+the child holds it in an on-disk cache, or because compiled code was sent in
+its place. It is imported from the parent only by contexts that enable either,
+and by parents of such contexts, keeping it out of every child's bootstrap.
+"""
+
+import binascii
+import hashlib
+import imp
+import marshal
+import os
+import threading
+import zlib
+
+import mitogen.core
+from mitogen.core import LOG
+
+
+class ModuleCache(object):
+    """
+    Directory of :py:mod:`zlib`-compressed module source, named by the hex
+    SHA-1 digest of the uncompressed source, allowing a context to skip
+    fetching source it received in a previous run. Each entry is verified
+    against its name when read, and when the directory exceeds
+    :py:attr:`max_size` bytes, the least recently used entries are removed
+    until it is below :py:attr:`low_size` bytes, so a full cache is not
+    rescanned for every new entry. Entries are written and evicted by a
+    writer thread, so :py:meth:`put` never waits on the filesystem.
+
+    :param str path:
+        Directory to use, created if it does not exist.
+    """
+    #: Maximum total size of entries.
+    max_size = 64 * 1048576
+
+    #: Total size of entries to keep when :py:attr:`max_size` is exceeded.
+    low_size = 48 * 1048576
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, int('0700', 8))
+        self._lock = threading.Lock()
+        #: Mapping of digest to entry size.
+        self._sizes = {}
+        self._size = 0
+        #: Digests queued for the writer thread.
+        self._pending = set()
+        self._latch = mitogen.core.Latch()
+        self._thread = None
+        for name in os.listdir(self.path):
+            if len(name) == 40:
+                try:
+                    self._add(binascii.unhexlify(name),
+                              os.path.getsize(self._path(name)))
+                except (TypeError, ValueError, OSError):
+                    pass
+
+    def __repr__(self):
+        return 'ModuleCache(%r)' % (self.path,)
+
+    def _path(self, name):
+        return os.path.join(self.path, name)
+
+    def _add(self, digest, size):
+        self._sizes[digest] = size
+        self._size += size
+
+    def _remove(self, digest):
+        self._lock.acquire()
+        try:
+            self._size -= self._sizes.pop(digest, 0)
+        finally:
+            self._lock.release()
+        try:
+            os.unlink(self._path(binascii.hexlify(digest)))
+        except OSError:
+            pass
+
+    def digests(self):
+        """
+        Return a list of digests of the cached source.
+        """
+        self._lock.acquire()
+        try:
+            return list(self._sizes)
+        finally:
+            self._lock.release()
+
+    def get(self, digest):
+        """
+        Return the compressed source whose SHA-1 is `digest`, or
+        :py:data:`None` if it is absent or fails verification.
+        """
+        path = self._path(binascii.hexlify(digest))
+        try:
+            fp = open(path, 'rb')
+        except IOError:
+            # Absent, perhaps evicted by another context sharing the cache.
+            self._remove(digest)
+            return None
+
+        try:
+            try:
+                compressed = fp.read()
+            finally:
+                fp.close()
+            source = zlib.decompress(compressed)
+            ok = hashlib.sha1(source).digest() == digest
+        except (IOError, zlib.error):
+            ok = False
+
+        if not ok:
+            LOG.warning('%r: discarding unreadable or corrupt %r', self, path)
+            self._remove(digest)
+            return None
+
+        try:
+            os.utime(path, None)  # Mark as recently used.
+        except OSError:
+            pass
+        return compressed
+
+    def put(self, digest, compressed):
+        """
+        Queue the compressed source `compressed`, whose SHA-1 is `digest`, to
+        be stored by the writer thread unless it is already present.
+        """
+        self._lock.acquire()
+        try:
+            if digest in self._sizes or digest in self._pending:
+                return
+            self._pending.add(digest)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._writer_main,
+                                                name='mitogen-module-cache')
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+        self._latch.put((digest, compressed))
+
+    def flush(self):
+        """
+        Wait for queued entries to be written, stopping the writer thread
+        until the next :py:meth:`put`.
+        """
+        self._lock.acquire()
+        try:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._latch.put(None)
+        finally:
+            self._lock.release()
+        if thread is not None:
+            thread.join()
+
+    def _writer_main(self):
+        while True:
+            item = self._latch.get()
+            if item is None:
+                return
+            self._write(*item)
+
+    def _write(self, digest, compressed):
+        path = self._path(binascii.hexlify(digest))
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            fp = open(tmp_path, 'wb')
+            try:
+                fp.write(compressed)
+            finally:
+                fp.close()
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            LOG.debug('%r: could not write %r', self, path, exc_info=True)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            written = False
+        else:
+            written = True
+
+        self._lock.acquire()
+        try:
+            self._pending.discard(digest)
+            if written:
+                self._add(digest, len(compressed))
+            full = self._size > self.max_size
+        finally:
+            self._lock.release()
+        if full:
+            self._evict()
+
+    def _evict(self):
+        by_mtime = []
+        for digest in self.digests():
+            try:
+                mtime = os.path.getmtime(self._path(binascii.hexlify(digest)))
+            except OSError:
+                mtime = 0
+            by_mtime.append((mtime, digest))
+        by_mtime.sort()
+        for mtime, digest in by_mtime:
+            if self._size <= self.low_size:
+                break
+            self._remove(digest)
+
+
+class Resolver(object):
+    """
+    Complete the :py:data:`mitogen.core.LOAD_MODULE` tuples received by
+    `importer` whose source the parent omitted, and announce to the parent
+    what it may omit.
+
+    :param mitogen.core.Importer importer:
+        Importer to extend.
+    :param ModuleCache cache:
+        If not :py:data:`None`, cache of module source to announce to the
+        parent, consult for source it declines to send, and store fetched
+        source in.
+    :param bool bytecode:
+        If :py:data:`True`, announce this interpreter's bytecode magic to the
+        parent, so it may send compiled code in place of module source.
+    """
+    #: Seconds :py:meth:`fetch_source` waits for source the parent withheld
+    #: in favour of compiled code.
+    get_source_timeout = 5.0
+
+    def __init__(self, importer, cache=None, bytecode=False):
+        self._importer = importer
+        self._cache = cache
+        self._bytecode = bytecode
+        #: Names whose withheld source could not be fetched.
+        self._no_source = set()
+        #: Latches of threads waiting in :py:meth:`fetch_source`.
+        self._latches = []
+        self._dead = False
+        importer._resolver = self
+
+    def __repr__(self):
+        return 'Resolver(%r)' % (self._cache,)
+
+    def announce(self):
+        """
+        Tell the parent which sources the module cache already holds, so it may
+        omit them from :py:data:`LOAD_MODULE` replies, and whether compiled
+        code is wanted. Must be called once the parent stream is registered,
+        and before any import is attempted.
+        """
+        context = self._importer._context
+        if self._bytecode:
+            context.send(mitogen.core.Message(
+                data=imp.get_magic(),
+                handle=mitogen.core.CODE_MAGIC,
+            ))
+        if self._cache:
+            digests = self._cache.digests()
+            if digests:
+                context.send(mitogen.core.Message(
+                    data=mitogen.core.b('').join(d[:8] for d in digests),
+                    handle=mitogen.core.CACHED_MODULES,
+                ))
+
+    def on_dead(self):
+        """
+        Called when the parent is gone or the broker is shutting down, waking
+        threads waiting in :py:meth:`fetch_source`.
+        """
+        lock = self._importer._lock
+        lock.acquire()
+        try:
+            self._dead = True
+            latches, self._latches = self._latches, []
+        finally:
+            lock.release()
+        for latch in latches:
+            latch.close()
+
+    def resolve(self, tup):
+        """
+        Given a :py:data:`LOAD_MODULE` tuple whose sixth element is the SHA-1
+        digest of the module's source, store its source in the module cache,
+        or if the parent omitted it since it was announced as cached, return a
+        copy with the source read from the cache. If the cache lacks it and
+        the parent sent no compiled code in its place, request the module
+        again, which the parent answers with its source, and return
+        :py:data:`None`.
+        """
+        fullname, digest = tup[0], tup[5]
+        cache = self._cache
+        if tup[3] is not None:
+            if cache:
+                cache.put(digest, tup[3])
+            return tup
+
+        compressed = cache and cache.get(digest)
+        if compressed is not None:
+            return tup[:3] + (compressed,) + tup[4:]
+        if len(tup) > 6 and tup[6] is not None and self._bytecode:
+            return tup
+
+        importer = self._importer
+        importer._lock.acquire()
+        try:
+            in_flight = fullname in importer._callbacks
+        finally:
+            importer._lock.release()
+        LOG.debug('%r: cache miss for %r, requesting source', self, fullname)
+        if in_flight:
+            importer._context.send(mitogen.core.Message(
+                data=fullname,
+                handle=mitogen.core.GET_MODULE,
+            ))
+
+    def get_code(self, tup):
+        """
+        Return the code object carried by the :py:data:`LOAD_MODULE` tuple
+        `tup`, or :py:data:`None` if it has none.
+        """
+        if len(tup) > 6 and tup[6] is not None and self._bytecode:
+            # The parent only sends code compiled by a matching interpreter.
+            return marshal.loads(zlib.decompress(tup[6]))
+
+    def request_source(self, fullname, callback):
+        """
+        Like :py:meth:`mitogen.core.Importer._request_module`, but if the
+        parent sent only compiled code for `fullname`, request it again, which
+        the parent answers with its source, before running `callback`.
+        """
+        importer = self._importer
+
+        def on_module():
+            importer._lock.acquire()
+            try:
+                tup = importer._cache[fullname]
+                refetch = tup[2] is not None and tup[3] is None
+                if refetch:
+                    funcs = importer._callbacks.get(fullname)
+                    if funcs is not None:
+                        funcs.append(callback)
+                    else:
+                        importer._callbacks[fullname] = [callback]
+                        importer._context.send(mitogen.core.Message(
+                            data=fullname,
+                            handle=mitogen.core.GET_MODULE,
+                        ))
+            finally:
+                importer._lock.release()
+
+            if not refetch:
+                callback()
+
+        importer._request_module(fullname, on_module)
+
+    def fetch_source(self, fullname):
+        """
+        Fetch the source of `fullname`, for which the parent sent only
+        compiled code, waiting up to :py:attr:`get_source_timeout` seconds.
+        Return its updated :py:data:`LOAD_MODULE` tuple, or :py:data:`None`
+        if the source did not arrive. Failures are remembered, so formatting a
+        traceback that names many such modules does not wait for each every
+        time.
+        """
+        importer = self._importer
+        broker = importer._router.broker
+        if (fullname in self._no_source
+                or broker._thread == threading.currentThread()):
+            # Never wait for the broker on its own thread.
+            return None
+
+        latch = mitogen.core.Latch()
+        importer._lock.acquire()
+        try:
+            if not self._dead:
+                self._latches.append(latch)
+        finally:
+            importer._lock.release()
+
+        def on_source():
+            try:
+                latch.put(None)
+            except mitogen.core.LatchError:
+                pass  # Gave up waiting.
+
+        tup = None
+        if not self._dead:
+            self.request_source(fullname, on_source)
+            try:
+                latch.get(timeout=self.get_source_timeout)
+                tup = importer._cache[fullname]
+            except (mitogen.core.TimeoutError, mitogen.core.LatchError):
+                LOG.debug('%r: source for %r unavailable', self, fullname)
+
+        importer._lock.acquire()
+        try:
+            if latch in self._latches:
+                self._latches.remove(latch)
+        finally:
+            importer._lock.release()
+        latch.close()
+
+        if tup is None or tup[3] is None:
+            self._no_source.add(fullname)
+            return None
+        return tup
+
+
+def on_cached_modules(router, msg):
+    """
+    Record the prefixes of module source digests a child announced in a
+    :py:data:`mitogen.core.CACHED_MODULES` message.
+    """
+    if msg.is_dead:
+        return
+    stream = router.stream_by_id(msg.src_id)
+    data = msg.data
+    stream.cached_modules.update(data[i:i + 8]
+                                 for i in range(0, len(data), 8))
+
+
+def on_code_magic(router, msg):
+    """
+    Record the bytecode magic a child announced in a
+    :py:data:`mitogen.core.CODE_MAGIC` message.
+    """
+    if msg.is_dead:
+        return
+    router.stream_by_id(msg.src_id).code_magic = msg.data
+
+
+def select_code(stream, tup, code=None):
+    """
+    Return the :py:data:`mitogen.core.LOAD_MODULE` tuple `tup` with the
+    compressed, marshalled `code` compiled by this interpreter appended, or
+    lacking any code if the child on `stream` did not announce a matching
+    bytecode magic. If `code` is :py:data:`None`, any code already present in
+    `tup` is kept, as it must have been compiled by a matching interpreter for
+    it to have been received.
+    """
+    if len(tup) < 6:
+        return tup
+    if stream.code_magic != imp.get_magic():
+        return tup[:6]
+    if code is None:
+        return tup
+    return tup[:6] + (code,)
+
+
+def omit_cached_source(stream, tup):
+    """
+    Return the :py:data:`mitogen.core.LOAD_MODULE` tuple `tup`, or a copy
+    lacking its source if the child on `stream` announced the source as
+    cached, and the module was not sent on `stream` before. A repeated request
+    means the child could not use its cached copy, so receives the source.
+    """
+    if (len(tup) > 5 and tup[3] is not None
+            and tup[5][:8] in stream.cached_modules
+            and tup[0] not in stream.sent_modules):
+        return tup[:3] + (None,) + tup[4:]
+    return tup
+
+
+def omit_compiled_source(stream, tup):
+    """
+    Return the :py:data:`mitogen.core.LOAD_MODULE` tuple `tup`, or a copy
+    lacking its source if it carries compiled code, and the module was not
+    sent on `stream` before. A repeated request means the child needs the
+    source, for example to forward it to a child of its own, so receives it.
+    """
+    if (len(tup) > 6 and tup[3] is not None and tup[6] is not None
+            and tup[0] not in stream.sent_modules):
+        return tup[:3] + (None,) + tup[4:]
+    return tup
+
+
+def prepare_tuple(stream, tup, code=None):
+    """
+    Return the :py:data:`mitogen.core.LOAD_MODULE` tuple `tup` as it should be
+    sent to the child on `stream`, given the cached sources and bytecode
+    magic it announced, with `code` as for :py:func:`select_code`.
+    """
+    tup = omit_cached_source(stream, tup)
+    return omit_compiled_source(stream, select_code(stream, tup, code))
@@ -29,6 +29,7 @@
 import errno
 import fcntl
 import getpass
+import imp
 import inspect
 import logging
 import os
@@ -40,7 +41,6 @@ import sys
 import termios
 import textwrap
 import threading
-import time
 import types
 import zlib
 
@@ -99,6 +99,54 @@ def is_immediate_child(msg, stream):
     return msg.src_id == stream.remote_id
 
 
+#: Most bundles kept by :py:func:`make_load_module_msgs` in its `cache`.
+MAX_CACHED_BUNDLES = 64
+
+
+def make_load_module_msgs(stream, tups, dst_id, cache=None):
+    """
+    Return a list of messages carrying the :py:data:`mitogen.core.LOAD_MODULE`
+    tuples `tups` to `dst_id` via `stream`. If there are several and
+    :py:attr:`mitogen.core.Stream.bundle_modules` is set, this is one
+    :py:data:`mitogen.core.LOAD_MODULES` message compressing their source
+    together, which related modules share much of, otherwise one
+    :py:data:`mitogen.core.LOAD_MODULE` message per tuple.
+
+    :param dict cache:
+        If not :py:data:`None`, dict in which to keep compressed bundles, to
+        be reused for identical bundles sent to further contexts. The caller
+        must always pass the same tuple for a module name.
+    """
+    if len(tups) < 2 or not stream.bundle_modules:
+        return [
+            mitogen.core.Message.pickled(tup, dst_id=dst_id,
+                                         handle=mitogen.core.LOAD_MODULE)
+            for tup in tups
+        ]
+
+    # Tuples for a name differ only by omitted source or present code.
+    key = tuple((tup[0], tup[3] is None, len(tup) > 6) for tup in tups)
+    data = None
+    if cache is not None:
+        data = cache.get(key)
+    if data is None:
+        bundle = []
+        for tup in tups:
+            if tup[3] is not None:
+                tup = tup[:3] + (zlib.decompress(tup[3]),) + tup[4:]
+            if len(tup) > 6 and tup[6] is not None:
+                tup = tup[:6] + (zlib.decompress(tup[6]),)
+            bundle.append(tup)
+        data = zlib.compress(mitogen.core.Message.pickled(bundle).data)
+        if cache is not None:
+            if len(cache) >= MAX_CACHED_BUNDLES:
+                cache.clear()
+            cache[key] = data
+
+    return [mitogen.core.Message(data=data, dst_id=dst_id,
+                                 handle=mitogen.core.LOAD_MODULES)]
+
+
 @lru_cache()
 def minimize_source(source):
     """Remove most comments and docstrings from Python source code.
@@ -364,7 +412,7 @@ def write_all(fd, s, deadline=None):
 
     while written < len(s):
         if deadline is not None:
-            timeout = max(0, deadline - time.time())
+            timeout = max(0, deadline - mitogen.core.now())
         if timeout == 0:
             raise mitogen.core.TimeoutError('write timed out')
 
@@ -386,7 +434,7 @@ def iter_read(fds, deadline=None):
 
     while fds:
         if deadline is not None:
-            timeout = max(0, deadline - time.time())
+            timeout = max(0, deadline - mitogen.core.now())
             if timeout == 0:
                 break
 
@@ -480,6 +528,114 @@ def _proxy_connect(name, method_name, kwargs, econtext):
     }
 
 
+class PollPoller(mitogen.core.Poller):
+    """
+    Poller based on the POSIX :py:func:`select.poll` interface. Its cost is
+    still linear in the number of descriptors, but it is not limited by
+    ``FD_SETSIZE``.
+    """
+    def __init__(self):
+        super(PollPoller, self).__init__()
+        self._pollobj = select.poll()
+
+    def _update(self, fd):
+        mask = (((fd in self._rfds) and select.POLLIN)
+                | ((fd in self._wfds) and select.POLLOUT))
+        if mask:
+            self._pollobj.register(fd, mask)
+        else:
+            try:
+                self._pollobj.unregister(fd)
+            except KeyError:
+                pass
+
+    def _poll(self, timeout):
+        if timeout is not None:
+            timeout *= 1000
+
+        events, _ = mitogen.core.io_op(self._pollobj.poll, timeout)
+        for fd, event in events:
+            if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                mitogen.core._vv and IOLOG.debug('%r: POLLIN: %r', self, fd)
+                data, gen = self._rfds.get(fd, (None, None))
+                if gen and gen < self._generation:
+                    yield data
+            if event & (select.POLLOUT | select.POLLHUP | select.POLLERR):
+                mitogen.core._vv and IOLOG.debug('%r: POLLOUT: %r', self, fd)
+                data, gen = self._wfds.get(fd, (None, None))
+                if gen and gen < self._generation:
+                    yield data
+
+
+class EpollPoller(mitogen.core.Poller):
+    """
+    Poller based on the Linux :py:func:`select.epoll` interface. Interest is
+    registered with the kernel as it changes, so the cost of each wakeup is
+    proportional only to the number of ready descriptors. Level-triggered
+    mode is used, matching the semantics of the other pollers.
+    """
+    def __init__(self):
+        super(EpollPoller, self).__init__()
+        self._epoll = select.epoll(32)
+        #: fd -> event mask currently registered with the kernel.
+        self._registered = {}
+
+    def close(self):
+        self._epoll.close()
+
+    def _update(self, fd):
+        mask = (((fd in self._rfds) and select.EPOLLIN)
+                | ((fd in self._wfds) and select.EPOLLOUT))
+        current = self._registered.get(fd, 0)
+        if mask == current:
+            return
+
+        try:
+            if not mask:
+                del self._registered[fd]
+                self._epoll.unregister(fd)
+            elif not current:
+                self._epoll.register(fd, mask)
+                self._registered[fd] = mask
+            else:
+                self._registered[fd] = mask
+                self._epoll.modify(fd, mask)
+        except (IOError, OSError):
+            e = sys.exc_info()[1]
+            if e.args[0] == errno.ENOENT and mask:
+                # The descriptor was closed and reopened without first being
+                # unregistered, so the kernel has already forgotten it.
+                self._epoll.register(fd, mask)
+            elif e.args[0] not in (errno.EBADF, errno.ENOENT):
+                raise
+
+    def _poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+
+        events, _ = mitogen.core.io_op(self._epoll.poll, timeout)
+        for fd, event in events:
+            if event & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                mitogen.core._vv and IOLOG.debug('%r: POLLIN: %r', self, fd)
+                data, gen = self._rfds.get(fd, (None, None))
+                if gen and gen < self._generation:
+                    yield data
+            if event & (select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR):
+                mitogen.core._vv and IOLOG.debug('%r: POLLOUT: %r', self, fd)
+                data, gen = self._wfds.get(fd, (None, None))
+                if gen and gen < self._generation:
+                    yield data
+
+
+if hasattr(select, 'epoll'):
+    PREFERRED_POLLER = EpollPoller
+elif hasattr(select, 'poll') and sys.platform != 'darwin':
+    # poll() is broken for TTYs and some pipes on OS X.
+    PREFERRED_POLLER = PollPoller
+else:
+    PREFERRED_POLLER = mitogen.core.Poller
+
+
 class TtyLogStream(mitogen.core.BasicStream):
     """
     For "hybrid TTY/socketpair" mode, after a connection has been setup, a
@@ -520,8 +676,9 @@ class Stream(mitogen.core.Stream):
     #: Maximum time to wait for a connection attempt.
     connect_timeout = 30.0
 
-    #: Derived from :py:attr:`connect_timeout`; absolute floating point
-    #: UNIX timestamp after which the connection attempt should be abandoned.
+    #: Derived from :py:attr:`connect_timeout`; time as returned by
+    #: :py:func:`mitogen.core.now` after which the connection attempt should
+    #: be abandoned.
     connect_deadline = None
 
     #: True to cause context to write verbose /tmp/mitogen.<pid>.log.
@@ -530,6 +687,31 @@ class Stream(mitogen.core.Stream):
     #: True to cause context to write /tmp/mitogen.stats.<pid>.<thread>.log.
     profiling = False
 
+    #: True to compress all messages exchanged with the context, see
+    #: :py:meth:`mitogen.core.Stream.enable_compression`.
+    compress = False
+
+    #: String with which to prime compression, or :py:data:`None`.
+    compress_prime = None
+
+    #: True to let calls, module loading and logging exchanged with the
+    #: context overtake bulk messages queued earlier, see
+    #: :py:attr:`mitogen.core.Stream.priority_lanes`.
+    priority_lanes = False
+
+    #: Directory in which the context caches module source, see
+    #: :py:class:`mitogen.module_cache.ModuleCache`, or :py:data:`None`.
+    module_cache = None
+
+    #: True to send the context compiled code in place of module source, if its
+    #: interpreter's bytecode magic matches ours.
+    bytecode = False
+
+    #: True to send the context every module a function it is asked to call
+    #: depends on, ahead of the call, see
+    #: :py:meth:`mitogen.master.ModuleResponder.preload`.
+    preload_modules = False
+
     #: Set to the child's PID by connect().
     pid = None
 
@@ -546,6 +728,8 @@ class Stream(mitogen.core.Stream):
 
     def construct(self, max_message_size, remote_name=None, python_path=None,
                   debug=False, connect_timeout=None, profiling=False,
+                  compress=False, compress_prime=None, priority_lanes=False,
+                  module_cache=None, bytecode=False, preload_modules=False,
                   old_router=None, **kwargs):
         """Get the named context running on the local machine, creating it if
         it does not exist."""
@@ -568,8 +752,17 @@ class Stream(mitogen.core.Stream):
         self.remote_name = remote_name
         self.debug = debug
         self.profiling = profiling
+        self.compress = compress
+        self.compress_prime = compress_prime
+        self.priority_lanes = priority_lanes
+        self.module_cache = module_cache
+        self.bytecode = bytecode
+        if module_cache or bytecode:
+            # Needed by handlers on the broker thread, which cannot import.
+            __import__('mitogen.module_cache')
+        self.preload_modules = preload_modules
         self.max_message_size = max_message_size
-        self.connect_deadline = time.time() + self.connect_timeout
+        self.connect_deadline = mitogen.core.now() + self.connect_timeout
 
     def on_shutdown(self, broker):
         """Request the slave gracefully shut itself down."""
@@ -626,8 +819,11 @@ class Stream(mitogen.core.Stream):
     # file descriptor 0 as 100, creates a pipe, then execs a new interpreter
     # with a custom argv.
     #   * Optimized for minimum byte count after minification & compression.
-    #   * 'CONTEXT_NAME', 'PREAMBLE_COMPRESSED_LEN', and 'PREAMBLE_LEN' are
-    #     substituted with their respective values.
+    #   * 'CONTEXT_NAME' and 'PREAMBLE_COMPRESSED_LEN' are substituted with
+    #     their respective values.
+    #   * The preamble is written compressed to the second pipe, since the
+    #     new interpreter reaps the first stage before reading it, so it must
+    #     fit in the pipe's buffer.
     #   * CONTEXT_NAME must be prefixed with the name of the Python binary in
     #     order to allow virtualenvs to detect their install prefix.
     @staticmethod
@@ -645,9 +841,9 @@ class Stream(mitogen.core.Stream):
             os.environ['ARGV0']=sys.executable
             os.execl(sys.executable,sys.executable+'(mitogen:CONTEXT_NAME)')
         os.write(1,'EC0\n')
-        C=_(os.fdopen(0,'rb').read(PREAMBLE_COMPRESSED_LEN),'zip')
-        os.fdopen(W,'w',0).write(C)
-        os.fdopen(w,'w',0).write('PREAMBLE_LEN\n'+C)
+        C=os.fdopen(0,'rb').read(PREAMBLE_COMPRESSED_LEN)
+        os.fdopen(W,'w',0).write(_(C,'zip'))
+        os.fdopen(w,'w',0).write('PREAMBLE_COMPRESSED_LEN\n'+C)
         os.write(1,'EC1\n')
 
     def get_boot_command(self):
@@ -658,8 +854,6 @@ class Stream(mitogen.core.Stream):
         preamble_compressed = self.get_preamble()
         source = source.replace('PREAMBLE_COMPRESSED_LEN',
                                 str(len(preamble_compressed)))
-        source = source.replace('PREAMBLE_LEN',
-                                str(len(zlib.decompress(preamble_compressed))))
         encoded = zlib.compress(source, 9).encode('base64').replace('\n', '')
         # We can't use bytes.decode() in 3.x since it was restricted to always
         # return unicode, so codecs.decode() is used instead. In 3.x
@@ -685,6 +879,11 @@ class Stream(mitogen.core.Stream):
             'whitelist': self._router.get_module_whitelist(),
             'blacklist': self._router.get_module_blacklist(),
             'max_message_size': self.max_message_size,
+            'compress': self.compress,
+            'compress_prime': self.compress_prime,
+            'priority_lanes': self.priority_lanes,
+            'module_cache': self.module_cache,
+            'bytecode': self.bytecode,
         }
 
     def get_preamble(self):
@@ -720,14 +919,16 @@ class Stream(mitogen.core.Stream):
         except Exception:
             self._reap_child()
             raise
+        if self.compress:
+            self.enable_compression(self.compress_prime)
 
     def _ec0_received(self):
         LOG.debug('%r._ec0_received()', self)
         write_all(self.transmit_side.fd, self.get_preamble())
-        discard_until(self.receive_side.fd, 'EC1\n', time.time() + 10.0)
+        discard_until(self.receive_side.fd, 'EC1\n', mitogen.core.now() + 10.0)
 
     def _connect_bootstrap(self, extra_fd):
-        deadline = time.time() + self.connect_timeout
+        deadline = mitogen.core.now() + self.connect_timeout
         discard_until(self.receive_side.fd, 'EC0\n', deadline)
         self._ec0_received()
 
@@ -911,8 +1112,7 @@ class Router(mitogen.core.Router):
         self.route_monitor = RouteMonitor(self, parent)
 
     def stream_by_id(self, dst_id):
-        return self._stream_by_id.get(dst_id,
-            self._stream_by_id.get(mitogen.parent_id))
+        return self._stream_by_id.get(dst_id, self._parent_stream)
 
     def add_route(self, target_id, stream):
         LOG.debug('%r.add_route(%r, %r)', self, target_id, stream)
@@ -920,6 +1120,7 @@ class Router(mitogen.core.Router):
         assert isinstance(stream, Stream)
         try:
             self._stream_by_id[target_id] = stream
+            self._on_routes_changed()
         except KeyError:
             LOG.error('%r: cant add route to %r via %r: no such stream',
                       self, target_id, stream)
@@ -928,6 +1129,7 @@ class Router(mitogen.core.Router):
         LOG.debug('%r.del_route(%r)', self, target_id)
         try:
             del self._stream_by_id[target_id]
+            self._on_routes_changed()
         except KeyError:
             LOG.error('%r: cant delete route to %r: no such stream',
                       self, target_id)
@@ -1043,12 +1245,25 @@ class ModuleForwarder(object):
         self.router = router
         self.parent_context = parent_context
         self.importer = importer
+        self._bundle_cache = {}
         router.add_handler(
             fn=self._on_get_module,
             handle=mitogen.core.GET_MODULE,
             persist=True,
             policy=is_immediate_child,
         )
+        router.add_handler(
+            fn=lambda msg: mitogen.module_cache.on_cached_modules(router, msg),
+            handle=mitogen.core.CACHED_MODULES,
+            persist=True,
+            policy=is_immediate_child,
+        )
+        router.add_handler(
+            fn=lambda msg: mitogen.module_cache.on_code_magic(router, msg),
+            handle=mitogen.core.CODE_MAGIC,
+            persist=True,
+            policy=is_immediate_child,
+        )
 
     def __repr__(self):
         return 'ModuleForwarder(%r)' % (self.router,)
@@ -1060,19 +1275,32 @@ class ModuleForwarder(object):
 
         fullname = msg.data
         callback = lambda: self._on_cache_callback(msg, fullname)
-        self.importer._request_module(fullname, callback)
-
-    def _send_one_module(self, msg, tup):
-        self.router._async_route(
-            mitogen.core.Message.pickled(
-                tup,
-                dst_id=msg.src_id,
-                handle=mitogen.core.LOAD_MODULE,
-            )
-        )
+        stream = self.router.stream_by_id(msg.src_id)
+        resolver = self.importer._resolver
+        if resolver and self._needs_source(stream, fullname):
+            resolver.request_source(fullname, callback)
+        else:
+            self.importer._request_module(fullname, callback)
+
+    def _needs_source(self, stream, fullname):
+        # A child that cannot run our compiled code, or that repeats a
+        # request, must receive source even if our parent sent only code.
+        return (fullname in stream.sent_modules
+                or stream.code_magic != imp.get_magic())
+
+    def _prepare_tuple(self, stream, tup):
+        if stream.cached_modules or stream.code_magic:
+            # Only then may the child's options have imported it.
+            tup = mitogen.module_cache.prepare_tuple(stream, tup)
+        else:
+            tup = tup[:6]
+        stream.sent_modules.add(tup[0])
+        return tup
 
     def _on_cache_callback(self, msg, fullname):
         LOG.debug('%r._on_get_module(): sending %r', self, fullname)
+        stream = self.router.stream_by_id(msg.src_id)
+        tups = []
         tup = self.importer._cache[fullname]
         if tup is not None:
             for related in tup[4]:
@@ -1081,6 +1309,13 @@ class ModuleForwarder(object):
                     LOG.debug('%r._on_get_module(): skipping absent %r',
                                self, related)
                     continue
-                self._send_one_module(msg, rtup)
+                if rtup[3] is None and self._needs_source(stream, related):
+                    LOG.debug('%r._on_get_module(): skipping sourceless %r',
+                              self, related)
+                    continue
+                tups.append(self._prepare_tuple(stream, rtup))
 
-        self._send_one_module(msg, tup)
+        tups.append(self._prepare_tuple(stream, tup))
+        for load_msg in make_load_module_msgs(stream, tups, msg.src_id,
+                                              self._bundle_cache):
+            self.router._async_route(load_msg)
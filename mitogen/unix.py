@@ -45,6 +45,13 @@ import mitogen.master
 
 from mitogen.core import LOG
 
+#: Handshake sent by a connecting client: its PID.
+HELLO = struct.Struct('>L')
+
+#: Handshake reply from the listener: the client's allocated context ID, the
+#: listener's context ID and its PID.
+WELCOME = struct.Struct('>LLL')
+
 
 def is_path_dead(path):
     s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
@@ -81,7 +88,7 @@ class Listener(mitogen.core.BasicStream):
     def on_receive(self, broker):
         sock, _ = self._sock.accept()
         sock.setblocking(True)
-        pid, = struct.unpack('>L', sock.recv(4))
+        pid, = HELLO.unpack(sock.recv(HELLO.size))
 
         context_id = self._router.id_allocator.allocate()
         context = mitogen.parent.Context(self._router, context_id)
@@ -90,8 +97,7 @@ class Listener(mitogen.core.BasicStream):
         stream.name = 'unix_client.%d' % (pid,)
         stream.auth_id = mitogen.context_id
         self._router.register(context, stream)
-        sock.send(struct.pack('>LLL', context_id, mitogen.context_id,
-                              os.getpid()))
+        sock.send(WELCOME.pack(context_id, mitogen.context_id, os.getpid()))
         sock.close()
 
 
@@ -99,8 +105,10 @@ def connect(path, broker=None):
     LOG.debug('unix.connect(path=%r)', path)
     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     sock.connect(path)
-    sock.send(struct.pack('>L', os.getpid()))
-    mitogen.context_id, remote_id, pid = struct.unpack('>LLL', sock.recv(12))
+    sock.send(HELLO.pack(os.getpid()))
+    mitogen.context_id, remote_id, pid = WELCOME.unpack(
+        sock.recv(WELCOME.size)
+    )
     mitogen.parent_id = remote_id
     mitogen.parent_ids = [remote_id]
 
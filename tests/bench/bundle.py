@@ -0,0 +1,73 @@
+"""
+Count messages and bytes of module source sent to a new child that imports a
+package, with related modules sent as one LOAD_MODULES bundle per request, and
+as one LOAD_MODULE message each. The module defaults to docker, whose imports
+span several top-level packages. Usage: bundle.py [module]
+"""
+
+import sys
+import time
+
+import mitogen.core
+import mitogen.master
+
+
+def import_module(name):
+    __import__(name)
+
+
+def count_from(router, context, counts):
+    # Tally module messages routed to the child, and their size.
+    async_route = router._async_route
+
+    def _async_route(msg, *args):
+        if (msg.dst_id == context.context_id
+                and msg.handle in (mitogen.core.LOAD_MODULE,
+                                   mitogen.core.LOAD_MODULES)):
+            counts[0] += 1
+            counts[1] += len(msg.data)
+        return async_route(msg, *args)
+    router._async_route = _async_route
+
+
+def measure(router, name):
+    context = router.local()
+    counts = [0, 0]
+    count_from(router, context, counts)
+    try:
+        t0 = time.time()
+        context.call(import_module, name)
+        elapsed = time.time() - t0
+    finally:
+        del router._async_route
+    context.shutdown(wait=True)
+    return counts[0], counts[1], elapsed
+
+
+def main():
+    name = 'docker'
+    if len(sys.argv) > 1:
+        name = sys.argv[1]
+    __import__(name)
+
+    broker = mitogen.master.Broker()
+    router = mitogen.master.Router(broker)
+    # Force the child to import the package from us, even if it is installed.
+    router.responder.whitelist_prefix('__main__')
+    router.responder.whitelist_prefix(name.partition('.')[0])
+    try:
+        # Warm the responder's cache, so only the messages differ.
+        measure(router, name)
+        for mode, bundle in ('separate', False), ('bundled', True):
+            mitogen.core.Stream.bundle_modules = bundle
+            msgs, size, elapsed = measure(router, name)
+            print '%-8s %4d messages  %8d bytes  %7.2f ms' % (
+                mode, msgs, size, 1000 * elapsed,
+            )
+    finally:
+        broker.shutdown()
+        broker.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Measure time, child CPU time and bytes sent while a new child imports a
+synthetic package of 300 modules, sending module source, and sending compiled
+code in its place. Usage: bytecode.py [count]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import mitogen.core
+import mitogen.master
+
+
+MODULE = '''
+"""
+Synthetic module %(i)d, resembling a typical library module.
+"""
+
+import os
+import sys
+
+
+class Thing%(i)d(object):
+    """A class with a few methods."""
+
+    def __init__(self, name, value=None):
+        self.name = name
+        self.value = value
+
+    def __repr__(self):
+        return 'Thing%(i)d(%%r, %%r)' %% (self.name, self.value)
+
+    def update(self, **kwargs):
+        for key, value in kwargs.items():
+            if key.startswith('_'):
+                raise ValueError('bad key: %%r' %% (key,))
+            setattr(self, key, value)
+        return self
+
+'''
+
+FUNC = '''
+def func_%(i)d_%(j)d(arg, *args, **kwargs):
+    """Return a value derived from `arg`."""
+    result = []
+    for item in args:
+        if isinstance(item, dict):
+            result.extend(sorted(item.items()))
+        elif item is None:
+            continue
+        else:
+            result.append(os.path.join(str(arg), str(item)))
+    try:
+        result.append(kwargs.pop('extra', %(j)d))
+    except KeyError:
+        pass
+    return [x for x in result if x], len(result), sys.maxsize
+'''
+
+
+def make_package(path, count):
+    # bytecodebench_all imports every module of bytecodebench_pkg.
+    pkg_path = os.path.join(path, 'bytecodebench_pkg')
+    os.mkdir(pkg_path)
+    open(os.path.join(pkg_path, '__init__.py'), 'w').close()
+    names = ['mod%d' % (i,) for i in range(count)]
+    fp = open(os.path.join(path, 'bytecodebench_all.py'), 'w')
+    fp.write(''.join('import bytecodebench_pkg.%s\n' % (name,)
+                     for name in names))
+    fp.write('def ping():\n    return True\n')
+    fp.close()
+
+    for i, name in enumerate(names):
+        fp = open(os.path.join(pkg_path, name + '.py'), 'w')
+        fp.write(MODULE % {'i': i})
+        for j in range(20):
+            fp.write(FUNC % {'i': i, 'j': j})
+        fp.close()
+
+
+def cpu_time():
+    return sum(os.times()[:2])
+
+
+def measure(router, **kwargs):
+    import bytecodebench_all
+    context = router.local(**kwargs)
+    cpu0 = context.call(cpu_time)
+    t0 = time.time()
+    context.call(bytecodebench_all.ping)
+    elapsed = time.time() - t0
+    cpu = context.call(cpu_time) - cpu0
+    stream = router.stream_by_id(context.context_id)
+    tx_bytes = stream.tx_bytes
+    context.shutdown(wait=True)
+    return elapsed, cpu, tx_bytes
+
+
+def main():
+    count = 300
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    tmp = tempfile.mkdtemp()
+    broker = mitogen.master.Broker()
+    router = mitogen.master.Router(broker)
+    try:
+        make_package(tmp, count)
+        sys.path.insert(0, tmp)
+        # Warm the responder's caches, so only the child's work differs.
+        measure(router, bytecode=True)
+        for name, bytecode in ('source', False), ('bytecode', True):
+            elapsed, cpu, tx_bytes = measure(router, bytecode=bytecode)
+            print '%-8s %8d bytes  %7.2f ms  child cpu %7.2f ms' % (
+                name, tx_bytes, 1000 * elapsed, 1000 * cpu,
+            )
+    finally:
+        broker.shutdown()
+        broker.join()
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Measure encoding and decoding of typical message payloads with pickle, as
+Message.pickled() and Message.unpickle() use it, marshal, and a compact codec
+written in Python, along with the size of each encoding. This is the
+measurement behind keeping pickle for message payloads.
+Usage: codec.py [count]
+"""
+
+import cPickle
+import marshal
+import struct
+import sys
+import time
+
+import mitogen.core
+
+
+# A CALL_FUNCTION request, and a result shaped like an Ansible module's.
+PAYLOADS = [
+    ('call', ('ansible_mitogen.target', None, 'run_module',
+              (u'/tmp/ansible_xyz/setup',), {'kwargs': {u'filter': u'*'}})),
+    ('result', {
+        u'changed': False,
+        u'rc': 0,
+        u'stdout': u'x' * 200,
+        u'stdout_lines': [u'line %d' % (i,) for i in range(20)],
+        u'invocation': {u'module_args': {u'path': u'/etc/hosts',
+                                         u'state': u'file',
+                                         u'follow': True,
+                                         u'mode': None}},
+        u'ansible_facts': dict((u'fact_%d' % (i,), i * 1.5)
+                               for i in range(20)),
+    }),
+]
+
+
+_pack_len = struct.Struct('>L').pack
+_unpack_len = struct.Struct('>L').unpack_from
+
+
+def encode(obj, out):
+    """
+    Append the compact encoding of `obj` to the list `out`: a one byte tag,
+    then a length or value. Covers the types found in message payloads.
+    """
+    if obj is None:
+        out.append('N')
+    elif obj is True:
+        out.append('T')
+    elif obj is False:
+        out.append('F')
+    elif isinstance(obj, (int, long)):
+        s = str(obj)
+        out.extend(('i', _pack_len(len(s)), s))
+    elif isinstance(obj, float):
+        out.extend(('f', struct.pack('>d', obj)))
+    elif isinstance(obj, str):
+        out.extend(('s', _pack_len(len(obj)), obj))
+    elif isinstance(obj, unicode):
+        s = obj.encode('utf-8')
+        out.extend(('u', _pack_len(len(s)), s))
+    elif isinstance(obj, (tuple, list)):
+        out.extend(('t' if isinstance(obj, tuple) else 'l',
+                    _pack_len(len(obj))))
+        for item in obj:
+            encode(item, out)
+    elif isinstance(obj, dict):
+        out.extend(('d', _pack_len(len(obj))))
+        for key, value in obj.iteritems():
+            encode(key, out)
+            encode(value, out)
+    else:
+        raise TypeError('cannot encode %r' % (type(obj),))
+
+
+def decode(s, i=0):
+    """
+    Return `(obj, end)` for the encoding starting at offset `i` of `s`.
+    """
+    tag = s[i]
+    i += 1
+    if tag == 'N':
+        return None, i
+    if tag == 'T':
+        return True, i
+    if tag == 'F':
+        return False, i
+    if tag == 'f':
+        return struct.unpack_from('>d', s, i)[0], i + 8
+    n, = _unpack_len(s, i)
+    i += 4
+    if tag == 'i':
+        return int(s[i:i + n]), i + n
+    if tag == 's':
+        return s[i:i + n], i + n
+    if tag == 'u':
+        return s[i:i + n].decode('utf-8'), i + n
+    if tag in 'tl':
+        items = []
+        for x in xrange(n):
+            item, i = decode(s, i)
+            items.append(item)
+        if tag == 't':
+            return tuple(items), i
+        return items, i
+    if tag == 'd':
+        dct = {}
+        for x in xrange(n):
+            key, i = decode(s, i)
+            dct[key], i = decode(s, i)
+        return dct, i
+    raise ValueError('bad tag %r' % (tag,))
+
+
+def dumps(obj):
+    out = []
+    encode(obj, out)
+    return ''.join(out)
+
+
+def loads(s):
+    return decode(s)[0]
+
+
+def loop(func, count):
+    t0 = time.time()
+    for x in xrange(count):
+        func()
+    return 1e6 * (time.time() - t0) / count
+
+
+def main():
+    count = 20000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    Message = mitogen.core.Message
+    for name, obj in PAYLOADS:
+        codecs = [
+            ('pickle', lambda: Message.pickled(obj).data,
+             lambda s: Message(data=s).unpickle()),
+            ('cPickle', lambda: cPickle.dumps(obj, 2), cPickle.loads),
+            ('marshal', lambda: marshal.dumps(obj), marshal.loads),
+            ('python', lambda: dumps(obj), loads),
+        ]
+        for codec, enc, dec in codecs:
+            s = enc()
+            assert dec(s) == obj
+            print '%-7s %-8s %5d bytes  encode %7.2f usec  ' \
+                  'decode %7.2f usec' % (name, codec, len(s),
+                                         loop(enc, count),
+                                         loop(lambda: dec(s), count))
+
+
+if __name__ == '__main__':
+    main()
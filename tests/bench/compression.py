@@ -0,0 +1,188 @@
+"""
+Measure bytes on the wire and throughput of stream compression for a mix of
+messages resembling an Ansible run: calls, results, forwarded log records and
+module source. Usage: compression.py [rounds]
+"""
+
+import cPickle
+import sys
+import time
+import zlib
+
+import mitogen.core
+import mitogen.master
+import mitogen.utils
+
+
+# Strings common in pickled calls, results and log records of an Ansible run,
+# used to prime compression so that early messages compress well. Since nearer
+# matches are cheaper to encode, the most common strings appear last.
+PRIMER = ''.join([
+    'cmitogen.core\n_unpickle_call_error\n',
+    'cmitogen.core\n_unpickle_context\n',
+    'cmitogen.core\n_unpickle_sender\n',
+    'Traceback (most recent call last):\n  File "',
+    '\x00\x14\x00mitogen\x00',
+    '\x80\x02(NU\x16ansible_mitogen.targetq\x01N',
+] + [
+    # SHORT_BINSTRING, as produced by pickle protocol 2.
+    'U%s%sq' % (chr(len(word)), word)
+    for word in (
+        'ansible_facts', 'warnings', 'deprecations', 'skipped', 'diff',
+        'results', 'cmd', 'start', 'end', 'delta', 'env', 'args',
+        'module_name', '_raw_params', '_ansible_check_mode',
+        '_ansible_no_log', '_ansible_verbosity', '_ansible_diff',
+        'module_args', 'invocation', 'stdout_lines', 'stderr_lines',
+        'kwargs', 'run_module', 'msg', 'rc', 'stderr', 'stdout', 'failed',
+        'changed',
+    )
+])
+
+
+def call(i):
+    return mitogen.core.Message.pickled(
+        ('ansible_mitogen.target', None, 'run_module', (), {
+            'kwargs': {
+                'module_name': 'ansible.modules.commands.command',
+                'module_args': {'_raw_params': 'echo %d' % (i,),
+                                '_ansible_check_mode': False,
+                                '_ansible_no_log': False,
+                                '_ansible_verbosity': 0},
+                'env': {},
+            },
+        }),
+        handle=mitogen.core.CALL_FUNCTION, dst_id=1,
+    )
+
+
+def result(i):
+    stdout = 'line %d\n' % (i,) * 5
+    return mitogen.core.Message.pickled({
+        'changed': True, 'rc': 0, 'failed': False, 'cmd': ['echo', str(i)],
+        'start': '2018-04-01 12:00:00.%06d' % (i,),
+        'end': '2018-04-01 12:00:00.%06d' % (i + 1,), 'delta': '0:00:00.001',
+        'stdout': stdout, 'stderr': '', 'stdout_lines': stdout.splitlines(),
+        'stderr_lines': [], 'invocation': {'module_args': {}}, 'msg': '',
+    }, handle=1000, dst_id=0)
+
+
+def log(i):
+    return mitogen.core.Message(
+        data='ansible_mitogen.runner\x0010\x00Running module %d' % (i,),
+        handle=mitogen.core.FORWARD_LOG, dst_id=0,
+    )
+
+
+def module():
+    source = open(mitogen.master.__file__.rstrip('c')).read()
+    return mitogen.core.Message.pickled(
+        ('mitogen.master', None, 'mitogen/master.py',
+         zlib.compress(source, 9), []),
+        handle=mitogen.core.LOAD_MODULE, dst_id=1,
+    )
+
+
+def mix(rounds):
+    msgs = [module()]
+    for i in xrange(rounds):
+        msgs += [call(i), log(i), log(i), result(i)]
+    return msgs
+
+
+class Side(object):
+    fd = 0
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, s):
+        if isinstance(s, memoryview):
+            s = s.tobytes()
+        self.written.append(s)
+        return len(s)
+
+    def read(self, n=None):
+        return self.written.pop(0)
+
+    def readinto(self, buf, offset):
+        s = self.read()
+        buf[offset:offset + len(s)] = s
+        return len(s)
+
+
+class Router(object):
+    max_message_size = 128 * 1048576
+    broker = mitogen.core.Broker.__new__(mitogen.core.Broker)
+
+    def __init__(self):
+        self.count = 0
+
+    def _async_route(self, msg, stream=None):
+        self.count += 1
+
+    def _async_forward(self, *args):
+        return False
+
+
+Router.broker._start_transmit = Router.broker._stop_transmit = \
+    lambda stream: None
+
+
+def measure(msgs, compress, prime=None):
+    router = Router()
+    tx = mitogen.core.Stream(router, 1)
+    rx = mitogen.core.Stream(router, 1)
+    tx.transmit_side = rx.receive_side = Side()
+    if compress:
+        tx.enable_compression(prime)
+        rx.enable_compression(prime)
+
+    t0 = time.time()
+    wire = 0
+    for msg in msgs:
+        # Flush after every message: the worst case of no batching.
+        tx._send(msg)
+        while tx.pending_bytes():
+            tx.on_transmit(router.broker)
+        while tx.transmit_side.written:
+            wire += len(tx.transmit_side.written[0])
+            rx.on_receive(router.broker)
+    assert router.count == len(msgs)
+    return wire, len(msgs) / (time.time() - t0)
+
+
+def end_to_end(router, compress, count):
+    context = router.local(compress=compress)
+    t0 = time.time()
+    for i in xrange(count):
+        context.call(cPickle.loads, result(i).data)
+    return count / (time.time() - t0)
+
+
+@mitogen.utils.with_router
+def main(router):
+    rounds = 2000
+    if len(sys.argv) > 1:
+        rounds = int(sys.argv[1])
+
+    # Priming matters most for a new stream, so also measure the first few
+    # rounds alone. The cost of the primer itself is included.
+    for msgs in mix(rounds), mix(10)[1:]:
+        raw = sum(mitogen.core.Stream.HEADER_LEN + len(m.data) for m in msgs)
+        print '%d messages, %d bytes unframed' % (len(msgs), raw)
+        for name, compress, prime in (('off', False, None),
+                                      ('zlib', True, None),
+                                      ('zlib+prime', True, PRIMER)):
+            wire, rate = measure(msgs, compress, prime)
+            print '  %-10s %9d bytes on wire (%5.1f%%), %8.0f msgs/s' % (
+                name, wire, 100.0 * wire / raw, rate,
+            )
+
+    for compress in False, True:
+        print 'local round trip, compress=%-5s %6.0f calls/s' % (
+            compress, end_to_end(router, compress, rounds),
+        )
+
+
+if __name__ == '__main__':
+    main()
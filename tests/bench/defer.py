@@ -0,0 +1,67 @@
+"""
+Measure cross-thread Broker.defer() throughput from 1, 4 and 16 producer
+threads. Usage: defer.py [calls_per_thread]
+"""
+
+import sys
+import threading
+import time
+
+import mitogen.core
+
+
+def noop():
+    pass
+
+
+def produce(broker, count):
+    for x in xrange(count):
+        broker.defer(noop)
+
+
+def produce_many(broker, count):
+    calls = [(noop, (), {})] * 100
+    for x in xrange(count // 100):
+        broker.defer_many(calls)
+
+
+def measure(broker, target, nthreads, count):
+    threads = [
+        threading.Thread(target=target, args=(broker, count))
+        for x in xrange(nthreads)
+    ]
+    t0 = time.time()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    # Wait for the broker to run everything queued so far.
+    latch = mitogen.core.Latch()
+    broker.defer(latch.put, None)
+    latch.get()
+    return time.time() - t0
+
+
+def main():
+    count = 50000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    broker = mitogen.core.Broker()
+    try:
+        targets = [('defer', produce)]
+        if hasattr(broker, 'defer_many'):
+            targets.append(('defer_many', produce_many))
+        for name, target in targets:
+            for nthreads in 1, 4, 16:
+                elapsed = measure(broker, target, nthreads, count)
+                print '%-10s %2d threads: %9.0f calls/s' % (
+                    name, nthreads, nthreads * count / elapsed,
+                )
+    finally:
+        broker.shutdown()
+        broker.join()
+
+
+if __name__ == '__main__':
+    main()
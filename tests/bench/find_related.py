@@ -0,0 +1,58 @@
+"""
+Measure time taken by ModuleFinder.find_related() in a fresh master, for a
+module with no dependency cache, a cold cache and a warm cache. The module
+defaults to ansible.module_utils.basic if Ansible is installed, otherwise
+docker. Usage: find_related.py [module]
+"""
+
+import shutil
+import sys
+import tempfile
+import time
+
+import mitogen.master
+
+
+def default_name():
+    try:
+        __import__('ansible.module_utils.basic')
+        return 'ansible.module_utils.basic'
+    except ImportError:
+        return 'docker'
+
+
+def measure(name, path=None):
+    # A new finder and cache object stand in for a new master process.
+    cache = None
+    if path is not None:
+        cache = mitogen.master.DependencyCache(path)
+    finder = mitogen.master.ModuleFinder(cache)
+    t0 = time.time()
+    related = finder.find_related(name)
+    elapsed = time.time() - t0
+    if cache is not None:
+        cache.save()
+    return elapsed, len(related)
+
+
+def main():
+    if len(sys.argv) > 1:
+        name = sys.argv[1]
+    else:
+        name = default_name()
+    __import__(name)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        for mode, path in [('no cache', None),
+                           ('cold cache', tmp),
+                           ('warm cache', tmp)]:
+            elapsed, count = measure(name, path)
+            print '%-10s %4d modules  %8.2f ms' % (mode, count,
+                                                   1000 * elapsed)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Measure message forwarding through intermediate contexts, by connecting
+master -> A -> B -> C and timing calls to, and bulk transfers from, C. Every
+message is relayed by A and B. Usage: forward.py [count]
+"""
+
+import sys
+import time
+
+import mitogen.core
+import mitogen.utils
+
+
+def ping():
+    pass
+
+
+def produce(sender, count, size):
+    s = ' ' * size
+    for x in xrange(count):
+        sender.send(s)
+    sender.close()
+
+
+def latency(context, count):
+    t0 = time.time()
+    for x in xrange(count):
+        context.call(ping)
+    return 1e6 * (time.time() - t0) / count
+
+
+def throughput(router, context, count, size):
+    recv = mitogen.core.Receiver(router)
+    t0 = time.time()
+    context.call_async(produce, recv.to_sender(), count, size)
+    for msg in recv:
+        pass
+    return count / (time.time() - t0)
+
+
+@mitogen.utils.with_router
+def main(router):
+    count = 20000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    a = router.local()
+    b = router.local(via=a)
+    c = router.local(via=b)
+    for context, name in (a, 'A'), (c, 'C'):
+        print '%s round trip: %8.1f usec' % (
+            name, latency(context, count // 10),
+        )
+    for size in 100, 10240, 131072, 1048576:
+        n = max(100, count * 100 // size)
+        print 'C -> master %6d byte msgs: %8.0f msgs/s' % (
+            size, throughput(router, c, n, size),
+        )
+
+
+if __name__ == '__main__':
+    main()
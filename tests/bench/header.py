@@ -0,0 +1,51 @@
+"""
+Measure frame header encoding and decoding, comparing a format string passed
+to each struct call with mitogen.core.HeaderCodec. Usage: header.py [count]
+"""
+
+import struct
+import sys
+import time
+
+import mitogen.core
+
+
+def measure(func, count):
+    t0 = time.time()
+    for x in xrange(count):
+        func()
+    return count / (time.time() - t0)
+
+
+def main():
+    count = 1000000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    codec = mitogen.core.HeaderCodec()
+    msg = mitogen.core.Message(dst_id=1, handle=100, data='x' * 64)
+    buf = bytearray(4096)
+    buf[100:100 + codec.size] = codec.encode(msg)
+    fmt = codec.fmt
+
+    tests = [
+        ('encode, format string', lambda: struct.pack(
+            fmt, msg.dst_id, msg.src_id, msg.auth_id, msg.handle,
+            msg.reply_to or 0, len(msg.data))),
+        ('encode, codec.pack', lambda: codec.pack(
+            msg.dst_id, msg.src_id, msg.auth_id, msg.handle,
+            msg.reply_to or 0, len(msg.data))),
+        ('encode, codec.encode', lambda: codec.encode(msg)),
+        ('decode, slice+unpack', lambda: struct.unpack(
+            fmt, str(buf[100:100 + codec.size]))),
+        ('decode, format string', lambda: struct.unpack_from(fmt, buf, 100)),
+        ('decode, codec.unpack', lambda: codec.unpack_from(buf, 100)),
+        ('decode, codec.decode_from', lambda: codec.decode_from(
+            buf, 100, max_message_size=1048576)),
+    ]
+    for name, func in tests:
+        print '%-28s %9.0f headers/s' % (name, measure(func, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Measure function call round trip time to a child while a bulk transfer to it
+saturates the stream, with and without the priority output lane.
+Usage: latency.py [bulk_mib]
+"""
+
+import sys
+import time
+
+import mitogen.core
+import mitogen.master
+
+
+def ping():
+    return True
+
+
+@mitogen.core.takes_router
+def get_discarding_sender(router):
+    recv = mitogen.core.Receiver(router, fragments=True)
+    recv.notify = lambda recv: recv.get()
+    return recv.to_sender()
+
+
+def measure(router, child, sender, size, rounds=5):
+    stream = router.stream_by_id(child.context_id)
+    best = None
+    for x in xrange(rounds):
+        child.send(mitogen.core.Message(data=' ' * size,
+                                        handle=sender.dst_handle))
+        t0 = time.time()
+        child.call(ping)
+        latency = time.time() - t0
+        while stream.pending_bytes():
+            time.sleep(0.01)
+        best = min(best or latency, latency)
+    return best
+
+
+def main():
+    size = 32
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    size *= 1048576
+
+    broker = mitogen.master.Broker()
+    router = mitogen.master.Router(broker)
+    try:
+        child = router.local()
+        sender = child.call(get_discarding_sender)
+        t0 = time.time()
+        for x in xrange(100):
+            child.call(ping)
+        print 'idle:          %6.2f ms' % (10 * (time.time() - t0),)
+        print 'priority lane: %6.2f ms' % (
+            1000 * measure(router, child, sender, size),
+        )
+        mitogen.core.Stream.priority_handles = frozenset()
+        print 'single lane:   %6.2f ms' % (
+            1000 * measure(router, child, sender, size),
+        )
+    finally:
+        broker.shutdown()
+        broker.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Measure mitogen.core.Message construction cost, memory footprint, and local
+routing throughput. Usage: message.py [count]
+"""
+
+import resource
+import sys
+import time
+
+import mitogen.core
+import mitogen.master
+
+
+def construct(count):
+    t0 = time.time()
+    for x in xrange(count):
+        mitogen.core.Message(dst_id=1, src_id=2, auth_id=2, handle=100,
+                             reply_to=0, data='x')
+    return count / (time.time() - t0)
+
+
+def footprint(count):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    msgs = [mitogen.core.Message(dst_id=1, handle=100, data='x')
+            for x in xrange(count)]
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return 1024.0 * (after - before) / len(msgs)
+
+
+def route(count):
+    broker = mitogen.master.Broker()
+    router = mitogen.master.Router(broker)
+    received = []
+    handle = router.add_handler(received.append)
+    try:
+        t0 = time.time()
+        for x in xrange(count):
+            router._async_route(mitogen.core.Message(
+                dst_id=mitogen.context_id, handle=handle, data='x'
+            ))
+        return count / (time.time() - t0)
+    finally:
+        broker.shutdown()
+        broker.join()
+
+
+def main():
+    count = 1000000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    # Measure memory first, before construct() warms the allocator.
+    print 'memory:       %6.0f bytes/msg' % (footprint(count),)
+    print 'construction: %8.0f msgs/s' % (construct(count),)
+    print 'local route:  %8.0f msgs/s' % (route(count),)
+
+
+if __name__ == '__main__':
+    main()
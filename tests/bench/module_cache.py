@@ -0,0 +1,93 @@
+"""
+Measure bytes sent to a new child and time until its first call returns, when
+the call imports a synthetic package of 200 modules, for a child with no module
+cache, a cold cache and a warm cache. Usage: module_cache.py [count]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import mitogen.core
+import mitogen.master
+
+
+MODULE = '''
+"""
+Synthetic module %(i)d, padded to resemble a typical library module.
+"""
+
+import os
+import sys
+
+TABLE = %(table)r
+
+
+def func_%(i)d(arg):
+    """Return a value derived from `arg`."""
+    return [os.path.join(str(arg), key) for key in sorted(TABLE)]
+'''
+
+
+def make_package(path, count):
+    # cachebench_all imports every module of cachebench_pkg.
+    pkg_path = os.path.join(path, 'cachebench_pkg')
+    os.mkdir(pkg_path)
+    open(os.path.join(pkg_path, '__init__.py'), 'w').close()
+    names = ['mod%d' % (i,) for i in range(count)]
+    fp = open(os.path.join(path, 'cachebench_all.py'), 'w')
+    fp.write(''.join('import cachebench_pkg.%s\n' % (name,)
+                     for name in names))
+    fp.write('def ping():\n    return True\n')
+    fp.close()
+
+    rand = random.Random(0)
+    for i, name in enumerate(names):
+        table = dict(('%x' % (rand.getrandbits(64),), rand.random())
+                     for j in range(200))
+        fp = open(os.path.join(pkg_path, name + '.py'), 'w')
+        fp.write(MODULE % {'i': i, 'table': table})
+        fp.close()
+
+
+def first_call(router, **kwargs):
+    import cachebench_all
+    t0 = time.time()
+    context = router.local(**kwargs)
+    context.call(cachebench_all.ping)
+    elapsed = time.time() - t0
+    stream = router.stream_by_id(context.context_id)
+    tx_bytes = stream.tx_bytes
+    context.shutdown(wait=True)
+    return elapsed, tx_bytes
+
+
+def main():
+    count = 200
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    tmp = tempfile.mkdtemp()
+    broker = mitogen.master.Broker()
+    router = mitogen.master.Router(broker)
+    try:
+        make_package(tmp, count)
+        sys.path.insert(0, tmp)
+        cache_path = os.path.join(tmp, 'cache')
+        for name, kwargs in [('no cache', {}),
+                             ('cold cache', {'module_cache': cache_path}),
+                             ('warm cache', {'module_cache': cache_path})]:
+            elapsed, tx_bytes = first_call(router, **kwargs)
+            print '%-10s %8d bytes  %7.2f ms' % (name, tx_bytes,
+                                                 1000 * elapsed)
+    finally:
+        broker.shutdown()
+        broker.join()
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
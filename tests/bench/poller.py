@@ -0,0 +1,94 @@
+"""
+Measure the cost of one Broker IO loop iteration as the number of idle streams
+grows, for each available Poller implementation. One pipe is kept permanently
+readable so every iteration returns immediately.
+"""
+
+import os
+import resource
+import socket
+import time
+
+import mitogen.core
+import mitogen.parent
+
+
+COUNTS = [10, 100, 1000, 5000]
+ITERATIONS = 2000
+
+
+class IdleStream(mitogen.core.BasicStream):
+    def __init__(self, fd):
+        self.receive_side = mitogen.core.Side(self, fd)
+
+    def on_receive(self, broker):
+        pass
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    want = 2 * max(COUNTS) + 100
+    if soft < want:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(want, hard), hard))
+
+
+class FakeBroker(mitogen.core.Broker):
+    """Broker whose loop is driven by the benchmark rather than a thread."""
+    def __init__(self, poller_class):
+        self.poller = poller_class()
+        self._timers = []
+
+    def _call(self, stream, func):
+        func(self)
+
+
+def measure(poller_class, count):
+    broker = FakeBroker(poller_class)
+    socks = []
+    for x in xrange(count):
+        a, b = socket.socketpair()
+        socks.extend((a, b))
+        stream = IdleStream(a.fileno())
+        broker.poller.start_receive(stream.receive_side.fd,
+                                    (stream.receive_side, stream.on_receive))
+
+    rfd, wfd = os.pipe()
+    os.write(wfd, 'x')
+    busy = IdleStream(rfd)
+    broker.poller.start_receive(rfd, (busy.receive_side, busy.on_receive))
+
+    try:
+        t0 = time.time()
+        for x in xrange(ITERATIONS):
+            broker._loop_once(0)
+        return 1e6 * (time.time() - t0) / ITERATIONS
+    finally:
+        broker.poller.close()
+        os.close(wfd)
+        busy.receive_side.close()
+        for sock in socks:
+            sock.close()
+
+
+def main():
+    raise_fd_limit()
+    classes = [mitogen.core.Poller]
+    if hasattr(mitogen.parent, 'PollPoller'):
+        classes.append(mitogen.parent.PollPoller)
+    if hasattr(mitogen.parent.select, 'epoll'):
+        classes.append(mitogen.parent.EpollPoller)
+
+    print '%-14s %s' % ('streams', ' '.join('%12s' % c.__name__
+                                          for c in classes))
+    for count in COUNTS:
+        row = []
+        for klass in classes:
+            try:
+                row.append('%10.1fus' % (measure(klass, count),))
+            except (ValueError, OSError, IOError, socket.error):
+                row.append('%12s' % ('n/a',))
+        print '%-14d %s' % (count, ' '.join(row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Measure time until a new child's first call returns, when the call's module
+depends on a chain of 20 packages of 5 modules each, with and without module
+preloading. Every message from the child is delayed on arrival by an
+artificial round trip time. Usage: preload.py [rtt_msec]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import mitogen.core
+import mitogen.master
+
+
+def make_packages(path, count, size):
+    # preloadbench_N imports its submodules and preloadbench_N+1.
+    for i in range(count):
+        pkg_path = os.path.join(path, 'preloadbench_%d' % (i,))
+        os.mkdir(pkg_path)
+        fp = open(os.path.join(pkg_path, '__init__.py'), 'w')
+        for j in range(size):
+            fp.write('import preloadbench_%d.mod%d\n' % (i, j))
+        if i + 1 < count:
+            fp.write('import preloadbench_%d\n' % (i + 1,))
+        fp.close()
+        for j in range(size):
+            open(os.path.join(pkg_path, 'mod%d.py' % (j,)), 'w').close()
+
+    fp = open(os.path.join(path, 'preloadbench_main.py'), 'w')
+    fp.write('import preloadbench_0\n')
+    fp.write('def ping():\n    return True\n')
+    fp.close()
+
+
+def delay_from(router, context, rtt, requests):
+    # Stand-in for a slow link: hold each message from the child for a round
+    # trip before routing it, and count its GET_MODULE requests.
+    async_route = router._async_route
+
+    def _async_route(msg, *args):
+        if msg.src_id != context.context_id:
+            return async_route(msg, *args)
+        if msg.handle == mitogen.core.GET_MODULE:
+            requests.append(msg.data)
+        router.broker.call_later(rtt, async_route, msg, *args)
+    router._async_route = _async_route
+
+
+def measure(router, rtt, **kwargs):
+    import preloadbench_main
+    context = router.local(**kwargs)
+    requests = []
+    delay_from(router, context, rtt, requests)
+    try:
+        t0 = time.time()
+        context.call(preloadbench_main.ping)
+        elapsed = time.time() - t0
+    finally:
+        del router._async_route
+    context.shutdown(wait=True)
+    return elapsed, len(requests)
+
+
+def main():
+    rtt = 0.1
+    if len(sys.argv) > 1:
+        rtt = int(sys.argv[1]) / 1000.0
+
+    tmp = tempfile.mkdtemp()
+    broker = mitogen.master.Broker()
+    router = mitogen.master.Router(broker)
+    try:
+        make_packages(tmp, 20, 5)
+        sys.path.insert(0, tmp)
+        for name, preload in ('on demand', False), ('preload', True):
+            elapsed, requests = measure(router, rtt, preload_modules=preload)
+            print '%-9s %3d GET_MODULE  %8.2f ms' % (name, requests,
+                                                    1000 * elapsed)
+    finally:
+        broker.shutdown()
+        broker.join()
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Measure mitogen.core.Stream receive path throughput over a socketpair, for
+large and tiny messages. Usage: stream_receive.py [megabytes]
+"""
+
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+import mitogen.core
+
+
+class FakeBroker(object):
+    # Stream.on_disconnect() calls these on EOF.
+    def stop_receive(self, stream):
+        pass
+
+    def _stop_transmit(self, stream):
+        pass
+
+
+class FakeRouter(object):
+    max_message_size = 128 * 1048576
+
+    def __init__(self):
+        self.count = 0
+        self.nbytes = 0
+
+    def _async_route(self, msg, stream=None):
+        self.count += 1
+        self.nbytes += len(msg.data)
+
+
+def make_frames(size, total):
+    frame = struct.pack(mitogen.core.Stream.HEADER_FMT,
+                        0, 1, 1, 100, 0, size) + (' ' * size)
+    n = max(1, 1048576 // len(frame))
+    block = frame * n
+    return block, (total // size) // n
+
+
+def writer(sock, block, count):
+    for x in xrange(count):
+        sock.sendall(block)
+    sock.close()
+
+
+def measure(size, total):
+    rsock, wsock = socket.socketpair()
+    router = FakeRouter()
+    stream = mitogen.core.Stream(router, 1)
+    stream.accept(rsock.fileno(), rsock.fileno())
+    rsock.close()
+
+    block, count = make_frames(size, total)
+    th = threading.Thread(target=writer, args=(wsock, block, count))
+    t0 = time.time()
+    th.start()
+    broker = FakeBroker()
+    fd = stream.receive_side.fd
+    while stream.receive_side.fd is not None:
+        select.select([fd], [], [])
+        stream.on_receive(broker)
+    elapsed = time.time() - t0
+    th.join()
+    return router.count, router.nbytes, elapsed
+
+
+def main():
+    megabytes = 1024
+    if len(sys.argv) > 1:
+        megabytes = int(sys.argv[1])
+    total = megabytes * 1048576
+
+    for size in 131072, 64:
+        count, nbytes, elapsed = measure(size, total)
+        print '%7d byte messages: %9d msgs %8.1f MB/s %10.0f msgs/s' % (
+            size, count, nbytes / elapsed / 1048576, count / elapsed,
+        )
+
+
+if __name__ == '__main__':
+    main()
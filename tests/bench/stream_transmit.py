@@ -0,0 +1,76 @@
+"""
+Measure mitogen.core.Stream transmit path throughput over a socketpair, for
+bursts of small and large messages. Usage: stream_transmit.py [count]
+"""
+
+import select
+import socket
+import sys
+import threading
+import time
+
+import mitogen.core
+
+
+class FakeBroker(object):
+    def _start_transmit(self, stream):
+        pass
+
+    def _stop_transmit(self, stream):
+        pass
+
+
+class FakeRouter(object):
+    def __init__(self):
+        self.broker = FakeBroker()
+
+
+def reader(sock):
+    while sock.recv(1048576):
+        pass
+
+
+def measure(size, count):
+    rsock, wsock = socket.socketpair()
+    router = FakeRouter()
+    stream = mitogen.core.Stream(router, 1)
+    stream.accept(wsock.fileno(), wsock.fileno())
+    wsock.close()
+
+    th = threading.Thread(target=reader, args=(rsock,))
+    th.start()
+
+    msg = mitogen.core.Message(dst_id=1, handle=100, data=' ' * size)
+    t0 = time.time()
+    for x in xrange(count):
+        stream._send(msg)
+
+    calls = 0
+    fd = stream.transmit_side.fd
+    while stream.pending_bytes():
+        select.select([], [fd], [])
+        stream.on_transmit(router.broker)
+        calls += 1
+    elapsed = time.time() - t0
+
+    stream.transmit_side.close()
+    stream.receive_side.close()
+    th.join()
+    rsock.close()
+    return calls, elapsed
+
+
+def main():
+    count = 100000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    for size, n in (64, count), (131072, count // 100):
+        calls, elapsed = measure(size, n)
+        print '%7d byte messages: %7d msgs %7d writes %8.1f MB/s ' \
+              '%9.0f msgs/s' % (size, n, calls,
+                                size * n / elapsed / 1048576, n / elapsed)
+
+
+if __name__ == '__main__':
+    main()
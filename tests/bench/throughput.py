@@ -0,0 +1,70 @@
+"""
+Measure end-to-end throughput to a local() child: the rate of small function
+calls, and transfer rates of large call arguments and results. Uses only
+interfaces present before fragmenting, lanes and statistics were added, so it
+can compare against older trees by running it with their PYTHONPATH.
+Usage: throughput.py [calls] [mib]
+"""
+
+import sys
+import time
+
+import mitogen.master
+
+
+def ping():
+    return True
+
+
+def swallow(s):
+    return len(s)
+
+
+def make_string(size):
+    return ' ' * size
+
+
+def best_of(func, rounds=5):
+    best = None
+    for x in xrange(rounds):
+        t0 = time.time()
+        func()
+        elapsed = time.time() - t0
+        best = min(best or elapsed, elapsed)
+    return best
+
+
+def main():
+    calls = 2000
+    size = 4
+    if len(sys.argv) > 1:
+        calls = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        size = int(sys.argv[2])
+
+    broker = mitogen.master.Broker()
+    router = mitogen.master.Router(broker)
+    try:
+        child = router.local()
+        child.call(ping)
+        s = ' ' * (size * 1048576)
+
+        def small():
+            for x in xrange(calls):
+                child.call(ping)
+
+        t = best_of(small)
+        print 'small calls:  %8.0f calls/sec  %6.1f usec/call' % (
+            calls / t, 1e6 * t / calls,
+        )
+        t = best_of(lambda: child.call(swallow, s))
+        print '%d MiB arg:    %8.1f MiB/sec' % (size, size / t)
+        t = best_of(lambda: child.call(make_string, len(s)))
+        print '%d MiB result: %8.1f MiB/sec' % (size, size / t)
+    finally:
+        broker.shutdown()
+        broker.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Measure Message.unpickle() for 100 byte, 10 KiB and 1 MiB payloads, against a
+bare cPickle.loads() that has no restricted global resolver.
+Usage: unpickle.py [count]
+"""
+
+import cPickle
+import sys
+import time
+
+import mitogen.core
+
+
+SIZES = [('100B', 100), ('10KiB', 10240), ('1MiB', 1048576)]
+
+
+def payload(size):
+    # A list of distinct short tuples, sized to roughly `size`.
+    item_size = len(cPickle.dumps((1, 'name1', u'value', None, 1.5), 2))
+    return [(i, 'name%d' % (i,), u'value', None, 1.5)
+            for i in xrange(size // item_size or 1)]
+
+
+def loop(func, count):
+    t0 = time.time()
+    for x in xrange(count):
+        func()
+    return 1e6 * (time.time() - t0) / count
+
+
+def main():
+    count = 20000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    Message = mitogen.core.Message
+    for name, size in SIZES:
+        obj = payload(size)
+        n = max(1, count * 100 // size)
+        pickled = Message.pickled(obj).data
+        print '%-6s loads    %8.2f usec' % (
+            name, loop(lambda: cPickle.loads(pickled), n),
+        )
+        print '%-6s unpickle %8.2f usec' % (
+            name, loop(lambda: Message(data=pickled).unpickle(), n),
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+
+import time
+
+import mock
+import unittest2
+
+import testlib
+import mitogen.core
+
+
+def ping():
+    return True
+
+
+class StatsTest(testlib.RouterMixin, testlib.TestCase):
+    def test_local(self):
+        self.router.broker.stats_interval = 3600
+        child = self.router.local()
+        child.call(ping)
+        stats = self.router.broker.get_stats()
+        self.assertTrue(stats['loops'] > 0)
+        self.assertTrue(stats['poll_time'] > 0)
+        self.assertTrue(stats['deferred_calls'] > 0)
+        stream_stats, = [d for d in stats['streams']
+                         if d['remote_id'] == child.context_id]
+        self.assertTrue(stream_stats['tx_frames'] > 0)
+        self.assertTrue(stream_stats['rx_frames'] > 0)
+
+    def test_untimed(self):
+        child = self.router.local()
+        child.call(ping)
+        stats = self.router.broker.get_stats()
+        self.assertTrue(stats['deferred_calls'] > 0)
+        self.assertEquals(0, stats['poll_time'])
+        self.assertEquals(0, stats['defer_latency'])
+
+    def test_remote(self):
+        child = self.router.local()
+        stats = child.call(mitogen.core.get_stats)
+        stream_stats, = stats['streams']
+        self.assertEquals(0, stream_stats['remote_id'])
+        self.assertTrue(stream_stats['rx_frames'] > 0)
+
+    def test_log_stats(self):
+        log = testlib.LogCapturer('mitogen')
+        log.start()
+        try:
+            mitogen.core.log_stats(0.01, router=self.router)
+            time.sleep(0.1)
+            mitogen.core.log_stats(None, router=self.router)
+        finally:
+            logs = log.stop()
+        self.assertTrue("'dispatch_time'" in logs)
+
+
+class CallLaterTest(testlib.BrokerMixin, testlib.TestCase):
+    def test_order(self):
+        latch = mitogen.core.Latch()
+        self.broker.call_later(0.02, latch.put, 2)
+        self.broker.call_later(0.01, latch.put, 1)
+        self.broker.call_later(0, latch.put, 0)
+        self.assertEquals([0, 1, 2], [latch.get(timeout=1) for x in range(3)])
+
+    def test_cancel(self):
+        latch = mitogen.core.Latch()
+        timer = self.broker.call_later(0.01, latch.put, 1)
+        timer.cancel()
+        self.broker.call_later(0.02, latch.put, 2)
+        self.assertEquals(2, latch.get(timeout=1))
+        self.assertTrue(latch.empty())
+
+    def test_crash(self):
+        log = testlib.LogCapturer('mitogen')
+        log.start()
+        try:
+            latch = mitogen.core.Latch()
+            self.broker.call_later(0, lambda: 1 / 0)
+            self.broker.call_later(0, latch.put, 1)
+            self.assertEquals(1, latch.get(timeout=1))
+        finally:
+            logs = log.stop()
+        self.assertTrue('crashed' in logs)
+
+    def test_clock(self):
+        clock = [mitogen.core.now()]
+        patcher = mock.patch('mitogen.core.now', lambda: clock[0])
+        patcher.start()
+        try:
+            latch = mitogen.core.Latch()
+            self.broker.call_later(3600, latch.put, 1)
+            self.sync_with_broker()
+            self.assertTrue(latch.empty())
+            clock[0] += 3600
+            self.sync_with_broker()
+            self.assertEquals(1, latch.get(timeout=1))
+        finally:
+            patcher.stop()
+
+    def test_idle(self):
+        latch = mitogen.core.Latch()
+        self.broker.call_later(0.01, latch.put, 1)
+        latch.get(timeout=1)
+        self.sync_with_broker()
+        polls = self.broker.poller.polls
+        time.sleep(0.1)
+        # The broker may re-enter poll() once after running the barrier, but
+        # must not spin on the expired timer.
+        self.assertTrue(self.broker.poller.polls - polls <= 1)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,87 @@
+
+import threading
+import time
+
+import unittest2
+
+import testlib
+import mitogen.debug
+
+
+def spin(started, event):
+    started.set()
+    while not event.isSet():
+        sum(range(100))
+
+
+class SamplerTest(testlib.TestCase):
+    klass = mitogen.debug.Sampler
+
+    def setUp(self):
+        super(SamplerTest, self).setUp()
+        started = threading.Event()
+        self.event = threading.Event()
+        self.thread = threading.Thread(target=spin,
+                                       args=(started, self.event),
+                                       name='spinner')
+        self.thread.start()
+        started.wait()
+
+    def tearDown(self):
+        self.event.set()
+        self.thread.join()
+        super(SamplerTest, self).tearDown()
+
+    def test_sample(self):
+        sampler = self.klass()
+        sampler.sample()
+        sampler.sample()
+        self.assertEquals(2, sampler.samples)
+        keys = [key for key in sampler.counts if key.startswith('spinner;')]
+        self.assertTrue(keys)
+        self.assertTrue(';spin (' in keys[0])
+        self.assertFalse([key for key in sampler.counts
+                          if key.split(';')[-1].startswith('sample (')])
+
+    def test_format_folded(self):
+        sampler = self.klass()
+        sampler.counts = {'a;b': 2, 'a': 1}
+        self.assertEquals('a 1\na;b 2\n', sampler.format_folded())
+
+    def test_max_stacks(self):
+        sampler = self.klass(max_stacks=0)
+        sampler.sample()
+        self.assertEquals({}, sampler.counts)
+        self.assertTrue(sampler.dropped > 0)
+
+    def test_max_depth(self):
+        sampler = self.klass(max_depth=1)
+        sampler.sample()
+        for key in sampler.counts:
+            self.assertEquals(2, len(key.split(';')))
+
+    def test_stop_not_started(self):
+        sampler = self.klass()
+        sampler.stop()
+        self.assertEquals({}, sampler.counts)
+
+    def test_start_stop(self):
+        mitogen.debug.start_sampling(interval=0.001)
+        time.sleep(0.05)
+        folded = mitogen.debug.stop_sampling()
+        self.assertTrue('\nspinner;' in '\n' + folded)
+        self.assertEquals(None, mitogen.debug.stop_sampling())
+
+
+class RemoteSamplerTest(testlib.RouterMixin, testlib.TestCase):
+    def test_remote(self):
+        child = self.router.local()
+        child.call(mitogen.debug.start_sampling, interval=0.001)
+        child.call(time.sleep, 0.05)
+        folded = child.call(mitogen.debug.stop_sampling)
+        self.assertTrue('mitogen-broker;' in folded)
+        self.assertTrue('_dispatch_calls (' in folded)
+
+
+if __name__ == '__main__':
+    unittest2.main()
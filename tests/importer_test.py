@@ -1,7 +1,15 @@
 
+import binascii
 import email.utils
+import hashlib
+import imp
+import marshal
+import os
+import shutil
 import sys
+import tempfile
 import threading
+import time
 import types
 import zlib
 
@@ -10,6 +18,7 @@ import pytest
 import unittest2
 
 import mitogen.core
+import mitogen.module_cache
 import mitogen.utils
 
 import testlib
@@ -141,6 +150,273 @@ class LoadModulePackageTest(ImporterMixin, testlib.TestCase):
         self.assertEquals(mod.func.__module__, self.modname)
 
 
+class LoadModuleCodeTest(ImporterMixin, testlib.TestCase):
+    data = zlib.compress("data = 1\n")
+    code = zlib.compress(marshal.dumps(compile("data = 2\n", "x", "exec")))
+    path = 'fake_module.py'
+    modname = 'fake_module'
+
+    # 0:fullname 1:pkg_present 2:path 3:compressed 4:related 5:digest 6:code
+    response = (modname, None, path, data, [], None, code)
+
+    def resolver(self):
+        return mitogen.module_cache.Resolver(self.importer, bytecode=True)
+
+    def test_code_ignored_unless_requested(self):
+        self.set_get_module_response(self.response)
+        mod = self.importer.load_module(self.modname)
+        self.assertEquals(1, mod.data)
+
+    def test_code_used(self):
+        self.resolver()
+        self.set_get_module_response(self.response)
+        mod = self.importer.load_module(self.modname)
+        self.assertEquals(2, mod.data)
+
+    def test_code_absent(self):
+        self.resolver()
+        self.set_get_module_response(self.response[:6] + (None,))
+        mod = self.importer.load_module(self.modname)
+        self.assertEquals(1, mod.data)
+
+    def test_source_omitted(self):
+        self.resolver()
+        self.set_get_module_response(self.response[:3] + (None,)
+                                     + self.response[4:])
+        mod = self.importer.load_module(self.modname)
+        self.assertEquals(2, mod.data)
+
+    def test_omitted_source_fetched(self):
+        self.resolver()
+        self.set_get_module_response(self.response[:3] + (None,)
+                                     + self.response[4:])
+        self.importer.load_module(self.modname)
+        self.set_get_module_response(self.response)
+        self.assertEquals('data = 1\n', self.importer.get_source(self.modname))
+        self.assertEquals(self.modname, self.context_send_msg.data)
+
+    def test_omitted_source_timeout(self):
+        self.resolver().get_source_timeout = 0.05
+        self.set_get_module_response(self.response[:3] + (None,)
+                                     + self.response[4:])
+        self.importer.load_module(self.modname)
+        self.context.send = mock.Mock()
+        self.assertEquals(None, self.importer.get_source(self.modname))
+        self.assertEquals(1, self.context.send.call_count)
+        # Negative result is remembered.
+        self.assertEquals(None, self.importer.get_source(self.modname))
+        self.assertEquals(1, self.context.send.call_count)
+
+    def test_omitted_source_dead(self):
+        self.resolver()
+        self.set_get_module_response(self.response[:3] + (None,)
+                                     + self.response[4:])
+        self.importer.load_module(self.modname)
+        self.context.send = mock.Mock()
+        latch = mitogen.core.Latch()
+        th = threading.Thread(target=lambda: latch.put(
+            self.importer.get_source(self.modname)
+        ))
+        th.start()
+        while not self.importer._resolver._latches:
+            time.sleep(0.01)
+        self.importer._on_load_module(mitogen.core.Message.dead())
+        self.assertEquals(None, latch.get(timeout=5.0))
+        th.join()
+
+    def test_magic_announced(self):
+        self.resolver().announce()
+        msg, = self.context.send.call_args[0]
+        self.assertEquals(mitogen.core.CODE_MAGIC, msg.handle)
+        self.assertEquals(imp.get_magic(), msg.data)
+
+
+class LoadModulesTest(ImporterMixin, testlib.TestCase):
+    modname = 'fake_pkg'
+
+    # 0:fullname 1:pkg_present 2:path 3:source 4:related
+    bundle = [
+        ('fake_pkg', ['mod'], 'fake_pkg/__init__.py', '', ['fake_pkg.mod']),
+        ('fake_pkg.mod', None, 'fake_pkg/mod.py', 'data = 1\n', []),
+    ]
+
+    def tearDown(self):
+        sys.modules.pop('fake_pkg.mod', None)
+        super(LoadModulesTest, self).tearDown()
+
+    def send_bundle(self):
+        msg = mitogen.core.Message.pickled(self.bundle)
+        msg.data = zlib.compress(msg.data)
+        self.importer._on_load_modules(msg)
+
+    def test_source_stored(self):
+        self.send_bundle()
+        self.assertEquals('', self.importer.get_source('fake_pkg'))
+        self.assertEquals('data = 1\n',
+                          self.importer.get_source('fake_pkg.mod'))
+
+    def test_stored_compressed(self):
+        self.send_bundle()
+        tup = self.importer._cache['fake_pkg.mod']
+        self.assertEquals('data = 1\n', zlib.decompress(tup[3]))
+
+    def test_callbacks_fired_once_all_stored(self):
+        seen = []
+
+        def callback():
+            seen.append(sorted(self.importer._cache))
+        self.importer._callbacks['fake_pkg'] = [callback]
+        self.importer._callbacks['fake_pkg.mod'] = [callback]
+        self.send_bundle()
+        self.assertEquals(2, len(seen))
+        for names in seen:
+            self.assertTrue('fake_pkg' in names)
+            self.assertTrue('fake_pkg.mod' in names)
+        self.assertEquals({}, self.importer._callbacks)
+
+    def test_import(self):
+        self.send_bundle()
+        self.importer.load_module('fake_pkg')
+        mod = self.importer.load_module('fake_pkg.mod')
+        self.assertEquals(1, mod.data)
+
+
+class ModuleCacheTest(testlib.TestCase):
+    klass = mitogen.module_cache.ModuleCache
+
+    def setUp(self):
+        super(ModuleCacheTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(ModuleCacheTest, self).tearDown()
+
+    def entry(self, source):
+        return hashlib.sha1(source).digest(), zlib.compress(source)
+
+    def test_put_get(self):
+        cache = self.klass(self.path)
+        digest, compressed = self.entry('x = 1\n')
+        self.assertEquals(None, cache.get(digest))
+        cache.put(digest, compressed)
+        cache.flush()
+        self.assertEquals('x = 1\n', zlib.decompress(cache.get(digest)))
+        self.assertEquals([digest], self.klass(self.path).digests())
+
+    def test_corrupt(self):
+        cache = self.klass(self.path)
+        digest, _ = self.entry('x = 1\n')
+        cache.put(digest, zlib.compress('x = 2\n'))
+        cache.flush()
+        log = testlib.LogCapturer()
+        log.start()
+        self.assertEquals(None, cache.get(digest))
+        self.assertTrue('corrupt' in log.stop())
+        self.assertEquals([], cache.digests())
+        self.assertEquals([], os.listdir(self.path))
+
+    def test_evict_least_recent(self):
+        cache = self.klass(self.path)
+        entries = [self.entry(os.urandom(100)) for x in range(4)]
+        size = len(entries[0][1])
+        cache.max_size = 3 * size
+        cache.low_size = 2 * size
+        for i, (digest, compressed) in enumerate(entries[:3]):
+            cache.put(digest, compressed)
+            cache.flush()
+            path = os.path.join(self.path, binascii.hexlify(digest))
+            os.utime(path, (1000 + i, 1000 + i))
+        cache.get(entries[0][0])
+        cache.put(*entries[3])
+        cache.flush()
+        self.assertEquals(sorted([entries[0][0], entries[3][0]]),
+                          sorted(cache.digests()))
+        self.assertEquals(2, len(os.listdir(self.path)))
+
+    def test_put_does_not_write(self):
+        cache = self.klass(self.path)
+        digest, compressed = self.entry('x = 1\n')
+        cache._thread = mock.Mock()  # Writer thread is stalled.
+        cache.put(digest, compressed)
+        cache.put(digest, compressed)
+        self.assertEquals([], os.listdir(self.path))
+        self.assertEquals(1, len(cache._latch._queue))
+        cache._latch.put(None)
+        cache._writer_main()
+        self.assertEquals([digest], cache.digests())
+
+    def test_failed_write_removes_tmp(self):
+        cache = self.klass(self.path)
+        digest, compressed = self.entry('x = 1\n')
+        with mock.patch('os.rename', side_effect=OSError()):
+            cache.put(digest, compressed)
+            cache.flush()
+        self.assertEquals([], cache.digests())
+        self.assertEquals([], os.listdir(self.path))
+
+
+class ImporterModuleCacheTest(testlib.RouterMixin, testlib.TestCase):
+    source = 'data = 1\n'
+    digest = hashlib.sha1(source).digest()
+    modname = 'fake_cached_module'
+
+    def setUp(self):
+        super(ImporterModuleCacheTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.cache = mitogen.module_cache.ModuleCache(self.path)
+        self.context = mock.Mock()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        sys.modules.pop(self.modname, None)
+        super(ImporterModuleCacheTest, self).tearDown()
+
+    def importer(self):
+        importer = mitogen.core.Importer(self.router, self.context, '')
+        mitogen.module_cache.Resolver(importer, self.cache)
+        return importer
+
+    def load(self, importer, compressed):
+        importer._on_load_module(mitogen.core.Message.pickled(
+            # 0:fullname 1:pkg_present 2:path 3:compressed 4:related 5:digest
+            (self.modname, None, 'fake.py', compressed, [], self.digest)
+        ))
+
+    def test_empty_not_announced(self):
+        self.importer()._resolver.announce()
+        self.assertFalse(self.context.send.called)
+
+    def test_announced(self):
+        self.cache.put(self.digest, zlib.compress(self.source))
+        self.cache.flush()
+        self.importer()._resolver.announce()
+        msg, = self.context.send.call_args[0]
+        self.assertEquals(mitogen.core.CACHED_MODULES, msg.handle)
+        self.assertEquals(self.digest[:8], msg.data)
+
+    def test_source_stored(self):
+        self.load(self.importer(), zlib.compress(self.source))
+        self.cache.flush()
+        self.assertTrue(self.cache.get(self.digest))
+
+    def test_source_omitted(self):
+        self.cache.put(self.digest, zlib.compress(self.source))
+        self.cache.flush()
+        importer = self.importer()
+        self.load(importer, None)
+        self.assertEquals(self.source, importer.get_source(self.modname))
+
+    def test_source_omitted_miss(self):
+        importer = self.importer()
+        importer._callbacks[self.modname] = []
+        self.load(importer, None)
+        msg, = self.context.send.call_args[0]
+        self.assertEquals(mitogen.core.GET_MODULE, msg.handle)
+        self.assertEquals(self.modname, msg.data)
+        self.assertFalse(self.modname in importer._cache)
+
+
 class EmailParseAddrSysTest(testlib.RouterMixin, testlib.TestCase):
     @pytest.fixture(autouse=True)
     def initdir(self, caplog):
@@ -153,6 +429,16 @@ class EmailParseAddrSysTest(testlib.RouterMixin, testlib.TestCase):
         pass
 
 
+class CoreSourceTest(testlib.TestCase):
+    def test_main_call_stripped(self):
+        preamble = 'x = 1\nExternalContext(**{}).main()\n'
+        importer = mitogen.core.Importer(
+            router=mock.Mock(), context=None,
+            core_src=zlib.compress(preamble),
+        )
+        self.assertEquals('x = 1', importer.get_source('mitogen.core'))
+
+
 class ImporterBlacklistTest(testlib.TestCase):
     def test_is_blacklisted_import_default(self):
         importer = mitogen.core.Importer(
@@ -210,5 +496,30 @@ class ImporterBlacklistTest(testlib.TestCase):
         self.assertTrue(mitogen.core.is_blacklisted_import(importer, 'builtins'))
 
 
+class OmitCachedSourceTest(testlib.TestCase):
+    func = staticmethod(mitogen.module_cache.omit_cached_source)
+
+    def setUp(self):
+        super(OmitCachedSourceTest, self).setUp()
+        self.stream = mock.Mock(cached_modules=set(['d' * 8]),
+                                sent_modules=set())
+        # 0:fullname 1:pkg_present 2:path 3:compressed 4:related 5:digest
+        self.tup = ('mod', None, 'mod.py', zlib.compress('x = 1\n'), [],
+                    'd' * 20)
+
+    def test_cached(self):
+        self.assertEquals(self.tup[:3] + (None,) + self.tup[4:],
+                          self.func(self.stream, self.tup))
+
+    def test_not_cached(self):
+        self.stream.cached_modules = set()
+        self.assertEquals(self.tup, self.func(self.stream, self.tup))
+
+    def test_already_sent(self):
+        # A repeated request means the child's cached copy was unusable.
+        self.stream.sent_modules.add('mod')
+        self.assertEquals(self.tup, self.func(self.stream, self.tup))
+
+
 if __name__ == '__main__':
     unittest2.main()
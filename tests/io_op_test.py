@@ -41,6 +41,10 @@ class OsErrorRestartTest(RestartTest, testlib.TestCase):
     exception_class = OSError
 
 
+class IoErrorRestartTest(RestartTest, testlib.TestCase):
+    exception_class = IOError
+
+
 class DisconnectTest(object):
     func = staticmethod(mitogen.core.io_op)
     errno = None
@@ -115,5 +119,10 @@ class OsErrorExceptionTest(ExceptionTest, testlib.TestCase):
     exception_class = OSError
 
 
+class IoErrorExceptionTest(ExceptionTest, testlib.TestCase):
+    errno = errno.EBADF
+    exception_class = IOError
+
+
 if __name__ == '__main__':
     unittest2.main()
@@ -1,5 +1,6 @@
 
 import threading
+import time
 
 import unittest2
 
@@ -8,6 +9,10 @@ import mitogen.core
 import testlib
 
 
+class LockLatch(mitogen.core.Latch):
+    waiter_class = mitogen.core.LockWaiter
+
+
 class EmptyTest(testlib.TestCase):
     klass = mitogen.core.Latch
 
@@ -97,6 +102,25 @@ class ThreadedGetTest(testlib.TestCase):
         self.assertEquals(sorted(self.results), range(5))
         self.assertEquals(self.excs, [])
 
+    def test_no_timeout(self):
+        latch = self.klass()
+        self.start_one(latch.get)
+        latch.put('test')
+        self.join()
+        self.assertEquals(self.results, ['test'])
+
+    def test_timeout(self):
+        latch = self.klass()
+        self.start_one(lambda: latch.get(timeout=0.05))
+        self.join()
+        self.assertEquals(self.results, [None])
+        self.assertTrue(isinstance(self.excs[0], mitogen.core.TimeoutError))
+        # A timed-out waiter is reused without a stale wakeup.
+        self.start_one(lambda: latch.get(timeout=3.0))
+        latch.put('test')
+        self.join()
+        self.assertEquals(self.results, [None, 'test'])
+
 
 
 class PutTest(testlib.TestCase):
@@ -204,6 +228,139 @@ class ThreadedCloseTest(testlib.TestCase):
             self.assertTrue(isinstance(exc, mitogen.core.LatchError))
 
 
+class HandoffTest(testlib.TestCase):
+    klass = mitogen.core.Latch
+
+    def _start_sleeper(self, latch, results):
+        n = len(latch._sleeping)
+        th = threading.Thread(target=lambda: results.append(latch.get()))
+        th.start()
+        while len(latch._sleeping) == n:
+            time.sleep(0.001)
+        return th
+
+    def test_fifo(self):
+        latch = self.klass()
+        results = []
+        threads = [self._start_sleeper(latch, results) for x in range(3)]
+        for x in range(3):
+            latch.put(x)
+            threads[x].join()
+        self.assertEquals([0, 1, 2], results)
+
+    def test_counters(self):
+        latch = self.klass()
+        latch.put(1)
+        latch.put(2)
+        latch.get()
+        latch.get()
+        self.assertEquals((2, 2, 0, 0), (latch.puts, latch.gets,
+                                         latch.sleeps, latch.wakeups))
+        results = []
+        th = self._start_sleeper(latch, results)
+        latch.put(3)
+        th.join()
+        self.assertEquals([3], results)
+        self.assertEquals((3, 3, 1, 1), (latch.puts, latch.gets,
+                                         latch.sleeps, latch.wakeups))
+
+    def test_stress(self):
+        latch = self.klass()
+        results = []
+
+        def consume():
+            while True:
+                obj = latch.get()
+                if obj is None:
+                    break
+                results.append(obj)
+
+        def produce(base):
+            for x in range(2000):
+                latch.put(base + x)
+
+        consumers = [threading.Thread(target=consume) for x in range(8)]
+        producers = [threading.Thread(target=produce, args=(x * 2000,))
+                     for x in range(4)]
+        for th in consumers + producers:
+            th.start()
+        for th in producers:
+            th.join()
+        for th in consumers:
+            latch.put(None)
+        for th in consumers:
+            th.join()
+        self.assertEquals(range(8000), sorted(results))
+        self.assertTrue(latch.empty())
+
+
+class LockWaiterHandoffTest(HandoffTest):
+    klass = LockLatch
+
+
+class LockWaiterEmptyTest(EmptyTest):
+    klass = LockLatch
+
+
+class LockWaiterGetTest(GetTest):
+    klass = LockLatch
+
+    def test_main_thread_timeout(self):
+        latch = self.klass()
+        self.assertRaises(mitogen.core.TimeoutError,
+            lambda: latch.get(timeout=0.05))
+
+    @unittest2.skipIf(mitogen.core.PY3, 'Python 3 locks accept a timeout')
+    def test_socket_waiter_where_lock_cannot_block(self):
+        klass = mitogen.core.LockWaiter
+        waiter = klass.for_wait(None)
+        self.assertTrue(isinstance(waiter, mitogen.core.SocketWaiter))
+        waiter.free()
+        got = []
+        th = threading.Thread(target=lambda: got.extend([
+            klass.for_wait(None),
+            klass.for_wait(1.0),
+        ]))
+        th.start()
+        th.join()
+        self.assertTrue(isinstance(got[0], klass))
+        self.assertTrue(isinstance(got[1], mitogen.core.SocketWaiter))
+        for waiter in got:
+            waiter.free()
+
+
+class LockWaiterThreadedGetTest(ThreadedGetTest):
+    klass = LockLatch
+
+
+class LockWaiterPutTest(PutTest):
+    klass = LockLatch
+
+
+class LockWaiterCloseTest(CloseTest):
+    klass = LockLatch
+
+
+class LockWaiterThreadedCloseTest(ThreadedCloseTest):
+    klass = LockLatch
+
+
+class ForkTest(testlib.TestCase):
+    def test_pools_discarded(self):
+        for klass in mitogen.core.Latch, LockLatch:
+            latch = klass()
+            self.assertRaises(mitogen.core.TimeoutError,
+                lambda: latch.get(timeout=0))
+            th = threading.Thread(target=latch.get)
+            th.start()
+            latch.put(None)
+            th.join()
+        self.assertTrue(mitogen.core.SocketWaiter._pool)
+        self.assertTrue(mitogen.core.LockWaiter._pool)
+        mitogen.core.Latch._on_fork()
+        self.assertEquals([], mitogen.core.SocketWaiter._pool)
+        self.assertEquals([], mitogen.core.LockWaiter._pool)
+
 
 if __name__ == '__main__':
     unittest2.main()
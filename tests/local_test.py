@@ -4,6 +4,7 @@ import os
 import unittest2
 
 import mitogen
+import mitogen.core
 import mitogen.ssh
 import mitogen.utils
 
@@ -11,6 +12,11 @@ import testlib
 import plain_old_module
 
 
+@mitogen.core.takes_router
+def get_parent_priority_lanes(router):
+    return router._stream_by_id[mitogen.parent_id].priority_lanes
+
+
 class LocalTest(testlib.RouterMixin, unittest2.TestCase):
     stream_class = mitogen.ssh.Stream
 
@@ -20,5 +26,38 @@ class LocalTest(testlib.RouterMixin, unittest2.TestCase):
         self.assertEquals('local.%d' % (pid,), context.name)
 
 
+class CompressTest(testlib.RouterMixin, unittest2.TestCase):
+    def test_compress(self):
+        context = self.router.local(compress=True)
+        stream = self.router.stream_by_id(context.context_id)
+        self.assertTrue(stream._compressor is not None)
+        data = os.urandom(300000) + ' ' * 300000
+        self.assertEquals(data, context.call(str, data))
+
+    def test_prime(self):
+        context = self.router.local(compress=True,
+                                    compress_prime='cmitogen.core\n')
+        self.assertEquals(123, context.call(int, '123'))
+
+    def test_via(self):
+        parent = self.router.local(compress=True)
+        child = self.router.local(via=parent, compress=True)
+        self.assertEquals(child.call(os.getppid), parent.call(os.getpid))
+
+
+class PriorityLanesTest(testlib.RouterMixin, unittest2.TestCase):
+    def test_default_off(self):
+        context = self.router.local()
+        stream = self.router.stream_by_id(context.context_id)
+        self.assertFalse(stream.priority_lanes)
+        self.assertFalse(context.call(get_parent_priority_lanes))
+
+    def test_enabled(self):
+        context = self.router.local(priority_lanes=True)
+        stream = self.router.stream_by_id(context.context_id)
+        self.assertTrue(stream.priority_lanes)
+        self.assertTrue(context.call(get_parent_priority_lanes))
+
+
 if __name__ == '__main__':
     unittest2.main()
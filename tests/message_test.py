@@ -0,0 +1,88 @@
+
+import mock
+import unittest2
+
+import testlib
+import mitogen.core
+
+
+class ConstructorTest(testlib.TestCase):
+    klass = mitogen.core.Message
+
+    def test_defaults(self):
+        msg = self.klass()
+        self.assertEquals(None, msg.dst_id)
+        self.assertEquals(mitogen.context_id, msg.src_id)
+        self.assertEquals(mitogen.context_id, msg.auth_id)
+        self.assertEquals(None, msg.handle)
+        self.assertEquals(None, msg.reply_to)
+        self.assertEquals('', msg.data)
+        self.assertEquals(None, msg.router)
+        self.assertEquals(None, msg.receiver)
+
+    def test_positional(self):
+        router = object()
+        msg = self.klass(1, 2, 3, 4, 5, 'data', router)
+        self.assertEquals((1, 2, 3, 4, 5, 'data'),
+                          (msg.dst_id, msg.src_id, msg.auth_id, msg.handle,
+                           msg.reply_to, msg.data))
+        self.assertTrue(msg.router is router)
+
+    def test_no_dict(self):
+        msg = self.klass()
+        self.assertFalse(hasattr(msg, '__dict__'))
+        self.assertRaises(AttributeError, lambda: setattr(msg, 'bad', 1))
+
+    def test_unknown_kwarg(self):
+        self.assertRaises(TypeError, lambda: self.klass(bad=1))
+
+
+class PickledTest(testlib.TestCase):
+    klass = mitogen.core.Message
+
+    def test_pickled(self):
+        msg = self.klass.pickled([1, 2], handle=123)
+        self.assertEquals(123, msg.handle)
+        self.assertEquals([1, 2], msg.unpickle())
+
+    def test_unpickle_cached(self):
+        msg = self.klass.pickled([1, 2])
+        self.assertTrue(msg.unpickle() is msg.unpickle())
+
+    def test_dead(self):
+        msg = self.klass.dead(handle=123)
+        self.assertTrue(msg.is_dead)
+        self.assertEquals(123, msg.handle)
+        self.assertRaises(mitogen.core.ChannelError, msg.unpickle)
+
+
+class UnpickleRouterTest(testlib.RouterMixin, testlib.TestCase):
+    klass = mitogen.core.Message
+
+    def test_context(self):
+        context = mitogen.core.Context(self.router, 1234, 'name')
+        msg = self.klass.pickled((1, context))
+        msg.router = self.router
+        self.assertEquals(1234, msg.unpickle()[1].context_id)
+
+
+class ReplyTest(testlib.TestCase):
+    klass = mitogen.core.Message
+
+    def test_reply(self):
+        router = mock.Mock()
+        msg = self.klass(src_id=1234, reply_to=5678, router=router)
+        msg.reply(123, reply_to=777)
+        reply, = router.route.call_args[0]
+        self.assertEquals(1234, reply.dst_id)
+        self.assertEquals(5678, reply.handle)
+        self.assertEquals(777, reply.reply_to)
+        self.assertEquals(123, reply.unpickle())
+
+    def test_reply_bad_kwarg(self):
+        msg = self.klass(src_id=1234, reply_to=5678, router=mock.Mock())
+        self.assertRaises(AttributeError, lambda: msg.reply(123, bad=1))
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -1,5 +1,10 @@
 import inspect
+import os
+import shutil
+import sys
+import tempfile
 
+import mock
 import unittest2
 
 import mitogen.master
@@ -203,6 +208,7 @@ class FindRelatedTest(testlib.TestCase):
             'mitogen.compat.functools',
             'mitogen.core',
             'mitogen.master',
+            'mitogen.module_cache',
             'mitogen.parent',
         ])
 
@@ -379,5 +385,145 @@ class FindRelatedTest(testlib.TestCase):
             'pytz.tzinfo',
         ])
 
+
+class DependencyCacheTest(testlib.TestCase):
+    klass = mitogen.master.DependencyCache
+
+    def setUp(self):
+        super(DependencyCacheTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'mod.py')
+        self.write('import os\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(DependencyCacheTest, self).tearDown()
+
+    def write(self, source, mtime=1000):
+        fp = open(self.filename, 'w')
+        fp.write(source)
+        fp.close()
+        os.utime(self.filename, (mtime, mtime))
+
+    def test_put_get(self):
+        cache = self.klass(self.path)
+        self.assertEquals(None, cache.get(self.filename))
+        cache.put(self.filename, [(-1, 'os', ())])
+        self.assertEquals([(-1, 'os', ())], cache.get(self.filename))
+
+    def test_changed_mtime(self):
+        cache = self.klass(self.path)
+        cache.put(self.filename, [(-1, 'os', ())])
+        self.write('import sys\n', mtime=2000)
+        self.assertEquals(None, cache.get(self.filename))
+
+    def test_changed_size(self):
+        cache = self.klass(self.path)
+        cache.put(self.filename, [(-1, 'os', ())])
+        self.write('import sys, os\n')
+        self.assertEquals(None, cache.get(self.filename))
+
+    def test_save_load(self):
+        cache = self.klass(self.path)
+        cache.put(self.filename, [(-1, 'os', ())])
+        self.assertEquals(None, self.klass(self.path).get(self.filename))
+        cache.save()
+        cache2 = self.klass(self.path)
+        self.assertEquals([(-1, 'os', ())], cache2.get(self.filename))
+
+    def test_save_merges(self):
+        other = os.path.join(self.path, 'other.py')
+        open(other, 'w').close()
+        cache = self.klass(self.path)
+        cache2 = self.klass(self.path)
+        cache.put(self.filename, [(-1, 'os', ())])
+        cache2.put(other, [])
+        cache.save()
+        cache2.save()
+        cache3 = self.klass(self.path)
+        self.assertEquals([(-1, 'os', ())], cache3.get(self.filename))
+        self.assertEquals([], cache3.get(other))
+
+    def test_save_prunes(self):
+        other = os.path.join(self.path, 'other.py')
+        open(other, 'w').close()
+        cache = self.klass(self.path)
+        cache.put(self.filename, [(-1, 'os', ())])
+        cache.put(other, [])
+        cache.save()
+        os.unlink(other)
+        self.write('import sys\n', mtime=2000)
+        mod2 = os.path.join(self.path, 'mod2.py')
+        open(mod2, 'w').close()
+        cache2 = self.klass(self.path)
+        cache2.put(mod2, [])
+        cache2.save()
+        self.assertEquals([mod2], list(self.klass(self.path)._entries))
+
+    def test_corrupt(self):
+        cache = self.klass(self.path)
+        fp = open(cache.filename, 'wb')
+        fp.write('garbage')
+        fp.close()
+        log = testlib.LogCapturer()
+        log.start()
+        cache = self.klass(self.path)
+        self.assertTrue('corrupt' in log.stop())
+        self.assertEquals(None, cache.get(self.filename))
+
+
+class FindRelatedDependencyCacheTest(testlib.TestCase):
+    klass = mitogen.master.ModuleFinder
+
+    def setUp(self):
+        super(FindRelatedDependencyCacheTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(FindRelatedDependencyCacheTest, self).tearDown()
+
+    def call(self, fullname):
+        cache = mitogen.master.DependencyCache(self.path)
+        try:
+            return self.klass(cache).find_related(fullname)
+        finally:
+            cache.save()
+
+    def test_same_result(self):
+        expect = self.klass().find_related('mitogen.fakessh')
+        self.assertEquals(expect, self.call('mitogen.fakessh'))
+        self.assertEquals(expect, self.call('mitogen.fakessh'))
+
+    def test_warm_skips_compile(self):
+        self.call('mitogen.fakessh')
+        with mock.patch('mitogen.master.scan_code_imports') as scan:
+            self.call('mitogen.fakessh')
+        self.assertEquals(0, scan.call_count)
+
+    def test_never_imported(self):
+        fullname = 'module_finder_testmod.sibling_dep_mod_py2_import'
+        sys.modules.pop(fullname, None)
+        expect = self.klass()._scan_imports(fullname)
+        cache = mitogen.master.DependencyCache(self.path)
+        self.klass(cache)._scan_imports(fullname)
+        cache.save()
+        cache = mitogen.master.DependencyCache(self.path)
+        with mock.patch('mitogen.master.scan_code_imports') as scan:
+            found = self.klass(cache)._scan_imports(fullname)
+        self.assertEquals(expect, found)
+        self.assertEquals(0, scan.call_count)
+        self.assertFalse(fullname in sys.modules)
+
+    def test_relative_file(self):
+        import mitogen.fakessh
+        relpath = os.path.relpath(mitogen.fakessh.__file__)
+        with mock.patch.object(mitogen.fakessh, '__file__', relpath):
+            self.call('mitogen.fakessh')
+            with mock.patch('mitogen.master.scan_code_imports') as scan:
+                self.call('mitogen.fakessh')
+        self.assertEquals(0, scan.call_count)
+
+
 if __name__ == '__main__':
     unittest2.main()
@@ -3,10 +3,13 @@ import os
 import subprocess
 import tempfile
 import time
+import zlib
 
+import mock
 import unittest2
 import testlib
 
+import mitogen.core
 import mitogen.parent
 
 
@@ -102,6 +105,69 @@ class ContextTest(testlib.RouterMixin, unittest2.TestCase):
         self.assertRaises(OSError, lambda: os.kill(pid, 0))
 
 
+class PreambleSizeTest(testlib.RouterMixin, testlib.TestCase):
+    def test_fits_pipe_buffer(self):
+        # The first stage writes the compressed preamble to a pipe and exits,
+        # and the child reaps it before reading the pipe, so a preamble larger
+        # than the smallest common pipe buffer (64 KiB) deadlocks the
+        # bootstrap.
+        stream = mitogen.parent.Stream(self.router, 0,
+                                       max_message_size=128 * 1048576)
+        preamble = stream.get_preamble()
+        self.assertTrue(len('%d\n%s' % (len(preamble), preamble)) < 65536)
+
+
+class MakeLoadModuleMsgsTest(testlib.TestCase):
+    func = staticmethod(mitogen.parent.make_load_module_msgs)
+
+    def setUp(self):
+        super(MakeLoadModuleMsgsTest, self).setUp()
+        self.stream = mock.Mock(bundle_modules=True)
+        # 0:fullname 1:pkg_present 2:path 3:compressed 4:related
+        self.tups = [
+            ('pkg', ['a'], 'pkg/__init__.py', zlib.compress(''), []),
+            ('pkg.a', None, 'pkg/a.py', zlib.compress('x = 1\n'), []),
+            ('pkg.b', None, 'pkg/b.py', None, []),
+        ]
+
+    def test_single(self):
+        msg, = self.func(self.stream, self.tups[:1], 123)
+        self.assertEquals(mitogen.core.LOAD_MODULE, msg.handle)
+        self.assertEquals(123, msg.dst_id)
+        self.assertEquals(self.tups[0], msg.unpickle())
+
+    def test_bundle(self):
+        msg, = self.func(self.stream, self.tups, 123)
+        self.assertEquals(mitogen.core.LOAD_MODULES, msg.handle)
+        self.assertEquals(123, msg.dst_id)
+        bundle = mitogen.core.Message(data=zlib.decompress(msg.data))
+        self.assertEquals([
+            ('pkg', ['a'], 'pkg/__init__.py', '', []),
+            ('pkg.a', None, 'pkg/a.py', 'x = 1\n', []),
+            ('pkg.b', None, 'pkg/b.py', None, []),
+        ], list(bundle.unpickle()))
+
+    def test_bundle_cached(self):
+        cache = {}
+        msg1, = self.func(self.stream, self.tups, 123, cache)
+        msg2, = self.func(self.stream, self.tups, 456, cache)
+        self.assertEquals(1, len(cache))
+        self.assertTrue(msg1.data is msg2.data)
+        self.assertEquals(456, msg2.dst_id)
+
+        # Omitting source changes the bundle.
+        tups = self.tups[:1] + [self.tups[1][:3] + (None, [])] + self.tups[2:]
+        self.func(self.stream, tups, 123, cache)
+        self.assertEquals(2, len(cache))
+
+    def test_bundle_disabled(self):
+        self.stream.bundle_modules = False
+        msgs = self.func(self.stream, self.tups, 123)
+        self.assertEquals([mitogen.core.LOAD_MODULE] * 3,
+                          [msg.handle for msg in msgs])
+        self.assertEquals(self.tups, [msg.unpickle() for msg in msgs])
+
+
 class TtyCreateChildTest(unittest2.TestCase):
     func = staticmethod(mitogen.parent.tty_create_child)
 
@@ -120,7 +186,7 @@ class TtyCreateChildTest(unittest2.TestCase):
             pid, fd, _ = self.func(
                 'bash', '-c', 'exec 2>%s; echo hi > /dev/tty' % (tf.name,)
             )
-            deadline = time.time() + 5.0
+            deadline = mitogen.core.now() + 5.0
             for line in mitogen.parent.iter_read([fd], deadline):
                 self.assertEquals('hi\n', line)
                 break
@@ -168,7 +234,7 @@ class IterReadTest(unittest2.TestCase):
 
     def test_deadline_exceeded_during_call(self):
         proc = self.make_proc()
-        reader = self.func([proc.stdout.fileno()], time.time() + 0.4)
+        reader = self.func([proc.stdout.fileno()], mitogen.core.now() + 0.4)
         try:
             got = []
             try:
@@ -214,7 +280,7 @@ class WriteAllTest(unittest2.TestCase):
     def test_deadline_exceeded_during_call(self):
         proc = self.make_proc()
         try:
-            deadline = time.time() + 0.1   # 100ms deadline
+            deadline = mitogen.core.now() + 0.1   # 100ms deadline
             self.assertRaises(mitogen.core.TimeoutError, (
                 lambda: self.func(proc.stdin.fileno(),
                                   self.ten_ms_chunk * 100,  # 1s of data
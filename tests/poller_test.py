@@ -0,0 +1,314 @@
+
+import select
+import socket
+
+import unittest2
+
+import mitogen.core
+import mitogen.parent
+
+import testlib
+
+
+class SockMixin(object):
+    def tearDown(self):
+        self.l1.close()
+        self.r1.close()
+        self.l2.close()
+        self.r2.close()
+        super(SockMixin, self).tearDown()
+
+    def setUp(self):
+        super(SockMixin, self).setUp()
+        self.l1, self.r1 = socket.socketpair()
+        self.l2, self.r2 = socket.socketpair()
+        for sock in self.l1, self.r1, self.l2, self.r2:
+            mitogen.core.set_nonblock(sock.fileno())
+
+    def fill(self, sock):
+        try:
+            while True:
+                sock.send('x' * 4096)
+        except socket.error:
+            pass
+
+
+class PollerMixin(object):
+    klass = None
+
+    def setUp(self):
+        super(PollerMixin, self).setUp()
+        self.p = self.klass()
+
+    def tearDown(self):
+        self.p.close()
+        super(PollerMixin, self).tearDown()
+
+
+class ReceiveStateMixin(PollerMixin, SockMixin):
+    def test_start_receive_adds_reader(self):
+        self.p.start_receive(self.l1.fileno())
+        self.assertEquals([(self.l1.fileno(), self.l1.fileno())],
+                          self.p.readers)
+        self.assertEquals([], self.p.writers)
+
+    def test_start_receive_adds_reader_data(self):
+        data = object()
+        self.p.start_receive(self.l1.fileno(), data=data)
+        self.assertEquals([(self.l1.fileno(), data)], self.p.readers)
+
+    def test_stop_receive(self):
+        self.p.start_receive(self.l1.fileno())
+        self.p.stop_receive(self.l1.fileno())
+        self.assertEquals([], self.p.readers)
+
+    def test_stop_receive_dup(self):
+        self.p.start_receive(self.l1.fileno())
+        self.p.stop_receive(self.l1.fileno())
+        self.p.stop_receive(self.l1.fileno())
+        self.assertEquals([], self.p.readers)
+
+    def test_stop_receive_noexist(self):
+        self.p.stop_receive(123)
+        self.assertEquals([], self.p.readers)
+
+
+class TransmitStateMixin(PollerMixin, SockMixin):
+    def test_start_transmit_adds_writer(self):
+        self.p.start_transmit(self.r1.fileno())
+        self.assertEquals([(self.r1.fileno(), self.r1.fileno())],
+                          self.p.writers)
+        self.assertEquals([], self.p.readers)
+
+    def test_stop_transmit(self):
+        self.p.start_transmit(self.r1.fileno())
+        self.p.stop_transmit(self.r1.fileno())
+        self.assertEquals([], self.p.writers)
+
+
+class ReadableMixin(PollerMixin, SockMixin):
+    def test_unreadable(self):
+        self.p.start_receive(self.l1.fileno())
+        self.assertEquals([], list(self.p.poll(0)))
+
+    def test_readable_before_add(self):
+        self.r1.send('x')
+        self.p.start_receive(self.l1.fileno())
+        self.assertEquals([self.l1.fileno()], list(self.p.poll(0)))
+
+    def test_readable_after_add(self):
+        self.p.start_receive(self.l1.fileno())
+        self.r1.send('x')
+        self.assertEquals([self.l1.fileno()], list(self.p.poll(0)))
+
+    def test_readable_then_unreadable(self):
+        self.r1.send('x')
+        self.p.start_receive(self.l1.fileno())
+        self.assertEquals([self.l1.fileno()], list(self.p.poll(0)))
+        self.l1.recv(1)
+        self.assertEquals([], list(self.p.poll(0)))
+
+    def test_readable_data(self):
+        data = object()
+        self.r1.send('x')
+        self.p.start_receive(self.l1.fileno(), data)
+        self.assertEquals([data], list(self.p.poll(0)))
+
+    def test_double_readable_data(self):
+        data1 = object()
+        data2 = object()
+        self.r1.send('x')
+        self.p.start_receive(self.l1.fileno(), data1)
+        self.r2.send('x')
+        self.p.start_receive(self.l2.fileno(), data2)
+        self.assertEquals(set([data1, data2]), set(self.p.poll(0)))
+
+    def test_stopped_not_reported(self):
+        self.r1.send('x')
+        self.p.start_receive(self.l1.fileno())
+        self.p.stop_receive(self.l1.fileno())
+        self.assertEquals([], list(self.p.poll(0)))
+
+    def test_hangup_is_readable(self):
+        self.p.start_receive(self.l1.fileno())
+        self.r1.close()
+        self.assertEquals([self.l1.fileno()], list(self.p.poll(0)))
+
+
+class WriteableMixin(PollerMixin, SockMixin):
+    def test_writeable(self):
+        self.p.start_transmit(self.r1.fileno())
+        self.assertEquals([self.r1.fileno()], list(self.p.poll(0)))
+
+    def test_writeable_data(self):
+        data = object()
+        self.p.start_transmit(self.r1.fileno(), data)
+        self.assertEquals([data], list(self.p.poll(0)))
+
+    def test_writeable_then_unwriteable(self):
+        self.p.start_transmit(self.r1.fileno())
+        self.assertEquals([self.r1.fileno()], list(self.p.poll(0)))
+        self.fill(self.r1)
+        self.assertEquals([], list(self.p.poll(0)))
+
+    def test_writeable_then_unwriteable_then_writeable(self):
+        self.p.start_transmit(self.r1.fileno())
+        self.fill(self.r1)
+        self.assertEquals([], list(self.p.poll(0)))
+        while self.l1.recv(65536):
+            if list(self.p.poll(0)):
+                break
+        self.assertEquals([self.r1.fileno()], list(self.p.poll(0)))
+
+
+class MutateDuringYieldMixin(PollerMixin, SockMixin):
+    # verify behaviour when poller contents is modified in the middle of
+    # poll() output generation.
+
+    def test_one_readable_removed_before_yield(self):
+        self.l1.send('x')
+        self.p.start_receive(self.r1.fileno())
+        p = self.p.poll(0)
+        self.p.stop_receive(self.r1.fileno())
+        self.assertEquals([], list(p))
+
+    def test_one_readable_readded_before_yield(self):
+        # fd removed, closed, another fd opened, gets same fd number, re-added.
+        # event fires for wrong underlying object.
+        self.l1.send('x')
+        self.p.start_receive(self.r1.fileno())
+        p = self.p.poll(0)
+        self.p.stop_receive(self.r1.fileno())
+        self.p.start_receive(self.r1.fileno())
+        self.assertEquals([], list(p))
+
+    def test_one_readable_readded_during_yield(self):
+        self.l1.send('1')
+        self.l2.send('2')
+        self.p.start_receive(self.r1.fileno())
+        self.p.start_receive(self.r2.fileno())
+        p = self.p.poll(0)
+
+        # figure out which one is consumed and which is still to-read.
+        consumed = next(p)
+        ready = (self.r1, self.r2)[consumed == self.r1.fileno()]
+
+        # now remove and re-add the one that hasn't been read yet.
+        self.p.stop_receive(ready.fileno())
+        self.p.start_receive(ready.fileno())
+
+        # the start_receive() may be for a totally new underlying file object,
+        # the live loop iteration must not yield any buffered readiness event.
+        self.assertEquals([], list(p))
+
+
+class BothMixin(PollerMixin, SockMixin):
+    def test_same_fd_read_and_write(self):
+        rdata = object()
+        wdata = object()
+        self.r1.send('x')
+        self.p.start_receive(self.l1.fileno(), rdata)
+        self.p.start_transmit(self.l1.fileno(), wdata)
+        self.assertEquals(set([rdata, wdata]), set(self.p.poll(0)))
+
+    def test_stop_transmit_keeps_receive(self):
+        self.r1.send('x')
+        self.p.start_receive(self.l1.fileno())
+        self.p.start_transmit(self.l1.fileno())
+        self.p.stop_transmit(self.l1.fileno())
+        self.assertEquals([self.l1.fileno()], list(self.p.poll(0)))
+
+
+class BatchingMixin(PollerMixin, SockMixin):
+    def setUp(self):
+        super(BatchingMixin, self).setUp()
+        self.updated = []
+        update = self.p._update
+
+        def _update(fd):
+            self.updated.append(fd)
+            update(fd)
+        self.p._update = _update
+
+    def test_toggles_coalesced(self):
+        fd = self.l1.fileno()
+        self.p.start_receive(fd)
+        for x in xrange(10):
+            self.p.start_transmit(fd)
+            self.p.stop_transmit(fd)
+        self.assertEquals([], self.updated)
+        list(self.p.poll(0))
+        self.assertEquals([fd], self.updated)
+        self.assertEquals(21, self.p.changes)
+        self.assertEquals(1, self.p.updates)
+        self.assertEquals(1, self.p.polls)
+
+    def test_removal_immediate(self):
+        fd = self.l1.fileno()
+        self.p.start_receive(fd)
+        list(self.p.poll(0))
+        del self.updated[:]
+        self.p.stop_receive(fd)
+        self.assertEquals([fd], self.updated)
+
+    def test_add_then_remove_cancels(self):
+        fd = self.l1.fileno()
+        self.r1.send('x')
+        self.p.start_receive(fd)
+        self.p.stop_receive(fd)
+        self.assertEquals([], list(self.p.poll(0)))
+        self.assertEquals([], self.p.readers)
+
+
+class AllMixin(ReceiveStateMixin,
+               TransmitStateMixin,
+               ReadableMixin,
+               WriteableMixin,
+               MutateDuringYieldMixin,
+               BothMixin,
+               BatchingMixin):
+    pass
+
+
+class SelectTest(AllMixin, testlib.TestCase):
+    klass = mitogen.core.Poller
+
+
+class PollTest(AllMixin, testlib.TestCase):
+    klass = mitogen.parent.PollPoller
+
+
+PollTest = unittest2.skipIf(
+    condition=not hasattr(select, 'poll'),
+    reason='select.poll() not available',
+)(PollTest)
+
+
+class EpollTest(AllMixin, testlib.TestCase):
+    klass = mitogen.parent.EpollPoller
+
+    def test_closed_fd_is_forgotten(self):
+        # Kernel drops the registration when the last reference is closed;
+        # a new descriptor reusing the number must still be registrable.
+        sock1, sock2 = socket.socketpair()
+        fd = sock1.fileno()
+        self.p.start_receive(fd)
+        sock1.close()
+        self.p.stop_receive(fd)
+        sock2.close()
+
+
+EpollTest = unittest2.skipIf(
+    condition=not hasattr(select, 'epoll'),
+    reason='select.epoll() not available',
+)(EpollTest)
+
+
+class BrokerTest(testlib.BrokerMixin, testlib.TestCase):
+    def test_preferred_poller(self):
+        self.assertTrue(isinstance(self.broker.poller,
+                                   mitogen.parent.PREFERRED_POLLER))
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -1,10 +1,16 @@
 
+import hashlib
+import imp
 import mock
+import os
+import shutil
 import subprocess
 import sys
+import tempfile
 
 import unittest2
 
+import mitogen.core
 import mitogen.master
 import testlib
 
@@ -34,6 +40,170 @@ class GoodModulesTest(testlib.RouterMixin, unittest2.TestCase):
         self.assertEquals(output, "['__main__', 50]\n")
 
 
+class ModuleCacheTest(testlib.RouterMixin, unittest2.TestCase):
+    def setUp(self):
+        super(ModuleCacheTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(ModuleCacheTest, self).tearDown()
+
+    def test_warm_cache_omits_source(self):
+        # The first child populates the cache; the second advertises it, and
+        # the responder must send it source stubs it can still import from.
+        context = self.router.local(module_cache=self.path)
+        self.assertEquals(256, context.call(plain_old_module.pow, 2, 8))
+        context.shutdown(wait=True)
+
+        context = self.router.local(module_cache=self.path)
+        self.assertEquals(256, context.call(plain_old_module.pow, 2, 8))
+        stream = self.router.stream_by_id(context.context_id)
+        self.assertTrue(stream.cached_modules)
+        self.assertTrue('plain_old_module' in stream.sent_modules)
+
+    def test_corrupt_cache_refetches(self):
+        context = self.router.local(module_cache=self.path)
+        context.call(plain_old_module.pow, 2, 8)
+        context.shutdown(wait=True)
+
+        for name in os.listdir(self.path):
+            fp = open(os.path.join(self.path, name), 'wb')
+            fp.write('garbage')
+            fp.close()
+
+        context = self.router.local(module_cache=self.path)
+        self.assertEquals(256, context.call(plain_old_module.pow, 2, 8))
+
+
+class ForwarderModuleCacheTest(testlib.RouterMixin, unittest2.TestCase):
+    def setUp(self):
+        super(ForwarderModuleCacheTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(ForwarderModuleCacheTest, self).tearDown()
+
+    def entry_path(self, fullname):
+        finder = self.router.responder._finder
+        _, source, _ = finder.get_module_source(fullname)
+        return os.path.join(self.path, hashlib.sha1(source).hexdigest())
+
+    def test_warm_cache_omits_source(self):
+        # The first target populates the cache. The intermediary must send the
+        # second a stub, which it completes from the cache, marking the entry
+        # as recently used.
+        via = self.router.local()
+        context = self.router.local(via=via, module_cache=self.path)
+        self.assertEquals(256, context.call(plain_old_module.pow, 2, 8))
+        context.shutdown(wait=True)
+
+        path = self.entry_path('plain_old_module')
+        os.utime(path, (1000, 1000))
+        context = self.router.local(via=via, module_cache=self.path)
+        self.assertEquals(256, context.call(plain_old_module.pow, 2, 8))
+        self.assertTrue(os.path.getmtime(path) > 1000)
+
+
+class BytecodeTest(testlib.RouterMixin, unittest2.TestCase):
+    def test_code_sent(self):
+        context = self.router.local(bytecode=True)
+        self.assertEquals(256, context.call(plain_old_module.pow, 2, 8))
+        stream = self.router.stream_by_id(context.context_id)
+        self.assertEquals(imp.get_magic(), stream.code_magic)
+        self.assertTrue(self.router.responder._code_cache['plain_old_module'])
+
+    def test_code_not_sent_by_default(self):
+        context = self.router.local()
+        self.assertEquals(256, context.call(plain_old_module.pow, 2, 8))
+        stream = self.router.stream_by_id(context.context_id)
+        self.assertEquals(None, stream.code_magic)
+        self.assertFalse('plain_old_module' in
+                         self.router.responder._code_cache)
+
+    def test_magic_mismatch(self):
+        context = self.router.local(bytecode=True)
+        stream = self.router.stream_by_id(context.context_id)
+        context.call(str)  # Wait for CODE_MAGIC.
+        stream.code_magic = 'bad!'
+        self.assertEquals(256, context.call(plain_old_module.pow, 2, 8))
+        self.assertFalse('plain_old_module' in
+                         self.router.responder._code_cache)
+
+    def test_source_omitted(self):
+        responder = self.router.responder
+        prepare_tuple = responder._prepare_tuple
+        sent = {}
+
+        def _prepare_tuple(stream, fullname):
+            tup = sent[fullname] = prepare_tuple(stream, fullname)
+            return tup
+        responder._prepare_tuple = _prepare_tuple
+
+        context = self.router.local(bytecode=True)
+        self.assertEquals(256, context.call(plain_old_module.pow, 2, 8))
+        tup = sent['plain_old_module']
+        self.assertEquals(None, tup[3])
+        self.assertTrue(tup[6])
+
+    def test_via_matching_child(self):
+        via = self.router.local(bytecode=True)
+        context = self.router.local(via=via, bytecode=True)
+        self.assertEquals(256, context.call(plain_old_module.pow, 2, 8))
+
+    def test_via_mismatched_child(self):
+        # The intermediary received only code, so must fetch source for a
+        # child that cannot run it.
+        via = self.router.local(bytecode=True)
+        context = self.router.local(via=via)
+        self.assertEquals(256, context.call(plain_old_module.pow, 2, 8))
+
+
+class PreloadTest(testlib.RouterMixin, unittest2.TestCase):
+    def setUp(self):
+        super(PreloadTest, self).setUp()
+        self.requests = []
+        persist, fn, policy = self.router._handle_map[mitogen.core.GET_MODULE]
+
+        def on_get_module(msg):
+            self.requests.append(msg.data)
+            fn(msg)
+        self.router._handle_map[mitogen.core.GET_MODULE] = (
+            persist, on_get_module, policy
+        )
+
+    def test_closure_sent_before_call(self):
+        context = self.router.local(preload_modules=True)
+        self.assertEquals(3,
+            context.call(simple_pkg.a.subtract_one_add_two, 2))
+        self.assertEquals([], self.requests)
+        stream = self.router.stream_by_id(context.context_id)
+        for name in 'simple_pkg', 'simple_pkg.a', 'simple_pkg.b':
+            self.assertTrue(name in stream.sent_modules)
+
+    def test_disabled_by_default(self):
+        context = self.router.local()
+        self.assertEquals(3,
+            context.call(simple_pkg.a.subtract_one_add_two, 2))
+        self.assertTrue('simple_pkg.a' in self.requests)
+
+    def test_disabled_no_defer(self):
+        context = self.router.local()
+        with mock.patch.object(self.router.broker, 'defer') as defer:
+            self.router.responder.preload(context, 'simple_pkg.a')
+        self.assertEquals(0, defer.call_count)
+
+    def test_stdlib_ignored(self):
+        context = self.router.local(preload_modules=True)
+        log = testlib.LogCapturer()
+        log.start()
+        self.assertEquals(context.call(os.getpid), context.call(os.getpid))
+        self.assertEquals('', log.stop())
+        stream = self.router.stream_by_id(context.context_id)
+        self.assertFalse('posix' in stream.sent_modules)
+
+
 class BrokenModulesTest(unittest2.TestCase):
     def test_obviously_missing(self):
         # Ensure we don't crash in the case of a module legitimately being
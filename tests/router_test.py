@@ -25,6 +25,22 @@ def send_n_sized_reply(sender, n):
     return 123
 
 
+def return_n_bytes(n):
+    return ' ' * n
+
+
+def send_n_raw_bytes(sender, n):
+    sender.context.send(mitogen.core.Message(data=' ' * n,
+                                             handle=sender.dst_handle))
+
+
+@mitogen.core.takes_router
+def get_discarding_sender(router):
+    recv = mitogen.core.Receiver(router, fragments=True)
+    recv.notify = lambda recv: recv.get()
+    return recv.to_sender()
+
+
 class SourceVerifyTest(testlib.RouterMixin, unittest2.TestCase):
     def setUp(self):
         super(SourceVerifyTest, self).setUp()
@@ -89,6 +105,82 @@ class SourceVerifyTest(testlib.RouterMixin, unittest2.TestCase):
         self.assertTrue(expect in log.stop())
 
 
+class ForwardTest(testlib.RouterMixin, testlib.TestCase):
+    def setUp(self):
+        super(ForwardTest, self).setUp()
+        self.child1 = self.router.fork()
+        self.child2 = self.router.fork()
+        self.child1_stream = self.router._stream_by_id[self.child1.context_id]
+        self.child2_stream = self.router._stream_by_id[self.child2.context_id]
+        # Route changes reset verdicts, so ping only after both exist.
+        self.child1.call(ping)
+
+    def call_on_broker(self, func, *args):
+        latch = mitogen.core.Latch()
+        self.broker.defer(lambda: latch.put(func(*args)))
+        return latch.get()
+
+    def frame(self, dst_id, src_id, auth_id, data='data'):
+        return mitogen.core.Stream.header_codec.pack(
+            dst_id, src_id, auth_id, 100, 0, len(data)
+        ) + data
+
+    def forward(self, in_stream, dst_id, src_id):
+        return self.call_on_broker(self.router._async_forward, in_stream,
+                                   dst_id, src_id, src_id, 100,
+                                   [self.frame(dst_id, src_id, src_id)])
+
+    def test_verified_forwarded(self):
+        def forward_and_measure():
+            before = self.child2_stream.pending_bytes()
+            forwarded = self.router._async_forward(
+                self.child1_stream, self.child2.context_id,
+                self.child1.context_id, self.child1.context_id, 100,
+                [self.frame(self.child2.context_id, self.child1.context_id,
+                            self.child1.context_id)]
+            )
+            return forwarded, self.child2_stream.pending_bytes() - before
+
+        forwarded, queued = self.call_on_broker(forward_and_measure)
+        self.assertTrue(forwarded)
+        self.assertEquals(24 + len('data'), queued)
+
+    def test_unverified_not_forwarded(self):
+        self.assertFalse(self.forward(self.child2_stream,
+                                      self.child2.context_id,
+                                      self.child1.context_id))
+
+    def test_no_route_not_forwarded(self):
+        self.assertFalse(self.forward(self.child1_stream, 1234,
+                                      self.child1.context_id))
+
+    def test_disconnect_clears_verdicts(self):
+        key = self.child1.context_id, self.child1.context_id
+        self.assertTrue(self.router._stream_by_ids[key] is self.child1_stream)
+        self.child1.shutdown(wait=True)
+        self.sync_with_broker()
+        self.assertFalse(key in self.router._stream_by_ids)
+
+    def test_restamp(self):
+        self.child1_stream.auth_id = 1234
+        pieces = [self.frame(self.child2.context_id, self.child1.context_id,
+                             self.child1.context_id)]
+        self.assertTrue(self.call_on_broker(
+            self.router._async_forward, self.child1_stream,
+            self.child2.context_id, self.child1.context_id,
+            self.child1.context_id, 100, pieces,
+        ))
+        frame = self.frame(self.child2.context_id, self.child1.context_id,
+                           1234)
+        hdr_len = mitogen.core.Stream.HEADER_LEN
+        self.assertEquals([frame[:hdr_len], 'data'], map(str, pieces))
+
+    def test_verdicts_bounded(self):
+        self.router.max_verified_ids = 1
+        self.child2.call(ping)
+        self.assertEquals(1, len(self.router._stream_by_ids))
+
+
 class PolicyTest(testlib.RouterMixin, testlib.TestCase):
     def test_allow_any(self):
         # This guy gets everything.
@@ -218,6 +310,173 @@ class MessageSizeTest(testlib.BrokerMixin, unittest2.TestCase):
         self.assertTrue(expect in logs.stop())
 
 
+class FragmentTest(testlib.RouterMixin, testlib.TestCase):
+    def fragment(self, handle, data, reply_to=mitogen.core.IS_FRAGMENT,
+                 src_id=None):
+        self.router.route(mitogen.core.Message(
+            dst_id=mitogen.context_id,
+            src_id=src_id or mitogen.context_id,
+            handle=handle,
+            reply_to=reply_to,
+            data=data,
+        ))
+
+    def test_reassembled(self):
+        recv = mitogen.core.Receiver(self.router)
+        self.fragment(recv.handle, 'ab')
+        self.fragment(recv.handle, 'cd')
+        self.sync_with_broker()
+        self.assertTrue(recv.empty())
+        self.fragment(recv.handle, 'ef', reply_to=0)
+        msg = recv.get()
+        self.assertEquals('abcdef', msg.data)
+        self.assertFalse(msg.is_fragment)
+        self.assertTrue(recv.empty())
+        self.assertEquals({}, self.router._fragments)
+
+    def test_sources_separate(self):
+        recv = mitogen.core.Receiver(self.router)
+        self.fragment(recv.handle, 'ab', src_id=1234)
+        self.fragment(recv.handle, 'cd')
+        self.fragment(recv.handle, 'ef', reply_to=0, src_id=1234)
+        self.fragment(recv.handle, 'gh', reply_to=0)
+        self.assertEquals('abef', recv.get().data)
+        self.assertEquals('cdgh', recv.get().data)
+
+    def test_stream(self):
+        recv = mitogen.core.Receiver(self.router, persist=False,
+                                     fragments=True)
+        self.fragment(recv.handle, 'ab')
+        self.fragment(recv.handle, 'cd', reply_to=0)
+        msg = recv.get()
+        self.assertTrue(msg.is_fragment)
+        self.assertEquals('ab', msg.data)
+        msg = recv.get()
+        self.assertFalse(msg.is_fragment)
+        self.assertEquals('cd', msg.data)
+        self.assertFalse(recv.handle in self.router._handle_map)
+        self.assertFalse(recv.handle in self.router._fragment_handles)
+
+    def test_too_large(self):
+        self.router.max_message_size = 3
+        recv = mitogen.core.Receiver(self.router)
+        reply = mitogen.core.Receiver(self.router)
+        log = testlib.LogCapturer()
+        log.start()
+        self.fragment(recv.handle, 'ab')
+        self.fragment(recv.handle, 'cd')
+        self.fragment(recv.handle, 'ef', reply_to=reply.handle)
+        self.assertRaises(mitogen.core.ChannelError, reply.get)
+        self.assertTrue('message too large (max 3 bytes)' in log.stop())
+        self.assertTrue(recv.empty())
+        self.assertEquals({}, self.router._fragments)
+
+    def test_disconnect_discards(self):
+        recv = mitogen.core.Receiver(self.router)
+        child = self.router.fork()
+        stream = self.router.stream_by_id(child.context_id)
+        self.broker.defer(self.router._async_route, mitogen.core.Message(
+            dst_id=mitogen.context_id,
+            src_id=child.context_id,
+            auth_id=child.context_id,
+            handle=recv.handle,
+            reply_to=mitogen.core.IS_FRAGMENT,
+            data='ab',
+        ), stream)
+        self.sync_with_broker()
+        self.assertEquals(1, len(self.router._fragments))
+        log = testlib.LogCapturer()
+        log.start()
+        child.shutdown(wait=True)
+        self.sync_with_broker()
+        self.assertTrue('lost while receiving a fragmented message' in
+                        log.stop())
+        self.assertEquals({}, self.router._fragments)
+
+    def test_remote_reply(self):
+        child = self.router.fork()
+        n = 3 * mitogen.core.Stream.fragment_size + 1
+        self.assertEquals(n, len(child.call(return_n_bytes, n)))
+
+    def test_remote_stream(self):
+        recv = mitogen.core.Receiver(self.router, fragments=True)
+        child = self.router.fork()
+        n = 3 * mitogen.core.Stream.fragment_size
+        child.call(send_n_sized_reply, recv.to_sender(), n)
+        msgs = [recv.get() for x in range(4)]
+        self.assertEquals([True, True, True, False],
+                          [msg.is_fragment for msg in msgs])
+        self.assertTrue(all(len(msg.data) <= n // 3 for msg in msgs))
+        data = ''.join(msg.data for msg in msgs)
+        self.assertEquals(' ' * n, mitogen.core.Message(data=data).unpickle())
+
+    def test_iter_data(self):
+        recv = mitogen.core.Receiver(self.router, fragments=True)
+        self.fragment(recv.handle, 'ab')
+        self.fragment(recv.handle, 'cd', reply_to=0)
+        self.fragment(recv.handle, 'ef', reply_to=0)
+        self.assertEquals(['ab', 'cd'], list(recv.iter_data()))
+        self.assertEquals(['ef'], list(recv.iter_data()))
+
+    def test_iter_data_closed(self):
+        recv = mitogen.core.Receiver(self.router, fragments=True)
+        self.fragment(recv.handle, 'ab')
+        self.sync_with_broker()
+        recv.close()
+        it = recv.iter_data()
+        self.assertEquals('ab', next(it))
+        self.assertRaises(mitogen.core.ChannelError, lambda: next(it))
+
+    def test_dead_discards(self):
+        recv = mitogen.core.Receiver(self.router)
+        self.fragment(recv.handle, 'ab')
+        self.fragment(recv.handle, '', reply_to=mitogen.core.IS_DEAD)
+        self.assertRaises(mitogen.core.ChannelError, recv.get)
+        self.assertEquals({}, self.router._fragments)
+
+    def test_relayed_cut_through(self):
+        recv = mitogen.core.Receiver(self.router, fragments=True)
+        via = self.router.fork()
+        child = self.router.fork(via=via)
+        n = 3 * mitogen.core.CHUNK_SIZE
+        child.call(send_n_raw_bytes, recv.to_sender(), n)
+        sizes = [len(s) for s in recv.iter_data()]
+        self.assertTrue(len(sizes) > 1)
+        self.assertEquals(n, sum(sizes))
+
+    def test_relayed_reassembled(self):
+        via = self.router.fork()
+        child = self.router.fork(via=via)
+        n = 3 * mitogen.core.CHUNK_SIZE
+        self.assertEquals(' ' * n, child.call(return_n_bytes, n))
+
+    def test_remote_iter_data(self):
+        recv = mitogen.core.Receiver(self.router, fragments=True)
+        child = self.router.fork()
+        n = 3 * mitogen.core.Stream.fragment_size + 1
+        child.call(send_n_raw_bytes, recv.to_sender(), n)
+        sizes = [len(s) for s in recv.iter_data()]
+        self.assertEquals(4, len(sizes))
+        self.assertEquals(n, sum(sizes))
+
+
+class PriorityTest(testlib.RouterMixin, testlib.TestCase):
+    def test_call_overtakes_bulk(self):
+        child = self.router.fork(priority_lanes=True)
+        sender = child.call(get_discarding_sender)
+        stream = self.router.stream_by_id(child.context_id)
+        size = 32 * mitogen.core.Stream.fragment_size
+        child.send(mitogen.core.Message(data=' ' * size,
+                                        handle=sender.dst_handle))
+        t0 = time.time()
+        child.call(ping)
+        latency = time.time() - t0
+        pending = stream.pending_bytes()
+        self.assertTrue(pending > size // 2,
+                        'call took %.1f ms, leaving %d bytes queued' % (
+                            1000 * latency, pending))
+
+
 class NoRouteTest(testlib.RouterMixin, testlib.TestCase):
     def test_invalid_handle_returns_dead(self):
         # Verify sending a message to an invalid handle yields a dead message
@@ -260,5 +519,27 @@ class NoRouteTest(testlib.RouterMixin, testlib.TestCase):
         self.assertEquals(e.args[0], mitogen.core.ChannelError.local_msg)
 
 
+class RouteThrottledTest(testlib.RouterMixin, testlib.TestCase):
+    def route_throttled(self, msg):
+        latch = mitogen.core.Latch()
+        self.router.route_throttled(msg, latch.put)
+        return latch.get(timeout=5.0)
+
+    def test_local(self):
+        recv = mitogen.core.Receiver(self.router)
+        msg = mitogen.core.Message.pickled(1, dst_id=mitogen.context_id,
+                                           handle=recv.handle)
+        self.assertTrue(self.route_throttled(msg))
+
+    def test_remote(self):
+        l1 = self.router.fork()
+        msg = mitogen.core.Message(dst_id=l1.context_id, handle=999)
+        self.assertTrue(self.route_throttled(msg))
+
+    def test_no_route(self):
+        msg = mitogen.core.Message(dst_id=1234, handle=1234)
+        self.assertFalse(self.route_throttled(msg))
+
+
 if __name__ == '__main__':
     unittest2.main()
@@ -0,0 +1,49 @@
+
+import unittest2
+
+import mitogen.core
+import testlib
+
+
+def send_congested(sender, count):
+    # Every message congests the stream to the parent.
+    mitogen.core.Stream.high_watermark = 1
+    mitogen.core.Stream.low_watermark = 0
+    for x in xrange(count):
+        sender.send((x, 'x' * 1000), block=True)
+    sender.close()
+    return count
+
+
+class BlockingSendTest(testlib.RouterMixin, testlib.TestCase):
+    def test_local(self):
+        recv = mitogen.core.Receiver(self.router)
+        sender = recv.to_sender()
+        for x in range(10):
+            sender.send(x, block=True)
+        self.assertEquals(range(10), [recv.get().unpickle()
+                                      for x in range(10)])
+
+    def test_congested(self):
+        local = self.router.local()
+        recv = mitogen.core.Receiver(self.router)
+        ret = local.call_async(send_congested, recv.to_sender(), 100)
+        self.assertEquals(range(100), [m.unpickle()[0] for m in recv])
+        self.assertEquals(100, ret.get().unpickle())
+
+    def test_broker_thread(self):
+        recv = mitogen.core.Receiver(self.router)
+        sender = recv.to_sender()
+        latch = mitogen.core.Latch()
+
+        def func():
+            try:
+                sender.send(1, block=True)
+            except SystemError:
+                latch.put(True)
+        self.broker.defer(func)
+        self.assertTrue(latch.get(timeout=5.0))
+
+
+if __name__ == '__main__':
+    unittest2.main()
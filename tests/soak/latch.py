@@ -2,19 +2,25 @@
 Used for stressing Latch.get/put. Swap the number of producer/consumer threads
 below to try both -- there are many conditions in the Latch code that require
 testing of both.
+
+Usage:
+    latch.py [socket|lock]      Soak until enter is pressed.
+    latch.py bench              Compare latency and throughput of both waiter
+                                classes.
 """
 
 import logging
 import random
+import sys
 import threading
 import time
 import mitogen.core
 import mitogen.utils
 
-mitogen.utils.log_to_file()
-mitogen.core.IOLOG.setLevel(logging.DEBUG)
-mitogen.core._v = True
-mitogen.core._vv = True
+WAITERS = {
+    'socket': mitogen.core.SocketWaiter,
+    'lock': mitogen.core.LockWaiter,
+}
 
 l = mitogen.core.Latch()
 consumed = 0
@@ -37,15 +43,97 @@ def cons():
 def prod():
     global produced
     while 1:
-        l.put(random.random()/10)
+        l.put(random.random() / 10)
         produced += 1
-        time.sleep(random.random()/10)
+        time.sleep(random.random() / 10)
+
+
+def soak(waiter_class):
+    mitogen.utils.log_to_file()
+    mitogen.core.IOLOG.setLevel(logging.DEBUG)
+    mitogen.core._v = True
+    mitogen.core._vv = True
+    l.waiter_class = waiter_class
+
+    allc = [threading.Thread(target=cons) for x in range(64)]
+    allp = [threading.Thread(target=prod) for x in range(8)]
+    for th in allc + allp:
+        th.setDaemon(True)
+        th.start()
+
+    raw_input()
+
+
+def bench_latency(waiter_class, rounds=20000):
+    """Round trip time of a ping-pong between two threads, each sleeping in
+    get() for every message. The main thread is avoided, since LockWaiter
+    must poll there on Python 2 to remain interruptible."""
+    ping = mitogen.core.Latch()
+    pong = mitogen.core.Latch()
+    ping.waiter_class = pong.waiter_class = waiter_class
+
+    def echo():
+        for x in xrange(rounds):
+            pong.put(ping.get())
+
+    def send():
+        for x in xrange(rounds):
+            ping.put(x)
+            pong.get()
+
+    threads = [threading.Thread(target=echo), threading.Thread(target=send)]
+    t0 = time.time()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    return 1e6 * (time.time() - t0) / rounds
+
+
+def bench_throughput(waiter_class, nconsumers, nproducers=4, count=20000):
+    """Items per second passed from producers to many sleeping consumers."""
+    latch = mitogen.core.Latch()
+    latch.waiter_class = waiter_class
+
+    def consume():
+        while latch.get() is not None:
+            pass
+
+    def produce():
+        for x in xrange(count):
+            latch.put(x)
+
+    consumers = [threading.Thread(target=consume) for x in range(nconsumers)]
+    producers = [threading.Thread(target=produce) for x in range(nproducers)]
+    for th in consumers:
+        th.start()
+    t0 = time.time()
+    for th in producers:
+        th.start()
+    for th in producers:
+        th.join()
+    for th in consumers:
+        latch.put(None)
+    for th in consumers:
+        th.join()
+    return nproducers * count / (time.time() - t0)
+
+
+def bench():
+    for name, waiter_class in sorted(WAITERS.items()):
+        print '%-7s round trip latency: %6.1f usec' % (
+            name, bench_latency(waiter_class),
+        )
+    for nconsumers in 1, 16, 64:
+        for name, waiter_class in sorted(WAITERS.items()):
+            print '%-7s %2d consumers: %8.0f items/s' % (
+                name, nconsumers, bench_throughput(waiter_class, nconsumers),
+            )
 
-allc = [threading.Thread(target=cons) for x in range(64)]
-allp = [threading.Thread(target=prod) for x in range(8)]
-for th in allc+allp:
-    th.setDaemon(True)
-    th.start()
 
-raw_input()
-exit()
+if __name__ == '__main__':
+    mode = (sys.argv[1:] or ['socket'])[0]
+    if mode == 'bench':
+        bench()
+    else:
+        soak(WAITERS[mode])
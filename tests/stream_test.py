@@ -0,0 +1,740 @@
+
+import errno
+import os
+import select
+import struct
+import zlib
+
+import mock
+import unittest2
+
+import testlib
+import mitogen.core
+
+
+class FakeRouter(object):
+    max_message_size = 1048576
+    forward = False
+    verify = True
+
+    def __init__(self):
+        self.msgs = []
+        self.forwarded = []
+
+    def _async_route(self, msg, stream=None):
+        self.msgs.append(msg)
+
+    def _verify_source(self, msg, stream):
+        return self.verify
+
+    def _async_forward(self, in_stream, dst_id, src_id, auth_id, handle,
+                       pieces):
+        if self.forward:
+            self.forwarded.append(pieces)
+        return self.forward
+
+
+def frame(data, handle=100):
+    return struct.pack(mitogen.core.Stream.HEADER_FMT,
+                       1, 2, 3, handle, 4, len(data)) + data
+
+
+class HeaderCodecTest(testlib.TestCase):
+    klass = mitogen.core.HeaderCodec
+
+    def test_size(self):
+        self.assertEquals(24, self.klass().size)
+
+    def test_round_trip(self):
+        codec = self.klass()
+        msg = mitogen.core.Message(1, 2, 3, 4, 5, 'data')
+        hdr = codec.encode(msg)
+        self.assertEquals(struct.pack('>LLLLLL', 1, 2, 3, 4, 5, 4), hdr)
+        self.assertEquals((1, 2, 3, 4, 5, 4), codec.decode_from(hdr))
+
+    def test_reply_to_none(self):
+        codec = self.klass()
+        hdr = codec.encode(mitogen.core.Message(dst_id=1, handle=2))
+        self.assertEquals(0, codec.decode_from(hdr)[4])
+
+    def test_restamp(self):
+        codec = self.klass()
+        s = codec.restamp(frame('body'), 99)
+        self.assertEquals(struct.pack('>LLLLLL', 1, 2, 99, 100, 4, 4) + 'body',
+                          s)
+
+    def test_offset(self):
+        codec = self.klass()
+        buf = bytearray('junk' + frame('x'))
+        self.assertEquals((1, 2, 3, 100, 4, 1), codec.decode_from(buf, 4))
+
+    def test_truncated(self):
+        codec = self.klass()
+        self.assertEquals(None, codec.decode_from(frame('')[:23]))
+
+    def test_truncated_offset(self):
+        codec = self.klass()
+        self.assertEquals(None, codec.decode_from(frame(''), 1))
+
+    def test_truncated_end(self):
+        codec = self.klass()
+        buf = bytearray(frame('') + 'junk')
+        self.assertEquals(None, codec.decode_from(buf, 0, 23))
+        self.assertEquals((1, 2, 3, 100, 4, 0), codec.decode_from(buf, 0, 24))
+
+    def test_fragment(self):
+        codec = self.klass()
+        msg = mitogen.core.Message(1, 2, 3, 4, 5, 'data')
+        self.assertEquals(struct.pack('>LLLLLL', 1, 2, 3, 4, 6, 2),
+                          codec.encode(msg, 6, 2))
+
+    def test_oversized(self):
+        codec = self.klass()
+        hdr = struct.pack('>LLLLLL', 1, 2, 3, 4, 5, 0xffffffff)
+        e = self.assertRaises(mitogen.core.StreamError,
+            lambda: codec.decode_from(hdr, max_message_size=1048576))
+        self.assertEquals(str(e), codec.too_large_msg % (0xffffffff, 1048576))
+        self.assertEquals(0xffffffff, codec.decode_from(hdr)[5])
+
+    def test_at_limit(self):
+        codec = self.klass()
+        self.assertEquals(4, codec.decode_from(frame('abcd'),
+                                               max_message_size=4)[5])
+
+
+class ReceiveTest(testlib.TestCase):
+    def setUp(self):
+        super(ReceiveTest, self).setUp()
+        rfd, self.wfd = os.pipe()
+        self.router = FakeRouter()
+        self.broker = mock.Mock()
+        self.stream = mitogen.core.Stream(self.router, 1)
+        self.stream.accept(rfd, rfd)
+        os.close(rfd)
+
+    def tearDown(self):
+        self.stream.receive_side.close()
+        self.stream.transmit_side.close()
+        if self.wfd is not None:
+            os.close(self.wfd)
+        super(ReceiveTest, self).tearDown()
+
+    def feed(self, s):
+        # Like the broker, call on_receive() for as long as input is ready.
+        os.write(self.wfd, s)
+        fd = self.stream.receive_side.fd
+        while fd is not None and select.select([fd], [], [], 0)[0]:
+            self.stream.on_receive(self.broker)
+            fd = self.stream.receive_side.fd
+
+    def test_header_fields(self):
+        self.feed(frame('x'))
+        msg, = self.router.msgs
+        self.assertEquals(1, msg.dst_id)
+        self.assertEquals(2, msg.src_id)
+        self.assertEquals(3, msg.auth_id)
+        self.assertEquals(100, msg.handle)
+        self.assertEquals(4, msg.reply_to)
+        self.assertEquals('x', msg.data)
+        self.assertTrue(msg.router is self.router)
+
+    def test_many_per_read(self):
+        self.feed(''.join(frame(str(i)) for i in range(100)))
+        self.assertEquals([str(i) for i in range(100)],
+                          [msg.data for msg in self.router.msgs])
+
+    def test_stats(self):
+        self.feed(frame('x') * 3)
+        self.assertEquals(3, self.stream.rx_frames)
+        self.assertEquals(3 * 25, self.stream.rx_bytes)
+
+    def test_split_header(self):
+        s = frame('abc')
+        for c in s[:-1]:
+            self.feed(c)
+            self.assertEquals([], self.router.msgs)
+        self.feed(s[-1])
+        self.assertEquals(['abc'], [msg.data for msg in self.router.msgs])
+
+    def test_larger_than_buffer(self):
+        self.stream.input_buf_size = 64
+        data = os.urandom(mitogen.core.CHUNK_SIZE * 3)
+        self.feed_large(frame(data) + frame('tail'))
+        self.assertEquals([data, 'tail'],
+                          [msg.data for msg in self.router.msgs])
+        # Buffer is kept for a while in case more large messages follow.
+        buf = self.stream._input_buf
+        self.feed(frame('next'))
+        self.assertTrue(self.stream._input_buf is buf)
+        # Then released.
+        for i in range(self.stream.input_buf_release_after):
+            self.feed(frame('next'))
+        self.assertTrue(len(self.stream._input_buf) < len(data))
+
+    def test_larger_than_buffer_reused(self):
+        data = os.urandom(mitogen.core.CHUNK_SIZE * 3)
+        s = struct.pack(mitogen.core.Stream.HEADER_FMT, mitogen.context_id,
+                        2, 3, 100, 4, len(data)) + data
+        self.feed_large(s)
+        buf = self.stream._input_buf
+        self.assertTrue(len(buf) >= len(s))
+        self.feed_large(s)
+        self.assertTrue(self.stream._input_buf is buf)
+        self.assertEquals([data, data],
+                          [msg.data for msg in self.router.msgs])
+
+    def test_forwarded(self):
+        self.router.forward = True
+        self.feed(frame('a') + frame('b'))
+        self.assertEquals([[frame('a')], [frame('b')]], self.router.forwarded)
+        self.assertEquals([], self.router.msgs)
+
+    def test_local_not_forwarded(self):
+        self.router.forward = True
+        self.feed(struct.pack(mitogen.core.Stream.HEADER_FMT,
+                              mitogen.context_id, 2, 3, 100, 4, 1) + 'x')
+        self.assertEquals([], self.router.forwarded)
+        self.assertEquals(['x'], [msg.data for msg in self.router.msgs])
+
+    def feed_large(self, s):
+        while s:
+            self.feed(s[:65536])
+            s = s[65536:]
+
+    def unframe(self, forwarded):
+        """Return (reply_to, body) for each frame in `forwarded`."""
+        frames = []
+        for pieces in forwarded:
+            s = ''.join(pieces)
+            hdr = self.stream.header_codec.decode_from(s)
+            self.assertEquals((1, 2, 3, 100), hdr[:4])
+            self.assertEquals(hdr[5], len(s) - self.stream.HEADER_LEN)
+            frames.append((hdr[4], s[self.stream.HEADER_LEN:]))
+        return frames
+
+    def test_relay(self):
+        self.router.forward = True
+        data = os.urandom(mitogen.core.CHUNK_SIZE * 3)
+        self.feed_large(frame(data) + frame('tail'))
+        frames = self.unframe(self.router.forwarded)
+        self.assertTrue(len(frames) > 2)
+        self.assertEquals([mitogen.core.IS_FRAGMENT] * (len(frames) - 2)
+                          + [4, 4], [reply_to for reply_to, _ in frames])
+        self.assertEquals(data, ''.join(body for _, body in frames[:-1]))
+        self.assertEquals([frame('tail')], self.router.forwarded[-1])
+        # Input buffer never grew to fit the relayed frame.
+        self.assertEquals(mitogen.core.CHUNK_SIZE,
+                          len(self.stream._input_buf))
+
+    def test_relay_cut_through(self):
+        self.router.forward = True
+        data = os.urandom(mitogen.core.CHUNK_SIZE * 3)
+        self.feed(frame(data)[:65536])
+        frames = self.unframe(self.router.forwarded)
+        self.assertEquals([(mitogen.core.IS_FRAGMENT,
+                            data[:65536 - self.stream.HEADER_LEN])], frames)
+
+    def test_relay_unverified(self):
+        data = os.urandom(mitogen.core.CHUNK_SIZE * 3)
+        self.feed_large(frame(data))
+        self.assertEquals([], self.router.forwarded)
+        self.assertEquals([data], [msg.data for msg in self.router.msgs])
+
+    def test_relay_bad_source(self):
+        self.router.forward = True
+        self.router.verify = False
+        self.feed_large(frame('x' * (mitogen.core.CHUNK_SIZE * 3))
+                        + frame('tail'))
+        self.assertEquals([[frame('tail')]], self.router.forwarded)
+        self.assertEquals([], self.router.msgs)
+
+    def test_relay_route_lost(self):
+        self.router.forward = True
+        logs = testlib.LogCapturer()
+        logs.start()
+        data = os.urandom(mitogen.core.CHUNK_SIZE * 3)
+        s = frame(data)
+        self.feed(s[:65536])
+        self.router.forward = False
+        self.feed_large(s[65536:])
+        self.assertTrue('route lost while relaying' in logs.stop())
+        self.assertEquals(1, len(self.router.forwarded))
+        discard, reply = self.router.msgs
+        self.assertEquals((1, 2, 100, mitogen.core.IS_DEAD),
+                          (discard.dst_id, discard.src_id, discard.handle,
+                           discard.reply_to))
+        self.assertEquals((2, 4, mitogen.core.IS_DEAD),
+                          (reply.dst_id, reply.handle, reply.reply_to))
+
+    def test_relay_disconnect(self):
+        self.router.forward = True
+        logs = testlib.LogCapturer()
+        logs.start()
+        self.feed(frame('x' * (mitogen.core.CHUNK_SIZE * 2))[:1000])
+        os.close(self.wfd)
+        self.wfd = None
+        self.stream.on_receive(self.broker)
+        self.assertTrue('disconnected while relaying' in logs.stop())
+        self.assertEquals([(mitogen.core.IS_FRAGMENT, 'x' * 976),
+                           (mitogen.core.IS_DEAD, '')],
+                          self.unframe(self.router.forwarded))
+        self.assertEquals([], self.router.msgs)
+
+    def test_max_message_size(self):
+        self.router.max_message_size = 4
+        logs = testlib.LogCapturer()
+        logs.start()
+        self.feed(frame('12345'))
+        self.assertTrue('Maximum message size exceeded' in logs.stop())
+        self.assertEquals([], self.router.msgs)
+        self.assertEquals(None, self.stream.receive_side.fd)
+
+    def test_oversized_after_valid(self):
+        self.router.max_message_size = 1024
+        hdr = struct.pack('>LLLLLL', 1, 2, 3, 4, 5, 0xffffffff)
+        logs = testlib.LogCapturer()
+        logs.start()
+        self.feed(frame('ok') + hdr + 'garbage')
+        self.assertTrue('Maximum message size exceeded' in logs.stop())
+        self.assertEquals(['ok'], [msg.data for msg in self.router.msgs])
+        self.assertEquals(None, self.stream.receive_side.fd)
+
+    def test_disconnect(self):
+        os.close(self.wfd)
+        self.wfd = None
+        self.stream.on_receive(self.broker)
+        self.assertEquals(None, self.stream.receive_side.fd)
+        self.broker.stop_receive.assert_called_once_with(self.stream)
+
+
+class CompressTest(testlib.TestCase):
+    def setUp(self):
+        super(CompressTest, self).setUp()
+        self.router = FakeRouter()
+        self.router.broker = mock.Mock()
+        self.tx = mitogen.core.Stream(self.router, 1)
+        self.tx.transmit_side = mock.Mock()
+        self.tx.transmit_side.write.side_effect = self._write
+        self.tx.enable_compression()
+        self.rx = mitogen.core.Stream(self.router, 1)
+        self.rx.receive_side = mock.Mock()
+        self.rx.enable_compression()
+        self.wire = []
+
+    def _write(self, s):
+        if isinstance(s, memoryview):
+            s = s.tobytes()
+        self.wire.append(s)
+        return len(s)
+
+    def send(self, data):
+        self.tx._send(mitogen.core.Message(dst_id=1, src_id=2, auth_id=3,
+                                           handle=100, reply_to=4, data=data))
+
+    def transmit(self):
+        del self.wire[:]
+        self.tx.on_transmit(self.router.broker)
+        while self.tx.pending_bytes():
+            self.tx.on_transmit(self.router.broker)
+        return ''.join(self.wire)
+
+    def receive(self, s):
+        self.rx.receive_side.read.return_value = s
+        self.rx.on_receive(self.router.broker)
+        return [msg.data for msg in self.router.msgs]
+
+    def test_round_trip(self):
+        self.send('a')
+        self.assertEquals(['a'], self.receive(self.transmit()))
+        self.send('b')
+        self.send('c')
+        self.assertEquals(['a', 'b', 'c'], self.receive(self.transmit()))
+
+    def test_batch_one_flush(self):
+        for i in range(100):
+            self.send('x' * 100)
+        self.assertEquals([], self.wire)
+        wire = self.transmit()
+        self.assertEquals(1, len(self.wire))
+        self.assertTrue(len(wire) < 100 * (24 + 100) / 10)
+        self.assertEquals(['x' * 100] * 100, self.receive(wire))
+
+    def test_split_input(self):
+        for i in range(10):
+            self.send(str(i) * 1000)
+        for c in self.transmit():
+            self.receive(c)
+        self.assertEquals([str(i) * 1000 for i in range(10)],
+                          [msg.data for msg in self.router.msgs])
+
+    def test_inflate_bounded(self):
+        self.rx.input_buf_size = 1024
+        for i in range(10):
+            self.send(' ' * 100000)
+        self.assertEquals([' ' * 100000] * 10,
+                          self.receive(self.transmit()))
+        self.assertTrue(len(self.rx._input_buf) < 200000)
+
+    def test_inflate_pending_output(self):
+        # Output filling the limit just as input runs out may leave the rest
+        # of a frame pending in the decompressor. Whatever prefix of the
+        # stream arrives, any frame it fully encodes must be delivered.
+        size = 1024 + 1
+        data = 'x' * (size - self.rx.HEADER_LEN)
+        self.send(data)
+        wire = self.transmit()
+        for i in range(1, len(wire) + 1):
+            self.setUp()
+            self.rx.input_buf_size = 1024
+            inflated = zlib.decompressobj().decompress(wire[:i])
+            expect = [data] if len(inflated) == size else []
+            self.assertEquals(expect, self.receive(wire[:i]))
+
+    def test_not_relayed(self):
+        self.router.forward = True
+        self.send('x' * (mitogen.core.CHUNK_SIZE * 3))
+        wire = self.transmit()
+        for i in range(0, len(wire), 1000):
+            self.receive(wire[i:i + 1000])
+        pieces, = self.router.forwarded
+        self.assertEquals(frame('x' * (mitogen.core.CHUNK_SIZE * 3)),
+                          ''.join(pieces))
+
+    def test_fragmented(self):
+        self.tx.fragment_size = 4
+        self.send('abcdefghij')
+        self.receive(self.transmit())
+        self.assertEquals(['abcd', 'efgh', 'ij'],
+                          [msg.data for msg in self.router.msgs])
+
+    def test_prime(self):
+        self.tx.enable_compression(prime='mitogen.core' * 10)
+        self.rx.enable_compression(prime='mitogen.core' * 10)
+        self.send('a')
+        self.assertEquals(['a'], self.receive(self.transmit()))
+
+    def test_corrupt(self):
+        self.send('a')
+        wire = self.transmit()
+        self.assertRaises(zlib.error,
+                          lambda: self.receive('junk' + wire[4:]))
+
+
+class TransmitMixin(object):
+    def setUp(self):
+        super(TransmitMixin, self).setUp()
+        self.router = FakeRouter()
+        self.router.broker = mock.Mock()
+        self.stream = mitogen.core.Stream(self.router, 1)
+        self.stream.transmit_side = mock.Mock()
+        self.stream.transmit_side.write.side_effect = self._write
+        self.written = []
+
+    def _write(self, s, limit=None):
+        if isinstance(s, memoryview):
+            s = s.tobytes()
+        s = s[:limit]
+        self.written.append(s)
+        return len(s)
+
+    def send(self, data):
+        self.stream._send(mitogen.core.Message(dst_id=1, src_id=2, auth_id=3,
+                                               handle=100, reply_to=4,
+                                               data=data))
+
+
+class TransmitTest(TransmitMixin, testlib.TestCase):
+    def test_coalesced(self):
+        for i in range(100):
+            self.send(str(i))
+        self.stream.on_transmit(self.router.broker)
+        self.assertEquals([''.join(frame(str(i)) for i in range(100))],
+                          self.written)
+        self.assertEquals(0, self.stream.pending_bytes())
+        self.router.broker._stop_transmit.assert_called_once_with(self.stream)
+
+    def test_max_write_size(self):
+        self.stream.max_write_size = 100
+        for i in range(10):
+            self.send('x' * 10)
+        while self.stream.pending_bytes():
+            self.stream.on_transmit(self.router.broker)
+        self.assertEquals(frame('x' * 10) * 10, ''.join(self.written))
+        self.assertTrue(all(len(s) <= 100 for s in self.written))
+
+    def test_large_not_coalesced(self):
+        data = 'x' * (self.stream.max_write_size + 1)
+        self.send('a')
+        self.send(data)
+        while self.stream.pending_bytes():
+            self.stream.on_transmit(self.router.broker)
+        self.assertEquals(frame('a') + frame(data), ''.join(self.written))
+        self.assertEquals(data, self.written[-1])
+
+    def test_partial_write(self):
+        self.stream.transmit_side.write.side_effect = (
+            lambda s: self._write(s, 7)
+        )
+        for i in range(3):
+            self.send('abcdefgh')
+        while self.stream.pending_bytes():
+            self.stream.on_transmit(self.router.broker)
+        self.assertEquals(frame('abcdefgh') * 3, ''.join(self.written))
+
+    def test_writev(self):
+        side = self.stream.transmit_side
+        side.writev.side_effect = lambda bufs: self._write(''.join(bufs))
+        writev = mock.Mock()
+        self.send('a')
+        self.send('b')
+        mock.patch.object(os, 'writev', writev, create=True).start()
+        try:
+            self.stream.on_transmit(self.router.broker)
+        finally:
+            mock.patch.stopall()
+        self.assertEquals(1, side.writev.call_count)
+        self.assertEquals([frame('a') + frame('b')], self.written)
+
+
+class FlushTest(TransmitMixin, testlib.TestCase):
+    def test_flush_requested_once(self):
+        self.send('a')
+        self.send('b')
+        self.router.broker._flush_soon.assert_called_once_with(self.stream)
+
+    def test_written(self):
+        self.send('a')
+        self.stream.on_flush(self.router.broker)
+        self.assertEquals([frame('a')], self.written)
+        self.assertFalse(self.router.broker._start_transmit.called)
+
+    def test_partial_write(self):
+        self.stream.transmit_side.write.side_effect = (
+            lambda s: self._write(s, 7)
+        )
+        self.send('abcdefgh')
+        self.stream.on_flush(self.router.broker)
+        self.router.broker._start_transmit.assert_called_once_with(
+            self.stream
+        )
+
+    def test_would_block(self):
+        self.stream.transmit_side.write.side_effect = (
+            OSError(errno.EAGAIN, 'Resource temporarily unavailable')
+        )
+        self.send('a')
+        self.stream.on_flush(self.router.broker)
+        self.assertEquals(len(frame('a')), self.stream.pending_bytes())
+        self.router.broker._start_transmit.assert_called_once_with(
+            self.stream
+        )
+
+
+class TransmitStatsTest(TransmitMixin, testlib.TestCase):
+    def test_stats(self):
+        self.stream.max_write_size = 34
+        for i in range(3):
+            self.send('x' * 10)
+        self.stream.on_transmit(self.router.broker)
+        stats = self.stream.get_stats()
+        self.assertEquals(3, stats['tx_frames'])
+        self.assertEquals(34, stats['tx_bytes'])
+        self.assertEquals(68, stats['pending'])
+        self.assertEquals(102, stats['max_pending'])
+
+
+class FragmentTest(TransmitMixin, testlib.TestCase):
+    def setUp(self):
+        super(FragmentTest, self).setUp()
+        self.stream.fragment_size = 4
+
+    def fragment(self, data, reply_to):
+        return struct.pack(mitogen.core.Stream.HEADER_FMT,
+                           1, 2, 3, 100, reply_to, len(data)) + data
+
+    def transmit(self):
+        while self.stream.pending_bytes():
+            self.stream.on_transmit(self.router.broker)
+        return ''.join(self.written)
+
+    def test_at_limit(self):
+        self.send('abcd')
+        self.assertEquals(frame('abcd'), self.transmit())
+
+    def test_fragmented(self):
+        self.send('abcdefghij')
+        IS_FRAGMENT = mitogen.core.IS_FRAGMENT
+        self.assertEquals(self.fragment('abcd', IS_FRAGMENT)
+                          + self.fragment('efgh', IS_FRAGMENT)
+                          + frame('ij'), self.transmit())
+
+    def test_exact_multiple(self):
+        self.send('abcdefgh')
+        self.assertEquals(self.fragment('abcd', mitogen.core.IS_FRAGMENT)
+                          + frame('efgh'), self.transmit())
+
+    def test_not_copied(self):
+        data = 'abcdefghij'
+        self.send(data)
+        bodies = list(self.stream._output_buf)[1::2]
+        self.assertEquals(3, len(bodies))
+        self.assertFalse(any(isinstance(s, type(data)) for s in bodies))
+        self.assertEquals(frame('ij'), self.transmit()[-len(frame('ij')):])
+
+
+class SingleLaneTest(TransmitMixin, testlib.TestCase):
+    def transmit(self):
+        while self.stream.pending_bytes():
+            self.stream.on_transmit(self.router.broker)
+        return ''.join(self.written)
+
+    def test_idle_bypasses_lanes(self):
+        self.send('abc')
+        self.assertEquals(0, self.stream._queued_len)
+        self.assertEquals(len(frame('abc')), self.stream.pending_bytes())
+        self.assertEquals(frame('abc'), self.transmit())
+
+    def test_queued_behind_lanes(self):
+        self.stream._lanes[-1].append((3, ['xyz'], 0))
+        self.stream._queued_len = 3
+        self.send('abc')
+        self.assertEquals(3 + len(frame('abc')), self.stream._queued_len)
+        self.stream.on_transmit(self.router.broker)
+        self.assertEquals('xyz' + frame('abc'), ''.join(self.written))
+
+
+class LaneTest(TransmitMixin, testlib.TestCase):
+    def setUp(self):
+        super(LaneTest, self).setUp()
+        self.stream.max_write_size = 100
+        self.stream.priority_lanes = True
+
+    def send(self, data, handle=1000):
+        self.stream._send(mitogen.core.Message(dst_id=1, src_id=2, auth_id=3,
+                                               handle=handle, reply_to=4,
+                                               data=data))
+
+    def transmit(self):
+        while self.stream.pending_bytes():
+            self.stream.on_transmit(self.router.broker)
+        return ''.join(self.written)
+
+    def handles(self, wire):
+        handles = []
+        while wire:
+            hdr = self.stream.header_codec.decode_from(wire)
+            handles.append(hdr[3])
+            wire = wire[self.stream.HEADER_LEN + hdr[5]:]
+        return handles
+
+    def test_priority_overtakes(self):
+        for i in range(10):
+            self.send('x' * 76)
+        self.stream.on_transmit(self.router.broker)
+        self.send('call', handle=mitogen.core.CALL_FUNCTION)
+        self.assertEquals([1000, mitogen.core.CALL_FUNCTION] + [1000] * 9,
+                          self.handles(self.transmit()))
+
+    def test_handle_order_kept(self):
+        for i in range(5):
+            self.send(str(i) * 76)
+        self.send('5', handle=mitogen.core.SHUTDOWN)
+        self.send('6')
+        wire = self.transmit()
+        self.assertEquals([1000] * 5 + [mitogen.core.SHUTDOWN, 1000],
+                          self.handles(wire))
+        self.assertEquals(''.join(frame(str(i) * 76, 1000) for i in range(5)),
+                          wire[:500])
+
+    def test_fair(self):
+        self.stream.lane_quantum = (200, 100)
+        for i in range(10):
+            self.send('x' * 76)
+            self.send('y' * 76, handle=mitogen.core.CALL_FUNCTION)
+        handles = self.handles(self.transmit())
+        self.assertEquals([101, 101, 1000] * 3, handles[:9])
+
+    def test_priority_not_overtaken(self):
+        self.stream.lane_quantum = (100, 100)
+        for i in range(3):
+            self.send('y' * 76, handle=mitogen.core.ADD_ROUTE)
+        self.send('x' * 76)
+        handles = self.handles(self.transmit())
+        self.assertEquals([mitogen.core.ADD_ROUTE] * 3 + [1000], handles)
+
+    def test_fragments_interleaved(self):
+        self.stream.fragment_size = 76
+        self.send('x' * 76 * 4)
+        self.send('call', handle=mitogen.core.CALL_FUNCTION)
+        handles = self.handles(self.transmit())
+        self.assertEquals([mitogen.core.CALL_FUNCTION] + [1000] * 4, handles)
+
+    def test_order_kept_across_lanes_by_default(self):
+        self.stream.priority_lanes = False
+        for i in range(3):
+            self.send('x' * 76)
+        self.stream.on_transmit(self.router.broker)
+        self.send('call', handle=mitogen.core.CALL_FUNCTION)
+        self.send('log', handle=mitogen.core.FORWARD_LOG)
+        self.send('x' * 76)
+        self.assertEquals([1000] * 3 + [mitogen.core.CALL_FUNCTION,
+                                        mitogen.core.FORWARD_LOG, 1000],
+                          self.handles(self.transmit()))
+
+    def test_pending_bytes(self):
+        self.send('x' * 76)
+        self.send('y' * 76, handle=mitogen.core.CALL_FUNCTION)
+        self.assertEquals(200, self.stream.pending_bytes())
+        self.stream.on_transmit(self.router.broker)
+        self.assertEquals(100, self.stream.pending_bytes())
+
+
+class CongestionTest(TransmitMixin, testlib.TestCase):
+    def setUp(self):
+        super(CongestionTest, self).setUp()
+        self.stream.high_watermark = 100
+        self.stream.low_watermark = 50
+        self.stream.max_write_size = 30
+        self.drained = []
+
+    def test_not_congested(self):
+        self.send('x' * (100 - 24))
+        self.assertFalse(self.stream.congested)
+        self.stream.call_when_drained(lambda: self.drained.append(1))
+        self.assertEquals([1], self.drained)
+
+    def test_congested(self):
+        self.send('x' * 100)
+        self.assertTrue(self.stream.congested)
+        self.stream.call_when_drained(lambda: self.drained.append(1))
+        self.assertEquals([], self.drained)
+
+    def test_drain(self):
+        for i in range(5):
+            self.send('x' * 6)
+        self.assertTrue(self.stream.congested)
+        self.stream.call_when_drained(lambda: self.drained.append(1))
+        fired = []
+        mitogen.core.listen(self.stream, 'drain', lambda: fired.append(1))
+        self.stream.on_transmit(self.router.broker)
+        self.stream.on_transmit(self.router.broker)
+        self.assertEquals(90, self.stream.pending_bytes())
+        self.assertEquals([], self.drained)
+        self.stream.on_transmit(self.router.broker)
+        self.assertEquals(60, self.stream.pending_bytes())
+        self.assertEquals([], self.drained)
+        self.stream.on_transmit(self.router.broker)
+        self.assertEquals([1], self.drained)
+        self.assertEquals([1], fired)
+        self.assertFalse(self.stream.congested)
+
+    def test_disconnect_releases(self):
+        self.send('x' * 100)
+        self.stream.call_when_drained(lambda: self.drained.append(1))
+        self.stream.receive_side = mock.Mock()
+        self.stream.on_disconnect(self.router.broker)
+        self.assertEquals([1], self.drained)
+
+
+if __name__ == '__main__':
+    unittest2.main()
@@ -0,0 +1,128 @@
+
+import threading
+
+import mock
+import unittest2
+
+import testlib
+import mitogen.core
+import mitogen.master
+
+
+class WakeupSuppressionTest(testlib.TestCase):
+    def setUp(self):
+        super(WakeupSuppressionTest, self).setUp()
+        self.waker = mitogen.core.Waker(mock.Mock())
+        self.write = mock.Mock(side_effect=self.waker.transmit_side.write)
+        self.waker.transmit_side.write = self.write
+        self.calls = []
+
+    def tearDown(self):
+        self.waker.receive_side.close()
+        self.waker.transmit_side.close()
+        super(WakeupSuppressionTest, self).tearDown()
+
+    def test_defer_wakes_once(self):
+        for i in range(3):
+            self.waker.defer(self.calls.append, i)
+        self.assertEquals(1, self.write.call_count)
+
+        self.waker.on_receive(None)
+        self.assertEquals([0, 1, 2], self.calls)
+
+        self.waker.defer(self.calls.append, 3)
+        self.assertEquals(2, self.write.call_count)
+
+    def test_defer_many_wakes_once(self):
+        self.waker.defer_many([
+            (self.calls.append, (i,), {})
+            for i in range(3)
+        ])
+        self.waker.defer_many([(self.calls.append, (3,), {})])
+        self.assertEquals(1, self.write.call_count)
+
+        self.waker.on_receive(None)
+        self.assertEquals([0, 1, 2, 3], self.calls)
+
+    def test_defer_stats(self):
+        for i in range(3):
+            self.waker.defer(self.calls.append, i)
+        self.waker.on_receive(None)
+        self.assertEquals(3, self.waker.deferred_calls)
+        self.assertTrue(0 <= self.waker.defer_latency_max)
+        self.assertEquals(self.waker.defer_latency,
+                          self.waker.defer_latency_max)
+
+    def test_defer_stats_off(self):
+        self.waker._broker.stats_interval = None
+        self.waker.defer(self.calls.append, 0)
+        self.waker.on_receive(None)
+        self.assertEquals(1, self.waker.deferred_calls)
+        self.assertEquals(0, self.waker.defer_latency)
+
+    def test_defer_many_empty(self):
+        self.waker.defer_many([])
+        self.assertEquals(0, self.write.call_count)
+
+
+class ThreadedDeferTest(testlib.BrokerMixin, unittest2.TestCase):
+    def _produce(self, defer_many):
+        for x in range(1000):
+            if defer_many:
+                self.broker.defer_many([(self.calls.append, (x,), {})] * 2)
+            else:
+                self.broker.defer(self.calls.append, x)
+
+    def _test(self, nthreads, defer_many=False):
+        self.calls = []
+        threads = [
+            threading.Thread(target=self._produce, args=(defer_many,))
+            for x in range(nthreads)
+        ]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        self.sync_with_broker()
+        return self.calls
+
+    def test_1_thread(self):
+        self.assertEquals(range(1000), self._test(1))
+
+    def test_4_threads(self):
+        calls = self._test(4)
+        self.assertEquals(sorted(4 * range(1000)), sorted(calls))
+
+    def test_16_threads(self):
+        calls = self._test(16)
+        self.assertEquals(sorted(16 * range(1000)), sorted(calls))
+
+    def test_16_threads_defer_many(self):
+        calls = self._test(16, defer_many=True)
+        self.assertEquals(sorted(32 * range(1000)), sorted(calls))
+
+
+class RouteManyTest(testlib.RouterMixin, testlib.TestCase):
+    def test_route_many(self):
+        recv = mitogen.core.Receiver(self.router)
+        self.router.route_many([
+            mitogen.core.Message.pickled(i, dst_id=mitogen.context_id,
+                                         handle=recv.handle)
+            for i in range(10)
+        ])
+        self.assertEquals(range(10), [recv.get().unpickle()
+                                      for i in range(10)])
+
+    def test_send_many(self):
+        recv = mitogen.core.Receiver(self.router)
+        context = self.router.context_by_id(mitogen.context_id)
+        context.send_many([
+            mitogen.core.Message.pickled(i, handle=recv.handle)
+            for i in range(10)
+        ])
+        self.assertEquals(range(10), [recv.get().unpickle()
+                                      for i in range(10)])
+
+
+if __name__ == '__main__':
+    unittest2.main()